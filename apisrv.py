@@ -1,26 +1,84 @@
 import asyncio
 import logging
 import multiprocessing
+import threading
 from asyncio import CancelledError
 from pathlib import Path
 
 import sys
 import uvicorn
 from fastapi import FastAPI
+from uvicorn.supervisors import Multiprocess
 
+from callbacks import close_http, init_callbacks_dispatcher
 from config import Config
 from const import SRV_PORT
-from db import create_tables
+from counteragents import init_counteragents_sync
+from db import create_tables, engine
+from diadoc.aconnector import DiadocHttp
+from docstatus import init_events_poller
 from logger import formatter, info, logger
 from middleware import middleware
 from router import CadesLogic, router
 from sender import init_repeat_task
+from signd import SignDaemonProcess
 
 KEYFILE_NAME = './certs/server.key'
 CERTFILE_NAME = './certs/server.crt'
 
 VERSION='0.3.1'
 
+# отправка, статусы, контрагенты и уведомления. Запускаются ровно в одном процессе
+BACKGROUND_TASKS = (init_repeat_task, init_counteragents_sync, init_events_poller, init_callbacks_dispatcher)
+
+
+def create_app() -> FastAPI:
+    """Фабрика приложения. С демоном подписи uvicorn вызывает её в каждом воркере,
+    поэтому здесь только то, что нужно для обработки запросов. Фоновые задачи - add_background_tasks"""
+    Config()
+    CadesLogic()
+
+    app = FastAPI(middleware=middleware)
+    app.include_router(router)
+    app.on_event("shutdown")(DiadocHttp().close)
+    app.on_event("shutdown")(close_http)
+    app.on_event("shutdown")(engine.dispose)
+    return app
+
+
+def add_background_tasks(app: FastAPI) -> FastAPI:
+    """Один процесс: фоновые задачи работают в цикле событий сервера"""
+    for init in BACKGROUND_TASKS:
+        app.on_event("startup")(init)
+    return app
+
+
+async def run_background() -> None:
+    for init in BACKGROUND_TASKS:
+        await init()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await DiadocHttp().close()
+        await close_http()
+        await engine.dispose()
+
+
+class BackgroundProcess(multiprocessing.Process):
+    """Несколько воркеров: фоновые задачи - в отдельном процессе, иначе каждый воркер опрашивал бы ДИАДОК
+    и отправлял очередь сам по себе"""
+
+    def __init__(self):
+        super().__init__(name='cades-background', daemon=True)
+
+    def run(self):
+        asyncio.run(run_background())
+
+    def stop(self):
+        self.terminate()
+        self.join(10)
+
+
 class UvicornServer(uvicorn.Server):
     # server: uvicorn.Server
     uvconf: uvicorn.Config
@@ -47,31 +105,72 @@ class UvicornServer(uvicorn.Server):
     certfile = property(lambda x: x.__get_file('certfile'))
 
     def __init__(self):
-        Config()
-        CadesLogic()
-
-        self.app = FastAPI(middleware=middleware)
-        self.app.include_router(router)
-        self.app.on_event("startup")(init_repeat_task)
-        self.uvconf = uvicorn.Config(self.app,
-                                     host="0.0.0.0",
-                                     port=SRV_PORT,
-                                     use_colors=False,
-                                     ssl_keyfile=self.keyfile,
-                                     ssl_certfile=self.certfile)
+        self.signd = None
+        self.background = None
+        self.supervisor = None
+        self.options = dict(host="0.0.0.0",
+                            port=SRV_PORT,
+                            use_colors=False,
+                            ssl_keyfile=self.keyfile,
+                            ssl_certfile=self.certfile)
+        self.app = create_app()
+        if Config().workers == 1:
+            add_background_tasks(self.app)
+        self.uvconf = uvicorn.Config(self.app, **self.options)
         info("UvicornServer created")
         asyncio.run(create_tables())
         super().__init__(self.uvconf)
 
+    def run(self, sockets=None):
+        conf = Config()
+        if conf.sign_daemon:
+            self.signd = SignDaemonProcess()
+            self.signd.start()
+        try:
+            if conf.workers > 1:
+                self.background = BackgroundProcess()
+                self.background.start()
+                self.run_workers(conf.workers)
+            else:
+                super().run(sockets)
+        finally:
+            # демон подписи - последним: воркеры могли дописывать через него
+            if self.background:
+                self.background.stop()
+            if self.signd:
+                self.signd.stop()
+
+    def run_workers(self, workers: int):
+        """То же, что uvicorn.run(workers=...), но супервизор остаётся у нас - его останавливает stop()"""
+        info(f"Starting {workers} workers")
+        config = uvicorn.Config("apisrv:create_app", factory=True, workers=workers, **self.options)
+        sock = config.bind_socket()
+        self.supervisor = Multiprocess(config, target=uvicorn.Server(config).run, sockets=[sock])
+        try:
+            if not self.should_exit:
+                self.supervisor.run()
+        finally:
+            sock.close()
+
     def stop(self):
+        """Можно вызывать из другого потока (служба Windows). Воркеры завершает супервизор:
+        SIGTERM, на Windows - CTRL_BREAK_EVENT, и ждёт их"""
         self.force_exit = True
         self.should_exit = True
+        if self.supervisor:
+            self.supervisor.should_exit.set()
 
 
 class ForkService(multiprocessing.Process):
 
+    def __init__(self):
+        super().__init__()
+        self.stopping = multiprocessing.Event()
+
     def run(self):
         us = UvicornServer()
+        # terminate() на Windows убивает процесс сразу, и воркеры остались бы без супервизора
+        threading.Thread(target=lambda: self.stopping.wait() and us.stop(), daemon=True).start()
         us.run()
 
     def start(self):
@@ -80,11 +179,15 @@ class ForkService(multiprocessing.Process):
 
         super().start()
 
-    def stop(self):
-        self.terminate()
+    def stop(self, timeout: float = 30):
+        self.stopping.set()
+        self.join(timeout)
+        if self.is_alive():
+            self.terminate()
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     stm_h = logging.StreamHandler(sys.stdout)
     stm_h.setFormatter(formatter)
     logger.addHandler(stm_h)
@@ -0,0 +1,223 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+from uuid import UUID
+
+import aiohttp
+from sqlalchemy import and_, delete, exists, func, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from config import Config
+from const import CallbackStatus
+from db import Callback, Document, Session, is_postgres, listen, notify
+from dbwriter import write
+from logger import logger
+from retry import Wakeup, backoff_delay
+
+
+RETRY_CLASS = 'callback'
+NOTIFY_CHANNEL = 'cades_callbacks'
+
+_wakeup = Wakeup()
+_http: aiohttp.ClientSession|None = None
+
+
+def wake_dispatcher() -> None:
+    """Вызывать после commit транзакции, в которой добавлены уведомления"""
+    _wakeup.set()
+
+
+def http_session() -> aiohttp.ClientSession:
+    """Общий пул соединений для всех URL уведомлений"""
+    global _http
+
+    if _http is None or _http.closed:
+        conf = Config()
+        _http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False),
+                                      timeout=aiohttp.ClientTimeout(total=conf.callback_timeout))
+    return _http
+
+
+async def close_http() -> None:
+    if _http and not _http.closed:
+        await _http.close()
+
+
+def callback_payload(doc: Document, stt: 'DocflowStatusModel|None' = None) -> dict:
+    """stt - новый статус ЭДО, если он ещё не записан в doc"""
+    return {"uuid"            : str(doc.uuid),
+            "status"          : str(doc.status),
+            "edo_status"      : stt.Severity if stt else doc.diadoc_status,
+            "edo_status_descr": stt.StatusText if stt else doc.diadoc_status_descr}
+
+
+async def enqueue_callbacks(ss: AsyncSession, payloads: list[dict]) -> int:
+    """Добавить уведомления в текущую транзакцию. После commit нужно вызвать wake_dispatcher(),
+    обработчик в другом процессе (PG) разбудит NOTIFY"""
+    now = datetime.now()
+    rows = [Callback(doc_uuid=UUID(p['uuid']), url=url, payload=json.dumps(p, ensure_ascii=False),
+                     status=CallbackStatus.PENDING, tries=0, created_at=now)
+            for p in payloads for url in Config().callback_urls]
+    ss.add_all(rows)
+    if rows:
+        await notify(ss, NOTIFY_CHANNEL)
+    return len(rows)
+
+
+def is_due(now: datetime):
+    return and_(Callback.status == CallbackStatus.PENDING,
+                or_(Callback.next_attempt_at.is_(None), Callback.next_attempt_at <= now))
+
+
+def in_order(now: datetime|None = None):
+    """Уведомления одного документа на один URL уходят по порядку: строку не берём, пока есть более ранняя
+    недоставленная (в том числе в доставке или ждущая повтора). С now более ранние, которым тоже пора,
+    не мешают - их забирают вместе с этой в один пакет"""
+    prev = aliased(Callback)
+    blocking = [prev.url == Callback.url, prev.doc_uuid == Callback.doc_uuid,
+                prev.status == CallbackStatus.PENDING, prev.id < Callback.id]
+    if now:
+        blocking.append(prev.next_attempt_at > now)
+    return ~exists().where(*blocking)
+
+
+async def lease(ss: AsyncSession, rows: list[Callback], now: datetime) -> list[Callback]:
+    """next_attempt_at сдвигается на срок аренды (как у документов), чтобы другие процессы их не взяли"""
+    if rows:
+        await ss.execute(update(Callback)
+                         .where(Callback.id.in_([r.id for r in rows]))
+                         .values(next_attempt_at=now + timedelta(seconds=Config().sender_lease)))
+    for r in rows:
+        ss.expunge(r)
+    return rows
+
+
+async def claim_callbacks(limit: int, exclude_urls: list[str]) -> list[Callback]:
+    """Уведомления на URL без пакетного режима, которым пора уйти"""
+    now = datetime.now()
+
+    async def claim(ss: AsyncSession) -> list[Callback]:
+        rows = (await ss.execute(select(Callback)
+                                 .where(is_due(now), in_order(), Callback.url.not_in(exclude_urls))
+                                 .order_by(Callback.id)
+                                 .limit(limit)
+                                 .with_for_update(skip_locked=True))).scalars().all()
+        return await lease(ss, rows, now)
+
+    return await write(claim)
+
+
+async def claim_batch(target: dict) -> tuple[list[Callback], datetime|None]:
+    """Пакет для URL, если накопилось max-count уведомлений или самое старое ждёт дольше window.
+    Иначе - пустой список и время, когда пакет будет готов"""
+    now = datetime.now()
+    async with Session() as ss:
+        count, oldest = (await ss.execute(select(func.count(), func.min(Callback.created_at))
+                                          .where(is_due(now), in_order(now), Callback.url == target['url']))).one()
+        if not count:
+            return [], None
+        ready_at = oldest + timedelta(seconds=target['window'])
+        if count < target['max-count'] and ready_at > now:
+            return [], ready_at
+
+    async def claim(ss: AsyncSession) -> list[Callback]:
+        rows = (await ss.execute(select(Callback)
+                                 .where(is_due(now), in_order(now), Callback.url == target['url'])
+                                 .order_by(Callback.id)
+                                 .limit(target['max-count'])
+                                 .with_for_update(skip_locked=True))).scalars().all()
+        return await lease(ss, rows, now)
+
+    return await write(claim), None
+
+
+def batch_payload(rows: list[Callback]) -> str:
+    """Несколько переходов одного документа в пакете схлопываются до последнего"""
+    latest = {}
+    for r in sorted(rows, key=lambda r: r.id):
+        latest.pop(r.doc_uuid, None)
+        latest[r.doc_uuid] = r.payload
+    return f"[{','.join(latest.values())}]"
+
+
+async def deliver(url: str, rows: list[Callback], sem: asyncio.Semaphore, batch: bool = False) -> None:
+    try:
+        async with sem:
+            async with http_session().post(url, data=batch_payload(rows) if batch else rows[0].payload,
+                                           headers={'Content-Type': 'application/json'}) as res:
+                if res.status >= 300:
+                    raise RuntimeError(f"HTTP {res.status}: {(await res.text())[:256]}")
+        logger.debug(f"callback {url} is called for {len(rows)} changes")
+        await write(lambda ss: ss.execute(delete(Callback).where(Callback.id.in_([r.id for r in rows]))))
+    except Exception as e:
+        await schedule_retry(url, rows, f"{type(e).__name__}: {e}")
+
+
+async def schedule_retry(url: str, rows: list[Callback], msg: str) -> None:
+    policy = Config().retry_policy(RETRY_CLASS)
+    tries = max(r.tries for r in rows) + 1
+    values = {'tries': tries, 'error_msg': msg[:512]}
+    if tries >= policy['max-tries']:
+        values.update(status=CallbackStatus.DEAD, next_attempt_at=None)
+        logger.error(f"callback {url} for {len(rows)} changes is dropped after {tries} tries: {msg}")
+    else:
+        values['next_attempt_at'] = datetime.now() + backoff_delay(policy, tries)
+        logger.warning(f"callback {url} for {len(rows)} changes will be retried at {values['next_attempt_at']}: {msg}")
+
+    await write(lambda ss: ss.execute(update(Callback).where(Callback.id.in_([r.id for r in rows])).values(**values)))
+
+
+async def dispatch_callbacks() -> None:
+    conf = Config()
+    wakeup = _wakeup.event
+    # медленный URL не должен занимать все соединения и задерживать остальные
+    semaphores: dict[str, asyncio.Semaphore] = {}
+    inflight: set[asyncio.Task] = set()
+
+    def done(task: asyncio.Task):
+        inflight.discard(task)
+        wakeup.set()
+
+    def start(url: str, rows: list[Callback], batch: bool = False):
+        sem = semaphores.setdefault(url, asyncio.Semaphore(conf.callback_concurrency))
+        task = asyncio.create_task(deliver(url, rows, sem, batch))
+        inflight.add(task)
+        task.add_done_callback(done)
+
+    while True:
+        wakeup.clear()
+        wake_at = []
+        try:
+            batched = [t for t in conf.callback_targets if t['batch']]
+            for target in batched:
+                rows, ready_at = await claim_batch(target)
+                if rows:
+                    start(target['url'], rows, batch=True)
+                elif ready_at:
+                    wake_at.append(ready_at)
+
+            if (free := conf.callback_batch_size - len(inflight)) > 0:
+                for cb in await claim_callbacks(free, [t['url'] for t in batched]):
+                    start(cb.url, [cb])
+
+            async with Session() as ss:
+                if next_attempt := (await ss.execute(select(func.min(Callback.next_attempt_at))
+                                                     .where(Callback.status == CallbackStatus.PENDING))).scalar():
+                    wake_at.append(next_attempt)
+        except Exception as e:
+            logger.error(f"Callbacks dispatching failed: {str(e)}")
+
+        timeout = conf.sender_poll_interval
+        if wake_at:
+            timeout = max(0.0, min(timeout, (min(wake_at) - datetime.now()).total_seconds()))
+        try:
+            await asyncio.wait_for(wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def init_callbacks_dispatcher() -> None:
+    asyncio.create_task(dispatch_callbacks())
+    if is_postgres:
+        asyncio.create_task(listen(NOTIFY_CHANNEL, wake_dispatcher, Config().sender_poll_interval))
@@ -0,0 +1,141 @@
+import re
+import threading
+from datetime import datetime
+from time import monotonic
+
+import pytz
+
+from logger import logger
+
+
+# Если сертификат не нашёлся по номеру - перечитать хранилище, но не чаще чем раз в N секунд
+MISS_REFRESH_INTERVAL = 10
+
+RDN_SPLIT = re.compile(r',\s*(?=[^,=]+=)')
+
+
+def subject_tokens(subject: str) -> set[str]:
+    """'CN=Иванов, O=ООО Ромашка' -> {'CN=Иванов', 'Иванов', 'O=ООО Ромашка', 'ООО Ромашка'}"""
+    tokens = set()
+    for rdn in RDN_SPLIT.split(subject or ''):
+        if rdn := rdn.strip():
+            tokens.add(rdn)
+            if '=' in rdn:
+                tokens.add(rdn.split('=', 1)[1].strip())
+    return tokens
+
+
+class IndexedCert:
+    __slots__ = ('cert', 'number', 'subject', 'valid_to')
+
+    def __init__(self, cert, number: str, subject: str, valid_to: datetime):
+        self.cert = cert
+        self.number = number
+        self.subject = subject
+        self.valid_to = valid_to
+
+
+class CertIndex:
+    """Кэш сертификатов хранилища. Поиск по SerialNumber и частям SubjectName без обращения к криптопровайдеру.
+    Перечитывается в фоне раз в `settings.cert-refresh-interval` секунд или по refresh()"""
+
+    def __init__(self, logic: 'LogicAbstract', interval: int):
+        self.logic = logic
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._refreshed_at = None
+        self._entries: list[IndexedCert] = []
+        self._by_number: dict[str, IndexedCert] = {}
+        self._by_token: dict[str, list[IndexedCert]] = {}
+
+    def refresh(self):
+        with self._lock:
+            entries = [IndexedCert(c, str(c.SerialNumber), str(c.SubjectName), self.logic.cert_valid_to(c))
+                       for c in self.logic.certs]
+            by_token = {}
+            for e in entries:
+                for t in subject_tokens(e.subject):
+                    by_token.setdefault(t, []).append(e)
+
+            self._entries, self._by_number, self._by_token = \
+                entries, {e.number: e for e in entries}, by_token
+            self._refreshed_at = monotonic()
+        logger.debug(f"Certificate index refreshed: {len(entries)} certificates")
+
+    def _run(self):
+        self.logic.executor_initializer()
+        while not self._stop.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Can't refresh certificate index: {e}")
+
+    def _ensure(self):
+        if self._refreshed_at is None:
+            self.refresh()
+        if self._thread is None and self.interval > 0:
+            self._thread = threading.Thread(target=self._run, name='cades-cert-index', daemon=True)
+            self._thread.start()
+
+    @property
+    def loaded(self) -> bool:
+        return self._refreshed_at is not None
+
+    def cached(self, number: str) -> IndexedCert|None:
+        """Действующий сертификат по номеру - только из кэша, хранилище не трогаем"""
+        if (e := self._by_number.get(number)) and e.valid_to > datetime.now(tz=pytz.UTC):
+            return e
+
+    def refresh_if_stale(self) -> bool:
+        """Перечитать хранилище, если это не делали последние MISS_REFRESH_INTERVAL секунд.
+        Обращается к криптопровайдеру - вызывать в потоке подписи, не в цикле событий"""
+        if self._refreshed_at is not None and monotonic() - self._refreshed_at <= MISS_REFRESH_INTERVAL:
+            return False
+        self.refresh()
+        self._ensure()
+        return True
+
+    def stop(self):
+        self._stop.set()
+
+    def actual(self) -> list[IndexedCert]:
+        self._ensure()
+        now = datetime.now(tz=pytz.UTC)
+        return [e for e in self._entries if e.valid_to > now]
+
+    def cached_find(self, number_or_subject: str|None = None) -> list[IndexedCert]|None:
+        """find() только по кэшу. None - кэш ещё не загружен или ничего не нашлось, и нужно перечитать хранилище"""
+        if not self.loaded:
+            return None
+        now = datetime.now(tz=pytz.UTC)
+        actual = [e for e in self._entries if e.valid_to > now]
+        if number_or_subject is None:
+            return actual
+        if found := self._lookup(number_or_subject):
+            return [e for e in actual if e in found]
+
+    def find(self, number_or_subject: str|None = None) -> list[IndexedCert]:
+        actual = self.actual()
+        if number_or_subject is None:
+            return actual
+
+        if not (found := self._lookup(number_or_subject)) and \
+                monotonic() - self._refreshed_at > MISS_REFRESH_INTERVAL:
+            # возможно, вставили новый токен
+            self.refresh()
+            actual = self.actual()
+            found = self._lookup(number_or_subject)
+
+        return [e for e in actual if e in found]
+
+    def _lookup(self, number_or_subject: str) -> set[IndexedCert]:
+        found = set()
+        if e := self._by_number.get(number_or_subject):
+            found.add(e)
+        found.update(self._by_token.get(number_or_subject, ()))
+        if not found:
+            # совместимость со старым поиском по подстроке, но уже по закэшированным строкам
+            found.update(e for e in self._entries if number_or_subject in e.subject)
+        return found
@@ -0,0 +1,131 @@
+import itertools
+import threading
+from contextlib import contextmanager
+from time import monotonic
+from uuid import UUID
+
+from config import Config
+from logger import logger
+
+
+ROUND_ROBIN = 'round-robin'
+LEAST_BUSY = 'least-busy'
+
+
+class NoAvailableCertificateException(Exception): ...
+
+
+class PoolCert:
+    def __init__(self, number: str, pincode: str|None = None, boxes: list[str]|None = None):
+        self.number = str(number)
+        self.pincode = str(pincode) if pincode is not None else None
+        self.boxes = set(boxes or [])
+        self.busy = 0
+        self.failures = 0
+        self.disabled_until = 0.0
+
+    @property
+    def disabled(self) -> bool:
+        return self.disabled_until > monotonic()
+
+    def __repr__(self):
+        return f"<PoolCert number={self.number} busy={self.busy} failures={self.failures}>"
+
+
+def parse_entry(item: dict) -> PoolCert|None:
+    """Запись из signing.certs. Ошибку в одной записи пишем в лог и пропускаем запись целиком: сертификат,
+    закреплённый за ящиками, не должен стать общим из-за опечатки в id ящика"""
+    try:
+        boxes = [str(UUID(str(b))) for b in item.get('boxes') or []]
+        return PoolCert(item['number'], item.get('pincode'), boxes)
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        logger.error(f"Certificate pool entry {item!r} is skipped: {e!r}")
+
+
+class CertPool:
+    """Набор сертификатов (в т.ч. на разных токенах), между которыми распределяется подпись.
+    Настраивается в секции `signing` файла cades.yaml"""
+
+    def __init__(self, logic: 'LogicAbstract'):
+        self.logic = logic
+        self.conf = Config()
+        self._lock = threading.Lock()
+        self._rr = itertools.count()
+        self._snapshot = None
+        self._entries: dict[str, PoolCert] = {}
+
+    def _reload(self):
+        # конфиг может быть перечитан в любой момент, счётчики живых сертификатов сохраняем
+        if (certs := self.conf.signing_certs) == self._snapshot:
+            return
+        entries = {}
+        for item in certs:
+            if not (entry := parse_entry(item)):
+                continue
+            if old := self._entries.get(entry.number):
+                entry.busy, entry.failures, entry.disabled_until = old.busy, old.failures, old.disabled_until
+            entries[entry.number] = entry
+        self._entries = entries
+        self._snapshot = certs
+        logger.info(f"Certificate pool: {list(entries)}")
+
+    @property
+    def enabled(self) -> bool:
+        with self._lock:
+            self._reload()
+            return bool(self._entries)
+
+    def _is_usable(self, entry: PoolCert) -> bool:
+        if entry.disabled:
+            return False
+        # только кэш: вызывается под self._lock и из цикла событий
+        return self.logic.cert_index.cached(entry.number) is not None
+
+    def candidates(self, source_box: UUID|str|None = None) -> list[PoolCert]:
+        entries = [e for e in self._entries.values() if self._is_usable(e)]
+        if source_box is not None:
+            if mapped := [e for e in entries if str(source_box) in e.boxes]:
+                return mapped
+        return [e for e in entries if not e.boxes]
+
+    def numbers(self, source_box: UUID|str|None = None) -> list[str]:
+        with self._lock:
+            self._reload()
+            return [e.number for e in self.candidates(source_box)]
+
+    def acquire(self, source_box: UUID|str|None = None) -> PoolCert:
+        with self._lock:
+            self._reload()
+            if not (candidates := self.candidates(source_box)):
+                raise NoAvailableCertificateException(f"No available certificate in pool for box {source_box}")
+
+            if self.conf.signing_balance == LEAST_BUSY:
+                entry = min(candidates, key=lambda e: e.busy)
+            else:
+                entry = candidates[next(self._rr) % len(candidates)]
+            entry.busy += 1
+            return entry
+
+    def release(self, entry: PoolCert, ok: bool = True):
+        with self._lock:
+            entry.busy -= 1
+            if ok:
+                entry.failures = 0
+                return
+            entry.failures += 1
+            if entry.failures >= self.conf.signing_fail_limit:
+                entry.disabled_until = monotonic() + self.conf.signing_cooldown
+                entry.failures = 0
+                logger.warning(f"Certificate {entry.number} is excluded from pool "
+                               f"for {self.conf.signing_cooldown} seconds")
+
+    @contextmanager
+    def lease(self, source_box: UUID|str|None = None):
+        entry = self.acquire(source_box)
+        try:
+            yield entry
+        except Exception:
+            self.release(entry, ok=False)
+            raise
+        else:
+            self.release(entry)
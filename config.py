@@ -8,6 +8,7 @@ import yaml, sys, os
 from watchdog.observers import Observer
 from watchdog.events import FileModifiedEvent, FileSystemEvent, FileSystemEventHandler
 
+from const import WORKERS
 from logger import logger
 from singleton import Singleton
 from tools import get_installation_dir
@@ -44,6 +45,8 @@ default_config_object = {
 class Config(FileSystemEventHandler, metaclass=Singleton):
     CONFIG_FILE = 'cades.yaml'
     _data: dict[str, dict[str, str|int|bool]|list[str]]
+    # растёт при каждой загрузке файла - по нему пересобираются производные структуры (middleware)
+    generation: int = 0
 
     def __init__(self):
 #        self._lock = Lock()
@@ -82,6 +85,7 @@ class Config(FileSystemEventHandler, metaclass=Singleton):
         with open(self.CONFIG_FILE, 'r') as f:
             if data := yaml.load(f, yaml.SafeLoader):
                 self._data = data
+                self.generation += 1
             logger.debug(self._data)
 
     @property
@@ -147,6 +151,62 @@ class Config(FileSystemEventHandler, metaclass=Singleton):
         self._data['diadoc']['password'] = value
         self.save()
 
+    @property
+    def diadoc_connection_limit(self) -> int:
+        return int(self._data.get('diadoc', {}).get('connection-limit', 20))
+
+    @property
+    def diadoc_keepalive(self) -> float:
+        return float(self._data.get('diadoc', {}).get('keepalive', 30))
+
+    @property
+    def diadoc_timeout(self) -> float:
+        return float(self._data.get('diadoc', {}).get('timeout', 60))
+
+    @property
+    def diadoc_cache_ttl(self) -> int:
+        return int(self._data.get('diadoc', {}).get('cache-ttl', 3600))
+
+    @property
+    def diadoc_cache_negative_ttl(self) -> int:
+        return int(self._data.get('diadoc', {}).get('cache-negative-ttl', 60))
+
+    @property
+    def diadoc_cache_size(self) -> int:
+        return int(self._data.get('diadoc', {}).get('cache-size', 10000))
+
+    @property
+    def diadoc_status_concurrency(self) -> int:
+        return int(self._data.get('diadoc', {}).get('status-concurrency', 4))
+
+    @property
+    def events_poll_interval(self) -> int:
+        return int(self._data.get('diadoc', {}).get('events-poll-interval', 30))
+
+    @property
+    def events_max_age(self) -> int:
+        return int(self._data.get('diadoc', {}).get('events-max-age', 300))
+
+    @property
+    def counteragents_sync_interval(self) -> int:
+        return int(self._data.get('diadoc', {}).get('counteragents-sync-interval', 600))
+
+    @property
+    def counteragents_max_age(self) -> int:
+        return int(self._data.get('diadoc', {}).get('counteragents-max-age', 3600))
+
+    @property
+    def diadoc_token_file(self) -> str:
+        return self._data.get('diadoc', {}).get('token-file') or join(get_installation_dir(), 'diadoc.token')
+
+    @property
+    def diadoc_token_lifetime(self) -> int:
+        return int(self._data.get('diadoc', {}).get('token-lifetime', 3600))
+
+    @property
+    def diadoc_token_refresh_margin(self) -> int:
+        return int(self._data.get('diadoc', {}).get('token-refresh-margin', 300))
+
     @property
     def capicom_store(self) -> int:
         return self._data.get('settings', {}).get('certificate-store', 1)
@@ -155,9 +215,34 @@ class Config(FileSystemEventHandler, metaclass=Singleton):
     def test_sign(self) -> bool:
         return self._data.get('settings', {}).get('test-sign', False)
 
+    @property
+    def callback_targets(self) -> list[dict]:
+        """Элемент списка callbacks - URL или словарь с url и настройками пакетной отправки"""
+        targets = []
+        for item in self._data.get('callbacks', []) or []:
+            if isinstance(item, str):
+                item = {'url': item}
+            targets.append({'url': item['url'],
+                            'batch': bool(item.get('batch', False)),
+                            'window': float(item.get('window', 5)),
+                            'max-count': int(item.get('max-count', 100) or 1)})
+        return targets
+
     @property
     def callback_urls(self) -> list[str]:
-        return self._data.get('callbacks', []) or []
+        return [t['url'] for t in self.callback_targets]
+
+    @property
+    def callback_concurrency(self) -> int:
+        return int(self.settings.get('callback-concurrency', 4) or 1)
+
+    @property
+    def callback_timeout(self) -> float:
+        return float(self.settings.get('callback-timeout', 10))
+
+    @property
+    def callback_batch_size(self) -> int:
+        return int(self.settings.get('callback-batch-size', 100) or 1)
 
     @property
     def dbscheme(self) -> str:
@@ -168,10 +253,137 @@ class Config(FileSystemEventHandler, metaclass=Singleton):
     def dbcnxstr(self) -> str:
         return self._data.get('db-connection-string', f"sqlite+aiosqlite:///{join(get_installation_dir(), 'cades.db')}")
 
+    @property
+    def db_pool(self) -> dict:
+        pool = self._data.get('db-pool') or {}
+        return {'size': int(pool.get('size', 5)),
+                'overflow': int(pool.get('overflow', 10)),
+                'timeout': float(pool.get('timeout', 30)),
+                'pre-ping': bool(pool.get('pre-ping', True)),
+                'recycle': int(pool.get('recycle', 1800)),
+                'statement-cache': int(pool.get('statement-cache', 100)),
+                'echo': bool(pool.get('echo', False))}
+
+    @property
+    def sqlite_options(self) -> dict:
+        opts = self._data.get('sqlite') or {}
+        synchronous = str(opts.get('synchronous', 'NORMAL')).upper()
+        return {'wal': bool(opts.get('wal', True)),
+                'synchronous': synchronous if synchronous in ('OFF', 'NORMAL', 'FULL', 'EXTRA') else 'NORMAL',
+                'busy-timeout': int(opts.get('busy-timeout', 5000)),
+                'cache-size': int(opts.get('cache-size', 20000)),
+                'group-commit-size': max(1, int(opts.get('group-commit-size', 100))),
+                'group-commit-window': float(opts.get('group-commit-window', 0))}
+
     @property
     def certnumber(self) -> str:
         return self.settings.get("certnumber", None)
 
+    @property
+    def sign_workers(self) -> int:
+        return int(self.settings.get('sign-workers', 2) or 1)
+
+    @property
+    def sign_queue_size(self) -> int:
+        return int(self.settings.get('sign-queue-size', 100) or 0)
+
+    @property
+    def batch_limit(self) -> int:
+        return int(self.settings.get('batch-limit', 1000))
+
+    @property
+    def upload_spool_size(self) -> int:
+        return int(self.settings.get('upload-spool-size', 1024 * 1024))
+
+    @property
+    def upload_max_size(self) -> int|None:
+        return self.settings.get('upload-max-size')
+
+    @property
+    def hash_sign(self) -> bool:
+        return bool(self.settings.get('hash-sign', False))
+
+    @property
+    def sign_reuse_window(self) -> int:
+        return int(self.settings.get('sign-reuse-window', 86400))
+
+    @property
+    def sender_concurrency(self) -> int:
+        return int(self.settings.get('sender-concurrency', 4) or 1)
+
+    def retry_policy(self, error_class: str|None = None) -> dict[str, int]:
+        retry = self._data.get('retry') or {}
+        policy = {
+            'base-delay': int(retry.get('base-delay', 60)),
+            'max-delay': int(retry.get('max-delay', 3600)),
+            'max-tries': int(retry.get('max-tries', 6)),
+        }
+        if error_class:
+            policy.update({k: int(v) for k, v in ((retry.get('classes') or {}).get(error_class) or {}).items()})
+        return policy
+
+    @property
+    def sender_batch_size(self) -> int:
+        return int(self.settings.get('sender-batch-size', 100) or 1)
+
+    @property
+    def sender_lease(self) -> int:
+        return int(self.settings.get('sender-lease', 300))
+
+    @property
+    def sender_poll_interval(self) -> int:
+        return int(self.settings.get('sender-poll-interval', 60))
+
+    @property
+    def cert_refresh_interval(self) -> int:
+        return int(self.settings.get('cert-refresh-interval', 300))
+
+    @property
+    def sign_daemon(self) -> str|None:
+        """Адрес демона подписи: путь к unix-сокету или host:port. true - адрес по умолчанию"""
+        if not (address := self.settings.get('sign-daemon')):
+            return None
+        if address is True:
+            return '127.0.0.1:8765' if sys.platform == 'win32' else join(get_installation_dir(), 'signd.sock')
+        return str(address)
+
+    @property
+    def sign_daemon_key(self) -> str:
+        """Файл с ключом, которым клиенты демона подписи подтверждают, что они - процессы сервиса"""
+        return self.settings.get('sign-daemon-key') or join(get_installation_dir(), 'signd.key')
+
+    @property
+    def workers(self) -> int:
+        """Воркеры uvicorn. Больше одного - только с демоном подписи и PostgreSQL: SQLite пишет один процесс
+        (dbwriter), а фоновый процесс воркеры будят через LISTEN/NOTIFY"""
+        if not self.sign_daemon:
+            return 1
+        workers = int(self.settings.get('workers', WORKERS) or 1)
+        if workers > 1 and 'sqlite' in self.dbscheme:
+            logger.warning(f"workers: {workers} is ignored, with SQLite the server runs in one process")
+            return 1
+        return workers
+
+    @property
+    def signing(self) -> dict:
+        return self._data.get('signing') or {}
+
+    @property
+    def signing_certs(self) -> list[dict]:
+        return self.signing.get('certs') or []
+
+    @property
+    def signing_balance(self) -> str:
+        return self.signing.get('balance', 'round-robin')
+
+    @property
+    def signing_fail_limit(self) -> int:
+        return int(self.signing.get('fail-limit', 3))
+
+    @property
+    def signing_cooldown(self) -> int:
+        return int(self.signing.get('cooldown', 300))
+
 if __name__ == '__main__':
     try:
         while True:
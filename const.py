@@ -16,6 +16,7 @@ class ServiceStatus(str, Enum):
     NO_KEYS = 'no_keys'
     OK = 'OK'
     ALREADY = 'already'
+    ERROR = 'error'
 
 
 class DiadocServiceStatus(StrEnum):
@@ -36,17 +37,27 @@ class DocumentStatus(StrEnum):
     FAIL = 'fail'
     # NOT_FOUND = 'not-found'
     RECEIVED = 'received'
+    DEAD = 'dead'
     UNKNOWN = 'unkwnown'
 
     @classmethod
     def bad(cls, status: "DocumentStatus") -> bool:
-        return status in (cls.FAIL, cls.UNKNOWN)
+        return status in (cls.FAIL, cls.DEAD, cls.UNKNOWN)
+
+    @classmethod
+    def restartable(cls, status: "DocumentStatus") -> bool:
+        return status in (cls.FAIL, cls.DEAD)
 
     @classmethod
     def good(cls, status: "DocumentStatus") -> bool:
         return status in (cls.SENT, cls.PROGRESS, cls.RECEIVED)
 
 
+class CallbackStatus(StrEnum):
+    PENDING = 'pending'
+    DEAD = 'dead'
+
+
 class DocumentStatusRus(StrEnum):
     PROGRESS = 'В обработке'
     SENT = "Отправлено"
@@ -54,4 +65,5 @@ class DocumentStatusRus(StrEnum):
     FAIL = "Неудача"
     NOT_FOUND = "Не найден"
     RECEIVED = "Получен"
+    DEAD = "Попытки отправки исчерпаны"
     UNKNOWN = "Неизвестно"
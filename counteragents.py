@@ -0,0 +1,139 @@
+import asyncio
+from datetime import datetime
+from uuid import UUID
+
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import Config
+from db import BoxCursor, CounteragentRecord, Session, cursor_is_fresh, get_cursor
+from dbwriter import write
+from diadoc.aconnector import AsyncDiadocAPI, authd_diadoc_api
+from diadoc.struct import Counteragent
+from logger import logger
+
+
+CURSOR_NAME = 'counteragents'
+
+
+async def save_page(box: UUID, page: list[Counteragent]) -> None:
+    now = datetime.now()
+    rows = [CounteragentRecord(my_box=box,
+                               box_id=UUID(b.BoxIdGuid),
+                               org_id=c.Organization.OrgId,
+                               inn=c.Organization.Inn,
+                               kpp=c.Organization.Kpp,
+                               status=c.CurrentStatus,
+                               index_key=c.IndexKey,
+                               data=c.model_dump_json(),
+                               synced_at=now)
+            for c in page for b in c.Organization.Boxes or []]
+
+    async def save(ss: AsyncSession):
+        # у контрагента мог смениться набор ящиков - заменяем записи организации целиком
+        await ss.execute(delete(CounteragentRecord)
+                         .where(CounteragentRecord.my_box == box,
+                                CounteragentRecord.org_id.in_({c.Organization.OrgId for c in page})))
+        ss.add_all(rows)
+        cur = await get_cursor(ss, box, CURSOR_NAME)
+        cur.cursor = page[-1].IndexKey
+
+    await write(save)
+
+
+async def sync_box(dd: AsyncDiadocAPI, box: UUID) -> int:
+    """Дочитать список контрагентов с места последней остановки. Контрагенты с изменившимся
+    статусом переезжают в конец списка ДИАДОК, так что повторная выборка с курсора их тоже вернёт"""
+    async with Session() as ss:
+        cursor = (cur := await ss.get(BoxCursor, (box, CURSOR_NAME))) and cur.cursor
+
+    count = 0
+    async for page in dd.iter_ctgs(box, cursor):
+        # курсор сохраняется после каждой страницы: прерванная синхронизация продолжится с неё же
+        await save_page(box, page)
+        count += len(page)
+
+    async def synced(ss: AsyncSession):
+        (await get_cursor(ss, box, CURSOR_NAME)).synced_at = datetime.now()
+
+    await write(synced)
+    return count
+
+
+async def my_boxes(dd: AsyncDiadocAPI) -> list[UUID]:
+    return [UUID(b.BoxIdGuid) for org in await dd.get_my_orgs(autoreg=False) for b in org.Boxes or []]
+
+
+async def sync_counteragents() -> None:
+    dd = await authd_diadoc_api()
+    for box in await my_boxes(dd):
+        try:
+            if count := await sync_box(dd, box):
+                logger.info(f"{count} counteragents of box {box} are synchronized")
+        except Exception as e:
+            logger.error(f"Can't synchronize counteragents of box {box}: {str(e)}")
+
+
+async def sync_counteragents_loop() -> None:
+    conf = Config()
+    while conf.counteragents_sync_interval > 0:
+        try:
+            await sync_counteragents()
+        except Exception as e:
+            logger.error(f"Counteragents synchronization failed: {str(e)}")
+        await asyncio.sleep(conf.counteragents_sync_interval)
+
+
+async def init_counteragents_sync() -> None:
+    asyncio.create_task(sync_counteragents_loop())
+
+
+async def is_fresh(ss: AsyncSession, box: UUID|str) -> bool:
+    """Локальной копии можно верить, если её дочитывали до конца не раньше counteragents-max-age назад"""
+    return await cursor_is_fresh(ss, box, CURSOR_NAME, Config().counteragents_max_age)
+
+
+async def local_ctgs(box: UUID|str) -> list[Counteragent]|None:
+    """Контрагенты ящика из локальной копии. None - копия устарела, нужно спросить ДИАДОК"""
+    async with Session() as ss:
+        if not await is_fresh(ss, box):
+            return None
+        rows = (await ss.execute(select(CounteragentRecord.org_id, CounteragentRecord.data)
+                                 .where(CounteragentRecord.my_box == UUID(str(box)))
+                                 .order_by(CounteragentRecord.index_key))).all()
+    return [Counteragent.model_validate_json(data) for data in dict(rows).values()]
+
+
+async def local_ctg(box: UUID|str, ctg_box: UUID|str) -> Counteragent|None:
+    async with Session() as ss:
+        if not await is_fresh(ss, box):
+            return None
+        row = await ss.get(CounteragentRecord, (UUID(str(box)), UUID(str(ctg_box))))
+    return Counteragent.model_validate_json(row.data) if row else None
+
+
+async def local_box_by_innkpp(box: UUID|str, inn: str, kpp: str|None = None) -> UUID|None:
+    async with Session() as ss:
+        if not await is_fresh(ss, box):
+            return None
+        query = select(CounteragentRecord.box_id).where(CounteragentRecord.my_box == UUID(str(box)),
+                                                        CounteragentRecord.inn == inn)
+        if kpp:
+            query = query.where(CounteragentRecord.kpp == kpp)
+        return (await ss.execute(query.limit(1))).scalar()
+
+
+async def find_ctg(dd: AsyncDiadocAPI, box: UUID|str, ctg_box: UUID|str) -> Counteragent|str:
+    """Контрагент из локальной копии, а если его там нет - из ДИАДОК"""
+    if ctg := await local_ctg(box, ctg_box):
+        return ctg
+    return await dd.get_ctg(box, ctg_box)
+
+
+async def list_ctgs(dd: AsyncDiadocAPI, box: UUID|str) -> list[Counteragent]|str:
+    if (ctgs := await local_ctgs(box)) is not None:
+        return ctgs
+    ctgs = []
+    async for page in dd.iter_ctgs(box):
+        ctgs.extend(page)
+    return ctgs
@@ -0,0 +1,81 @@
+import threading
+from time import perf_counter
+
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from config import Config
+
+
+class PoolStats:
+    """Счётчики пула соединений с БД. Доступны по GET /cades/db-pool"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.connects = 0
+        self.total_checkout_time = 0.0
+        self.max_checkout_time = 0.0
+
+    def observe(self, elapsed: float, waited: bool, failed: bool):
+        with self._lock:
+            self.checkouts += 1
+            self.waits += waited
+            self.timeouts += failed
+            self.total_checkout_time += elapsed
+            self.max_checkout_time = max(self.max_checkout_time, elapsed)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {'checkouts': self.checkouts,
+                    'waits': self.waits,
+                    'timeouts': self.timeouts,
+                    'connects': self.connects,
+                    'avg_checkout_ms': round(1000 * self.total_checkout_time / self.checkouts, 3) if self.checkouts else 0.0,
+                    'max_checkout_ms': round(1000 * self.max_checkout_time, 3)}
+
+
+class MeteredPool(AsyncAdaptedQueuePool):
+    """Пул, который считает время выдачи соединения и сколько раз пришлось ждать свободного"""
+    stats = PoolStats()
+
+    def _do_get(self):
+        # свободных нет и новых открыть нельзя - запрос встанет в очередь
+        waited = self.checkedin() == 0 and self._max_overflow >= 0 and self.overflow() >= self._max_overflow
+        started = perf_counter()
+        try:
+            conn = super()._do_get()
+        except Exception:
+            self.stats.observe(perf_counter() - started, waited, True)
+            raise
+        self.stats.observe(perf_counter() - started, waited, False)
+        return conn
+
+    def _create_connection(self):
+        with self.stats._lock:
+            self.stats.connects += 1
+        return super()._create_connection()
+
+    def usage(self) -> dict:
+        return {'size': self.size(),
+                'checked_out': self.checkedout(),
+                'idle': self.checkedin(),
+                'overflow': max(self.overflow(), 0),
+                'max_overflow': self._max_overflow,
+                **self.stats.snapshot()}
+
+
+def engine_options(postgres: bool) -> dict:
+    pool = Config().db_pool
+    options = {'poolclass': MeteredPool,
+               'echo': pool['echo'],
+               'pool_size': pool['size'],
+               'max_overflow': pool['overflow'],
+               'pool_timeout': pool['timeout'],
+               'pool_pre_ping': pool['pre-ping'],
+               'pool_recycle': pool['recycle']}
+    if postgres:
+        # 0 - для pgbouncer в режиме transaction
+        options['connect_args'] = {'prepared_statement_cache_size': pool['statement-cache']}
+    return options
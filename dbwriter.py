@@ -0,0 +1,84 @@
+import asyncio
+from typing import Any, Awaitable, Callable
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import Config
+from db import IMMEDIATE, Session, engine, is_sqlite
+from logger import logger
+from singleton import Singleton
+
+
+WriteFn = Callable[[AsyncSession], Awaitable[Any]]
+
+
+class DbWriter(metaclass=Singleton):
+    """Единственный писатель SQLite в процессе. Изменения из разных корутин выполняются по очереди
+    в одной транзакции, каждое в своём SAVEPOINT, и фиксируются одним commit (group commit).
+    Читатели тем временем работают на своих соединениях из пула - в WAL они писателю не мешают"""
+
+    def __init__(self):
+        self._engine = engine.execution_options(**{IMMEDIATE: True})
+        self._queue: asyncio.Queue|None = None
+        self._loop = None
+        self._task = None
+
+    def queue(self) -> asyncio.Queue:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._queue, self._loop = asyncio.Queue(), loop
+            self._task = loop.create_task(self._run())
+        return self._queue
+
+    async def submit(self, fn: WriteFn) -> Any:
+        fut = asyncio.get_running_loop().create_future()
+        self.queue().put_nowait((fn, fut))
+        return await fut
+
+    async def _collect(self) -> list[tuple[WriteFn, asyncio.Future]]:
+        opts = Config().sqlite_options
+        batch = [await self._queue.get()]
+        # даём набежать изменениям от соседних корутин
+        await asyncio.sleep(opts['group-commit-window'] / 1000)
+        while len(batch) < opts['group-commit-size'] and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _commit(self, batch: list[tuple[WriteFn, asyncio.Future]]):
+        done = []
+        async with Session(bind=self._engine) as ss:
+            for fn, fut in batch:
+                if fut.done():  # вызывающий отменён
+                    continue
+                try:
+                    async with ss.begin_nested():
+                        done.append((fut, await fn(ss)))
+                except Exception as e:
+                    fut.set_exception(e)
+            await ss.commit()
+        for fut, result in done:
+            if not fut.done():
+                fut.set_result(result)
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            try:
+                await self._commit(batch)
+            except Exception as e:
+                logger.error(f"Group commit of {len(batch)} changes failed: {str(e)}")
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+
+
+async def write(fn: WriteFn) -> Any:
+    """Выполнить fn(ss) в пишущей транзакции и закоммитить. Возвращает результат fn.
+    fn не коммитит сам, не вызывает write() и не возвращает ORM-объекты, привязанные к ss:
+    на SQLite после commit они будут expired. На остальных СУБД - обычная отдельная транзакция"""
+    if not is_sqlite:
+        async with Session() as ss:
+            result = await fn(ss)
+            await ss.commit()
+        return result
+    return await DbWriter().submit(fn)
@@ -0,0 +1,422 @@
+import asyncio
+import json
+import os
+from hashlib import md5
+from time import time
+from typing import AsyncIterator
+from urllib.parse import urljoin
+from uuid import UUID
+
+import aiohttp
+
+from diadoc.cache import LookupCache
+from diadoc.exceptions import AuthError, DiadocError
+from diadoc.struct import (BoxEvent, BoxEventList, Counteragent, CounteragentList, DocflowStatusModel, DocumentId,
+                           DocumentV3, GetDocflowBatchRequest, GetDocflowBatchResponseV3, GetDocflowRequest,
+                           Message, MessageToPost, Organization, OrganizationList)
+from logger import logger
+from singleton import Singleton
+
+
+SUCCESS_CODES = [200, 201]
+
+AUTH = 'Authorization'
+AUTH_PREFIX = "DiadocAuth"
+APP_JSON = 'application/json'
+
+AUTHENTICATE_URL = "/V3/Authenticate"
+
+client_id_param_name = "ddauth_api_client_id"
+ddauth_token_param_name = "ddauth_token"
+
+
+# GetCounteragents отдаёт не больше 100 записей за раз
+CTGS_PAGE_SIZE = 100
+# столько документов можно запросить одним GetDocflows
+DOCFLOWS_BATCH_SIZE = 100
+
+
+class AuthContainer(metaclass=Singleton):
+    def __init__(self):
+        from config import Config
+
+        self.conf = Config()
+        self._login = self.conf.diadoc_login
+        self._password = self.conf.diadoc_password
+        self._api_client_id = self.conf.client_id
+
+    @property
+    def login(self) -> str:
+        return self._login
+
+    @login.setter
+    def login(self, value: str):
+        self._login = value
+
+    @property
+    def password(self) -> str:
+        return self._password
+
+    @password.setter
+    def password(self, value: str):
+        self._password = value
+
+    @property
+    def api_token(self) -> str:
+        return getattr(self, '_api_token', None)
+
+    @api_token.setter
+    def api_token(self, value: str):
+        self._api_token = value
+        self._issued_at = time()
+
+    @api_token.deleter
+    def api_token(self):
+        if hasattr(self, '_api_token'):
+            # отвергнутый сервером токен не подхватываем обратно из файла
+            self._rejected_token = self._api_token
+            del self._api_token
+
+    @property
+    def token_key(self) -> str:
+        return md5(f"{self.login}:{self.api_client_id}".encode()).hexdigest()
+
+    def token_file_mtime(self) -> int|None:
+        try:
+            return os.stat(self.conf.diadoc_token_file).st_mtime_ns
+        except OSError:
+            return None
+
+    def load_token(self) -> bool:
+        """Токен, полученный этим или другим процессом, хранится в файле вместе со временем выдачи"""
+        self._token_mtime = self.token_file_mtime()
+        try:
+            with open(self.conf.diadoc_token_file) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if data.get('key') != self.token_key or data.get('token') == getattr(self, '_rejected_token', None):
+            return False
+        if time() - data.get('issued_at', 0) > self.conf.diadoc_token_lifetime:
+            return False
+        self._api_token = data['token']
+        self._issued_at = data['issued_at']
+        return True
+
+    def save_token(self):
+        tmp = f"{self.conf.diadoc_token_file}.{os.getpid()}.tmp"
+        try:
+            # токен - секрет, файл доступен только владельцу
+            with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                json.dump({'key': self.token_key, 'token': self._api_token, 'issued_at': self._issued_at}, f)
+            os.replace(tmp, self.conf.diadoc_token_file)
+            self._token_mtime = self.token_file_mtime()
+        except OSError as e:
+            logger.warning(f"Can't save diadoc token: {e}")
+
+    @property
+    def expiring(self) -> bool:
+        """Пора обновить токен заранее, не дожидаясь 401"""
+        return bool(getattr(self, '_api_token', None)) and \
+            time() - self._issued_at > self.conf.diadoc_token_lifetime - self.conf.diadoc_token_refresh_margin
+
+    async def aload_token(self) -> bool:
+        """Перечитать файл токена в потоке, если он изменился с прошлого чтения или записи"""
+        if self.token_file_mtime() == getattr(self, '_token_mtime', None):
+            return False
+        return await asyncio.to_thread(self.load_token)
+
+    async def has_fresh_token(self, stale: str|None) -> bool:
+        """Пока ждали блокировку, токен мог обновить другой запрос или другой процесс"""
+        await self.aload_token()
+        token = getattr(self, '_api_token', None)
+        return bool(token) and token != stale and not self.expiring
+
+    @property
+    def alock(self) -> asyncio.Lock:
+        if not hasattr(self, '_alock'):
+            self._alock = asyncio.Lock()
+        return self._alock
+
+    @property
+    def api_client_id(self) -> str:
+        return getattr(self, '_api_client_id', None)
+
+    @api_client_id.setter
+    def api_client_id(self, value: str):
+        self._api_client_id = value
+
+    @property
+    def header(self) -> str:
+        ddauth_token_header = ""
+        if self.api_token:
+            ddauth_token_header = f",{ddauth_token_param_name}={self.api_token}"
+        return f"{AUTH_PREFIX} {client_id_param_name}={self.api_client_id}{ddauth_token_header}"
+
+    @property
+    def is_authenticated(self) -> bool:
+        return bool(self.api_token)
+
+
+class ApiResponse:
+    """Неуспешный ответ ДИАДОК. Повторяет нужную часть requests.Response"""
+
+    def __init__(self, status_code: int, content: bytes):
+        self.status_code = status_code
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+    def __repr__(self):
+        return f"<ApiResponse [{self.status_code}]>"
+
+
+class DiadocHttp(metaclass=Singleton):
+    """Общий на процесс пул keep-alive соединений к ДИАДОК"""
+
+    def __init__(self):
+        self._session: aiohttp.ClientSession|None = None
+        self._loop = None
+
+    def session(self) -> aiohttp.ClientSession:
+        from config import Config
+
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            conf = Config()
+            connector = aiohttp.TCPConnector(limit=conf.diadoc_connection_limit,
+                                             limit_per_host=conf.diadoc_connection_limit,
+                                             keepalive_timeout=conf.diadoc_keepalive)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=conf.diadoc_timeout),
+                                                  headers={'Content-Type': APP_JSON, 'Accept': APP_JSON})
+            self._loop = loop
+        return self._session
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+class AsyncDiadocAPI:
+    """Асинхронный клиент ДИАДОК"""
+
+    def __init__(self, url: str|None = None, api_client_id: str|None = None):
+        from config import Config
+
+        self.cnf = Config()
+        self.url = url or self.cnf.diadoc_url
+        self.http = DiadocHttp()
+        self.cache = LookupCache()
+        self.auth_c = AuthContainer()
+        self.auth_c.api_client_id = api_client_id or self.cnf.client_id
+
+    async def request(self, method: str, url: str, **kwargs) -> ApiResponse:
+        joined_url = urljoin(self.url, url)
+        if 'params' in kwargs:
+            kwargs['params'] = {k: str(v) for k, v in kwargs['params'].items()}
+
+        async def send() -> ApiResponse:
+            async with self.http.session().request(method, joined_url,
+                                                   headers={AUTH: self.auth_c.header},
+                                                   **kwargs) as res:
+                return ApiResponse(res.status, await res.read())
+
+        if not self.auth_c.is_authenticated or self.auth_c.expiring:
+            await self.refresh_token(self.auth_c.api_token)
+
+        token = self.auth_c.api_token
+        resp = await send()
+        if resp.status_code == 401:
+            await self.refresh_token(token)
+            resp = await send()
+        return resp
+
+    async def refresh_token(self, stale: str|None = None) -> bool:
+        """Одновременные 401 и истечение токена приводят к одному логину на процесс"""
+        async with self.auth_c.alock:
+            if await self.auth_c.has_fresh_token(stale):
+                return True
+            if stale:
+                del self.auth_c.api_token
+            return await self.reauthenticate()
+
+    async def get(self, url: str, **kwargs) -> ApiResponse:
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> ApiResponse:
+        return await self.request('POST', url, **kwargs)
+
+    async def authenticate(self, login: str|None = None, password: str|None = None) -> bool:
+        if not (login or password):
+            if self.auth_c.is_authenticated and not self.auth_c.expiring:
+                return True
+            return await self.refresh_token(self.auth_c.api_token)
+        return await self.login(login, password)
+
+    async def login(self, login: str|None, password: str|None) -> bool:
+        self.auth_c.login = login
+        self.auth_c.password = password
+        async with self.http.session().post(urljoin(self.url, AUTHENTICATE_URL),
+                                            headers={AUTH: self.auth_c.header},
+                                            json={"login"   : self.auth_c.login,
+                                                  "password": self.auth_c.password},
+                                            params={"type": "password"}) as res:
+            content = await res.read()
+            if res.status in SUCCESS_CODES:
+                self.auth_c.api_token = content.decode()
+                await asyncio.to_thread(self.auth_c.save_token)
+                return True
+        raise AuthError(content)
+
+    async def reauthenticate(self) -> bool:
+        return await self.login(self.auth_c.login or self.cnf.diadoc_login,
+                                self.auth_c.password or self.cnf.diadoc_password)
+
+    async def get_my_orgs(self, autoreg: bool = True) -> list[Organization]:
+        res = await self.get('/GetMyOrganizations',
+                             params={'autoRegister': 'true' if autoreg else 'false'})
+        if res.status_code in SUCCESS_CODES:
+            return OrganizationList.parse_raw(res.content).Organizations
+        return []
+
+    async def get_ctgs(self, box: UUID,
+                       ctg_status: str|None = None,
+                       aindex_key: str|None = None,
+                       query: str|None = None) -> list[Counteragent]|str:
+        params = {'myBoxId': str(box)}
+        if ctg_status:
+            params['counteragentStatus'] = ctg_status
+        if aindex_key:
+            params['afterIndexKey'] = aindex_key
+        if query:
+            params['query'] = query
+
+        res = await self.get('/V3/GetCounteragents', params=params)
+        if res.status_code in SUCCESS_CODES:
+            return CounteragentList.parse_raw(res.content).Counteragents
+        return res.content.decode()
+
+    async def iter_ctgs(self, box: UUID, aindex_key: str|None = None) -> AsyncIterator[list[Counteragent]]:
+        """Все контрагенты ящика постранично, начиная после aindex_key"""
+        while True:
+            if isinstance(page := await self.get_ctgs(box, aindex_key=aindex_key), str):
+                logger.warning(f"GetCounteragents for box {box} failed: {page}")
+                raise DiadocError()
+            if not page:
+                return
+            yield page
+            if len(page) < CTGS_PAGE_SIZE or not (aindex_key := page[-1].IndexKey):
+                return
+
+    async def get_new_events(self, boxId: UUID,
+                             aindex_key: str|None = None,
+                             timestamp_from: int|None = None) -> list[BoxEvent]|str:
+        params = {'boxId': str(boxId)}
+        if aindex_key:
+            params['afterIndexKey'] = aindex_key
+        elif timestamp_from:
+            params['timestampFromTicks'] = timestamp_from
+
+        res = await self.get('/V7/GetNewEvents', params=params)
+        if res.status_code in SUCCESS_CODES:
+            return BoxEventList.model_validate_json(res.content).Events
+        return res.content.decode()
+
+    async def post_message(self,
+                           msg: MessageToPost,
+                           boxId: UUID|None = None,
+                           operationId: str|None = None) -> Message|ApiResponse:
+        params = {}
+        if boxId:
+            params['boxId'] = str(boxId)
+        if operationId:
+            params['operationId'] = operationId
+
+        res = await self.post("/V3/PostMessage", params=params, data=msg.model_dump_json())
+        if res.status_code in SUCCESS_CODES:
+            return Message.parse_raw(res.content)
+        return res
+
+    async def get_orgs_by_innkpp(self, inn: str|None = None, kpp: str|None = None) -> list[Organization]:
+        params = {
+            **{'inn': inn for _ in [inn] if inn},
+            **{'kpp': kpp for _ in [kpp] if kpp},
+        }
+
+        async def load() -> tuple[list[Organization], bool|None]:
+            res = await self.get("/GetOrganizationsByInnKpp", params=params)
+            if res.status_code in SUCCESS_CODES:
+                orgs = OrganizationList.parse_raw(res.content).Organizations
+                return orgs, bool(orgs)
+            return [], None
+
+        return await self.cache.get(('orgs', inn or None, kpp or None), load)
+
+    async def get_ctg(self, myBoxId: UUID, counteragentBoxId: UUID|str) -> Counteragent|str:
+        async def load() -> tuple[Counteragent|str, bool|None]:
+            res = await self.get("/V3/GetCounteragent",
+                                 params={
+                                     'myBoxId'          : str(myBoxId),
+                                     'counteragentBoxId': str(counteragentBoxId)
+                                 })
+            if res.status_code in SUCCESS_CODES:
+                return Counteragent.parse_raw(res.content), True
+            return res.content.decode(), False if res.status_code == 404 else None
+
+        return await self.cache.get(('ctg', str(myBoxId), str(counteragentBoxId)), load)
+
+    async def get_message(self, boxId: UUID, messageId: UUID, entityId: UUID|None = None) -> dict|str:
+        res = await self.get("/V5/GetMessage",
+                             params={
+                                 "boxId"    : str(boxId),
+                                 "messageId": str(messageId),
+                                 **{"entityId": str(entityId)
+                                    for _ in [0]
+                                    if entityId}})
+        if res.status_code in SUCCESS_CODES:
+            return res.json()
+        return res.content.decode()
+
+    async def get_docflows(self, boxId: UUID, messageId: UUID, documentId: UUID) -> list|str:
+        data = GetDocflowBatchRequest(GetDocflowsRequests=[
+            GetDocflowRequest(DocumentId=DocumentId(MessageId=messageId, EntityId=documentId))
+        ]).model_dump_json()
+        res = await self.post("/V3/GetDocflows", params={"boxId": str(boxId)}, data=data)
+        if res.status_code in SUCCESS_CODES:
+            return res.json()['Documents']
+        return res.content.decode()
+
+    async def get_docflow_statuses(self, boxId: UUID,
+                                   ids: list[tuple[UUID, UUID]]) -> dict[tuple[UUID, UUID], DocflowStatusModel]|str:
+        """Статусы нескольких документов ящика одним запросом. ids - пары (messageId, entityId)"""
+        data = GetDocflowBatchRequest(GetDocflowsRequests=[
+            GetDocflowRequest(DocumentId=DocumentId(MessageId=messageId, EntityId=documentId))
+            for messageId, documentId in ids
+        ]).model_dump_json()
+        res = await self.post("/V3/GetDocflows", params={"boxId": str(boxId)}, data=data)
+        if res.status_code in SUCCESS_CODES:
+            return {(d.DocumentId.MessageId, d.DocumentId.EntityId): d.Docflow.DocflowStatus.PrimaryStatus
+                    for d in GetDocflowBatchResponseV3.model_validate_json(res.content).Documents}
+        return res.content.decode()
+
+    async def get_document(self, boxId: UUID, messageId: UUID, documentId: UUID) -> DocumentV3|str:
+        res = await self.get("/V3/GetDocument", params={"boxId"    : str(boxId),
+                                                        "messageId": str(messageId),
+                                                        "entityId" : str(documentId)})
+        if res.status_code in SUCCESS_CODES:
+            return DocumentV3.parse_raw(res.content)
+        return res.content.decode()
+
+    async def get_document_status(self, boxId: UUID, messageId: UUID, documentId: UUID) -> DocflowStatusModel|None:
+        if isinstance(doc := await self.get_document(boxId, messageId, documentId), DocumentV3):
+            return doc.DocflowStatus.PrimaryStatus
+
+
+async def authd_diadoc_api() -> AsyncDiadocAPI:
+    """Аналог AuthdDiadocAPI()"""
+    dd = AsyncDiadocAPI()
+    await dd.authenticate()
+    return dd
@@ -0,0 +1,67 @@
+import asyncio
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Awaitable, Callable, Hashable
+
+from singleton import Singleton
+
+
+class LookupCache(metaclass=Singleton):
+    """Кэш справочных запросов к ДИАДОК (организации по ИНН/КПП, контрагенты).
+    Ограничен по размеру (LRU) и по времени жизни записей, отрицательные ответы живут меньше.
+    Одновременные запросы одного ключа ждут один общий запрос к ДИАДОК"""
+
+    def __init__(self):
+        from config import Config
+
+        self.conf = Config()
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._inflight: dict[Hashable, asyncio.Task] = {}
+
+    def _cached(self, key: Hashable) -> tuple[bool, Any]:
+        if (item := self._data.get(key)) is None:
+            return False, None
+        expires, value = item
+        if expires <= monotonic():
+            del self._data[key]
+            return False, None
+        self._data.move_to_end(key)
+        return True, value
+
+    def _store(self, key: Hashable, value: Any, found: bool):
+        ttl = self.conf.diadoc_cache_ttl if found else self.conf.diadoc_cache_negative_ttl
+        if ttl <= 0:
+            return
+        self._data[key] = (monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.conf.diadoc_cache_size:
+            self._data.popitem(last=False)
+
+    async def get(self, key: Hashable, loader: Callable[[], Awaitable[tuple[Any, bool|None]]]) -> Any:
+        """loader возвращает (значение, найдено ли). found=None - ошибка, такой ответ не кэшируется"""
+        hit, value = self._cached(key)
+        if hit:
+            return value
+
+        loop = asyncio.get_running_loop()
+        if (task := self._inflight.get(key)) is None or task.get_loop() is not loop:
+            # запрос идёт отдельной задачей: отмена первого вызвавшего не отменяет его для остальных
+            task = self._inflight[key] = loop.create_task(self._load(key, loader))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())  # ожидающих может не остаться
+        return await asyncio.shield(task)
+
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable[tuple[Any, bool|None]]]) -> Any:
+        try:
+            value, found = await loader()
+            if found is not None:
+                self._store(key, value, found)
+            return value
+        finally:
+            if self._inflight.get(key) is asyncio.current_task():
+                del self._inflight[key]
+
+    def invalidate(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
@@ -10,3 +10,7 @@ class CadesException(Exception):
 
 class AuthError(CadesException):
     default_message = "Authentication FAILED"
+
+
+class DiadocError(CadesException):
+    default_message = "Diadoc request FAILED"
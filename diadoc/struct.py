@@ -189,3 +189,39 @@ class DocflowStatus(CadesStruct):
 
 class DocumentV3(CadesStruct):
     DocflowStatus: DocflowStatus
+
+
+class DocflowV3(CadesStruct):
+    DocflowStatus: DocflowStatus
+
+
+class DocumentWithDocflowV3(CadesStruct):
+    """Из ответа GetDocflows берём только идентификатор и статус документооборота"""
+    DocumentId: DocumentId
+    Docflow: DocflowV3
+
+
+class GetDocflowBatchResponseV3(CadesStruct):
+    Documents: list[DocumentWithDocflowV3]
+
+
+class BoxEvent(CadesStruct):
+    """Событие ленты ящика. Нужен только идентификатор сообщения, которого оно касается"""
+    EventId: str
+    IndexKey: Optional[str] = None
+    MessageId: Optional[UUID] = None
+    Message: Optional[dict] = None
+    Patch: Optional[dict] = None
+
+    @property
+    def message_id(self) -> UUID|None:
+        if self.MessageId:
+            return self.MessageId
+        for part in (self.Message, self.Patch):
+            if part and part.get('MessageId'):
+                return UUID(part['MessageId'])
+
+
+class BoxEventList(CadesStruct):
+    Events: list[BoxEvent]
+    TotalCount: Optional[int] = None
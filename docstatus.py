@@ -0,0 +1,157 @@
+import asyncio
+from datetime import datetime, timezone
+from uuid import UUID
+
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from callbacks import callback_payload, enqueue_callbacks, wake_dispatcher
+from config import Config
+from db import BoxCursor, Document, Session, cursor_is_fresh, get_cursor
+from dbwriter import write
+from diadoc.aconnector import DOCFLOWS_BATCH_SIZE, AsyncDiadocAPI, authd_diadoc_api
+from diadoc.exceptions import DiadocError
+from diadoc.struct import DocflowStatusModel
+from logger import logger
+
+
+CURSOR_NAME = 'events'
+# GetNewEvents отдаёт не больше 100 событий за раз
+EVENTS_PAGE_SIZE = 100
+# тики .NET (100 нс) от 0001-01-01 до 1970-01-01
+EPOCH_TICKS = 621355968000000000
+
+STATUS_COLUMNS = (Document.uuid, Document.status, Document.source_box, Document.message_id, Document.entity_id,
+                  Document.diadoc_status, Document.diadoc_status_descr)
+
+
+def to_ticks(dt: datetime) -> int:
+    return EPOCH_TICKS + int(dt.astimezone(timezone.utc).timestamp() * 10 ** 7)
+
+
+async def docflow_statuses(dd: AsyncDiadocAPI, docs: list[Document]) -> dict[UUID, DocflowStatusModel]:
+    """Статусы ЭДО документов: группируем по ящику, режем на пачки GetDocflows и запрашиваем пачки параллельно"""
+    by_box = {}
+    for doc in docs:
+        if doc.message_id and doc.entity_id:
+            by_box.setdefault(doc.source_box, []).append(doc)
+
+    sem = asyncio.Semaphore(Config().diadoc_status_concurrency)
+
+    async def fetch(box: UUID, chunk: list[Document]) -> dict[UUID, DocflowStatusModel]:
+        async with sem:
+            res = await dd.get_docflow_statuses(box, [(d.message_id, d.entity_id) for d in chunk])
+        if isinstance(res, str):
+            logger.warning(f"Can't get docflows of box {box}: {res}")
+            return {}
+        return {d.uuid: stt for d in chunk if (stt := res.get((d.message_id, d.entity_id)))}
+
+    statuses = {}
+    for part in await asyncio.gather(*[fetch(box, box_docs[i:i + DOCFLOWS_BATCH_SIZE])
+                                       for box, box_docs in by_box.items()
+                                       for i in range(0, len(box_docs), DOCFLOWS_BATCH_SIZE)]):
+        statuses.update(part)
+    return statuses
+
+
+def changed_statuses(docs: list[Document],
+                     statuses: dict[UUID, DocflowStatusModel]) -> list[tuple[Document, DocflowStatusModel]]:
+    """Документы, статус ЭДО которых отличается от записанного в БД"""
+    return [(doc, stt) for doc in docs
+            if (stt := statuses.get(doc.uuid)) and
+            (doc.diadoc_status != stt.Severity or doc.diadoc_status_descr != stt.StatusText)]
+
+
+async def save_statuses(ss: AsyncSession, changed: list[tuple[Document, DocflowStatusModel]]) -> int:
+    """Записать изменившиеся статусы ЭДО (см. changed_statuses) одним UPDATE и поставить уведомления
+    в ту же транзакцию. commit - за вызывающим, после него - wake_dispatcher()"""
+    if changed:
+        await ss.execute(update(Document), [{'uuid'               : doc.uuid,
+                                             'diadoc_status'      : stt.Severity,
+                                             'diadoc_status_descr': stt.StatusText} for doc, stt in changed])
+        await enqueue_callbacks(ss, [callback_payload(doc, stt) for doc, stt in changed])
+    return len(changed)
+
+
+async def set_cursor(ss: AsyncSession, box: UUID, **values):
+    cur = await get_cursor(ss, box, CURSOR_NAME)
+    for k, v in values.items():
+        setattr(cur, k, v)
+
+
+async def events_are_fresh(box: UUID|str) -> bool:
+    """Статусы документов ящика в БД актуальны, если ленту событий дочитывали недавно"""
+    conf = Config()
+    if conf.events_poll_interval <= 0:
+        return False
+    async with Session() as ss:
+        return await cursor_is_fresh(ss, box, CURSOR_NAME, conf.events_max_age)
+
+
+async def start_ticks(box: UUID) -> int:
+    """Курсора ещё нет - читаем ленту с отправки самого старого документа ящика, который ждёт статус"""
+    async with Session() as ss:
+        oldest = (await ss.execute(select(func.min(Document.send_time))
+                                   .where(Document.source_box == box,
+                                          Document.message_id.is_not(None)))).scalar()
+    return to_ticks(oldest or datetime.now())
+
+
+async def poll_box(dd: AsyncDiadocAPI, box: UUID) -> int:
+    """Дочитать ленту событий ящика и обновить статусы документов, которых коснулись события"""
+    async with Session() as ss:
+        cursor = (cur := await ss.get(BoxCursor, (box, CURSOR_NAME))) and cur.cursor
+    timestamp_from = None if cursor else await start_ticks(box)
+
+    updated = 0
+    while True:
+        if isinstance(events := await dd.get_new_events(box, cursor, timestamp_from), str):
+            logger.warning(f"GetNewEvents for box {box} failed: {events}")
+            raise DiadocError()
+        if not events:
+            break
+
+        if message_ids := {mid for e in events if (mid := e.message_id)}:
+            async with Session() as ss:
+                docs = (await ss.execute(select(*STATUS_COLUMNS)
+                                         .where(Document.source_box == box,
+                                                Document.message_id.in_(message_ids),
+                                                Document.entity_id.is_not(None)))).all()
+            if docs and (changed := changed_statuses(docs, await docflow_statuses(dd, docs))):
+                updated += await write(lambda ss: save_statuses(ss, changed))
+                wake_dispatcher()
+
+        if indexed := [e.IndexKey for e in events if e.IndexKey]:
+            cursor = indexed[-1]
+            await write(lambda ss: set_cursor(ss, box, cursor=cursor))
+        if len(events) < EVENTS_PAGE_SIZE or not indexed:
+            break
+
+    await write(lambda ss: set_cursor(ss, box, synced_at=datetime.now()))
+    return updated
+
+
+async def poll_events() -> None:
+    from counteragents import my_boxes
+
+    dd = await authd_diadoc_api()
+    for box in await my_boxes(dd):
+        try:
+            if updated := await poll_box(dd, box):
+                logger.info(f"{updated} document statuses of box {box} are updated from events")
+        except Exception as e:
+            logger.error(f"Can't read events of box {box}: {str(e)}")
+
+
+async def poll_events_loop() -> None:
+    conf = Config()
+    while conf.events_poll_interval > 0:
+        try:
+            await poll_events()
+        except Exception as e:
+            logger.error(f"Events polling failed: {str(e)}")
+        await asyncio.sleep(conf.events_poll_interval)
+
+
+async def init_events_poller() -> None:
+    asyncio.create_task(poll_events_loop())
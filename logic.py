@@ -1,14 +1,22 @@
+import asyncio
+import threading
 from abc import ABCMeta, abstractmethod, abstractproperty
-from base64 import b64encode
+import hashlib
+from base64 import b64decode, b64encode
+from concurrent.futures import ThreadPoolExecutor
 from enum import property
 from time import sleep
+from typing import BinaryIO, Iterable, Iterator, NamedTuple
 
 import pytz
 import random
 import sys
 from datetime import datetime, timedelta
 from logging import info, warning, error
+from uuid import UUID
 
+from certindex import CertIndex
+from certpool import CertPool, NoAvailableCertificateException
 from config import Config
 from logger import logger
 
@@ -22,14 +30,42 @@ CAPICOM_ENCODE_BASE64 = 0
 
 # CADES
 CADES_BES = 1
+CADESCOM_BASE64_TO_BINARY = 1
+
+# Алгоритмы хэширования по OID алгоритма открытого ключа сертификата
+CADESCOM_HASH_ALGORITHM_CP_GOST_3411 = 100
+CADESCOM_HASH_ALGORITHM_CP_GOST_3411_2012_256 = 101
+CADESCOM_HASH_ALGORITHM_CP_GOST_3411_2012_512 = 102
+
+GOST_KEY_HASH_ALGORITHMS = {
+    '1.2.643.2.2.19': CADESCOM_HASH_ALGORITHM_CP_GOST_3411,
+    '1.2.643.7.1.1.1.1': CADESCOM_HASH_ALGORITHM_CP_GOST_3411_2012_256,
+    '1.2.643.7.1.1.1.2': CADESCOM_HASH_ALGORITHM_CP_GOST_3411_2012_512,
+}
+
+# кратно 3: каждый кусок кодируется в base64 отдельно
+HASH_CHUNK_SIZE = 3 * 64 * 1024
 
 
 STORE = 'CAdESCOM.Store'
 SIGNER = "CAdESCOM.CPSigner"
 SIGNED_DATA = "CAdESCOM.CadesSignedData"
+HASHED_DATA = "CAdESCOM.HashedData"
+
 
+def chunked(data: bytes, size: int = HASH_CHUNK_SIZE) -> Iterator[bytes]:
+    view = memoryview(data)
+    for i in range(0, len(view), size):
+        yield bytes(view[i:i + size])
 
-class NoAvailableCertificateException(Exception): ...
+
+class SignQueueFullException(Exception): ...
+
+
+class SignResult(NamedTuple):
+    sign: bytes
+    cert_number: str
+    sign_time: datetime
 
 
 class LogicAbstract(metaclass=ABCMeta):
@@ -38,10 +74,23 @@ class LogicAbstract(metaclass=ABCMeta):
     def certs(self):
         raise NotImplemented("property certs not implemented")
 
-    @property
     @abstractmethod
+    def cert_valid_to(self, cert) -> datetime:
+        raise NotImplemented("method cert_valid_to not implemented")
+
+    @property
+    def cert_index(self) -> CertIndex:
+        if not hasattr(self, '_cert_index'):
+            self._cert_index = CertIndex(self, Config().cert_refresh_interval)
+        return self._cert_index
+
+    def refresh_certs(self):
+        self.cert_index.refresh()
+
+    @property
     def actual_certs(self):
-        raise NotImplemented("property actual_certs not implemented")
+        for e in self.cert_index.actual():
+            yield e.cert
 
     @property
     @abstractmethod
@@ -49,31 +98,183 @@ class LogicAbstract(metaclass=ABCMeta):
         raise NotImplemented("property default_cert not implemented")
 
     def find_cert(self, number_or_subject: str|None = None):
-        for cert in self.actual_certs:
-            if (number_or_subject is None or
-                        cert.SerialNumber == number_or_subject or
-                        number_or_subject in cert.SubjectName):
-                yield cert
+        for e in self.cert_index.find(number_or_subject):
+            yield e.cert
 
     @abstractmethod
-    def sign_data(self, data: bytes|str, key_pin: str, detached_sign: bool = True):
+    def sign_data(self, data: bytes|str, key_pin: str, detached_sign: bool = True, cert: 'CDispatch|None' = None):
         raise NotImplemented("method sign_data not implemented")
 
+    @abstractmethod
+    def sign_hash(self, chunks: Iterable[bytes], key_pin: str|None = None, cert: 'CDispatch|None' = None) -> bytes:
+        """Откреплённая подпись: содержимое кусками хэшируется по ГОСТ, подписывается только хэш"""
+        raise NotImplemented("method sign_hash not implemented")
+
+    def hash_algorithm(self, cert) -> int:
+        try:
+            oid = cert.PublicKey().Algorithm.Value
+        except Exception:
+            return CADESCOM_HASH_ALGORITHM_CP_GOST_3411_2012_256
+        return GOST_KEY_HASH_ALGORITHMS.get(oid, CADESCOM_HASH_ALGORITHM_CP_GOST_3411_2012_256)
+
+    @property
+    def pool(self) -> CertPool:
+        if not hasattr(self, '_pool'):
+            self._pool = CertPool(self)
+        return self._pool
+
+    def executor_initializer(self):
+        pass
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if not hasattr(self, '_executor'):
+            conf = Config()
+            # Слоты = работающие воркеры + ожидающие в очереди. Больше не берём
+            self._sign_slots = threading.BoundedSemaphore(conf.sign_workers + conf.sign_queue_size)
+            self._executor = ThreadPoolExecutor(max_workers=conf.sign_workers,
+                                                thread_name_prefix='cades-sign',
+                                                initializer=self.executor_initializer)
+        return self._executor
+
+    @property
+    def store_executor(self) -> ThreadPoolExecutor:
+        """Перечитывание хранилища - в своём потоке, чтобы не ждать в очереди на подпись"""
+        if not hasattr(self, '_store_executor'):
+            self._store_executor = ThreadPoolExecutor(max_workers=1,
+                                                      thread_name_prefix='cades-store',
+                                                      initializer=self.executor_initializer)
+        return self._store_executor
+
+    async def _asign(self, fn, data, key_pin: str|None, detached_sign: bool,
+                     source_box: UUID|str|None) -> SignResult:
+        executor = self.executor
+        if not self._sign_slots.acquire(blocking=False):
+            raise SignQueueFullException("Sign queue is full")
+        try:
+            loop = asyncio.get_running_loop()
+            if not self.pool.enabled:
+                cert = await self.adefault_cert()
+                sign = await loop.run_in_executor(executor, fn, data, key_pin, detached_sign, cert)
+                return SignResult(sign, cert.SerialNumber, datetime.now())
+
+            if not self.pool.numbers(source_box):
+                # в кэше нет подходящих сертификатов - возможно, вставили токен. Перечитываем не в цикле событий
+                await self.in_store(self.cert_index.refresh_if_stale)
+
+            with self.pool.lease(source_box) as entry:
+                if (indexed := self.cert_index.cached(entry.number)) is None:
+                    raise NoAvailableCertificateException(f"Certificate {entry.number} is not found in store")
+                cert = indexed.cert
+                sign = await loop.run_in_executor(executor, fn, data,
+                                                  entry.pincode or key_pin, detached_sign, cert)
+                return SignResult(sign, entry.number, datetime.now())
+        finally:
+            self._sign_slots.release()
+
+    def signing_cert_numbers(self, source_box: UUID|str|None = None) -> list[str]:
+        """Сертификаты, которыми сейчас может быть подписан документ из source_box"""
+        if self.pool.enabled:
+            return self.pool.numbers(source_box)
+        return [self.default_cert.SerialNumber]
+
+    async def in_store(self, fn, *args):
+        """Обращения к хранилищу (перечитывание, поиск с промахом) - в потоке хранилища, не в цикле событий.
+        Что есть в кэше сертификатов, отдаётся сразу"""
+        return await asyncio.get_running_loop().run_in_executor(self.store_executor, fn, *args)
+
+    async def asigning_cert_numbers(self, source_box: UUID|str|None = None) -> list[str]:
+        if not self.pool.enabled:
+            return [(await self.adefault_cert()).SerialNumber]
+        if not self.pool.numbers(source_box):
+            await self.in_store(self.cert_index.refresh_if_stale)
+        return self.pool.numbers(source_box)
+
+    async def afind_cert(self, number_or_subject: str|None = None) -> list:
+        if (found := self.cert_index.cached_find(number_or_subject)) is not None:
+            return [e.cert for e in found]
+        return await self.in_store(lambda: list(self.find_cert(number_or_subject)))
+
+    async def aactual_certs(self) -> list:
+        if self.cert_index.loaded:
+            return [e.cert for e in self.cert_index.actual()]
+        return await self.in_store(lambda: list(self.actual_certs))
+
+    async def adefault_cert(self):
+        if cert := getattr(self, '_def_cert', None):
+            return cert
+
+        def default_cert():
+            try:
+                return self.default_cert
+            except StopIteration:  # в Future его передать нельзя
+                raise NoAvailableCertificateException("No available certificate")
+
+        return await self.in_store(default_cert)
+
+    async def aset_default_cert(self, value):
+        if isinstance(value, str) and (indexed := self.cert_index.cached(value)):
+            self.default_cert = indexed.cert
+            return
+
+        def set_default_cert():
+            if isinstance(value, str) and next(self.find_cert(value), None) is None:
+                raise ValueError(f"Certificate {value} is not found")
+            self.default_cert = value
+
+        await self.in_store(set_default_cert)
+
+    async def asign_data(self,
+                         data: bytes|str,
+                         key_pin: str|None = None,
+                         detached_sign: bool = True,
+                         source_box: UUID|str|None = None) -> SignResult:
+        return await self._asign(self.sign_data, data, key_pin, detached_sign, source_box)
+
+    def sign_file(self, fh: BinaryIO, key_pin: str|None = None, detached_sign: bool = True,
+                  cert: 'CDispatch|None' = None) -> bytes:
+        fh.seek(0)
+        if detached_sign and Config().hash_sign:
+            return self.sign_hash(iter(lambda: fh.read(HASH_CHUNK_SIZE), b''), key_pin, cert)
+        return self.sign_data(self.prepare_data(b64encode(fh.read())), key_pin, detached_sign, cert)
+
+    async def asign_file(self,
+                         fh: BinaryIO,
+                         key_pin: str|None = None,
+                         detached_sign: bool = True,
+                         source_box: UUID|str|None = None) -> SignResult:
+        return await self._asign(self.sign_file, fh, key_pin, detached_sign, source_box)
+
     @abstractmethod
     def prepare_data(self, data: str|bytes) -> str|bytes:
         raise NotImplemented("abstract method prepare_data not implemented")
 
 
 if sys.platform == 'win32':
+    # Импорт pythoncom инициализирует COM в текущем потоке с флагами sys.coinit_flags, по умолчанию - STA.
+    # Тогда CoInitializeEx(MTA) в том же потоке падает с RPC_E_CHANGED_MODE. Нужен MTA: объекты CAdESCOM
+    # создаются здесь, а используются из потоков подписи
+    if not hasattr(sys, 'coinit_flags'):
+        sys.coinit_flags = 0  # COINIT_MULTITHREADED
     import win32com.client as win32
     import win32timezone as w32tz
     import pythoncom
+    import winerror
     from win32com.client import CDispatch
 
+    def com_initialize():
+        try:
+            pythoncom.CoInitializeEx(pythoncom.COINIT_MULTITHREADED)
+        except pythoncom.com_error as e:
+            if e.hresult != winerror.RPC_E_CHANGED_MODE:
+                raise
+            # поток уже STA (pywin32 импортировали раньше с другими флагами) - работаем в нём, как прежде
+            logger.warning("COM is already initialized as STA in this thread")
+
     class Logic(LogicAbstract):
         def __init__(self):
             self.conf = Config()
-            pythoncom.CoInitialize()
+            com_initialize()
             self.store = win32.Dispatch(STORE)
             for _ in range(10):
                 capicom_store = self.conf.capicom_store or CAPICOM_SMART_CARD_USER_STORE
@@ -101,11 +302,8 @@ if sys.platform == 'win32':
         def certs(self):
             return list(self.store.Certificates)
 
-        @property
-        def actual_certs(self):
-            for c in self.certs:
-                if c.ValidToDate > w32tz.now():
-                    yield c
+        def cert_valid_to(self, cert) -> datetime:
+            return cert.ValidToDate
 
         @property
         def default_cert(self) -> CDispatch:
@@ -123,12 +321,19 @@ if sys.platform == 'win32':
             else:
                 raise ValueError(f"{value} is not instance of str or COMObject")
 
+        def executor_initializer(self):
+            com_initialize()
+
         def sign_data(self,
                       data: bytes|str,
                       key_pin: str|None = None,
-                      detached_sign: bool = True) -> bytes:
+                      detached_sign: bool = True,
+                      cert: CDispatch|None = None) -> bytes:
+            if detached_sign and self.conf.hash_sign:
+                return self.sign_hash(chunked(data), key_pin, cert)
+
             signer = win32.Dispatch(SIGNER)
-            signer.Certificate = self.default_cert
+            signer.Certificate = cert or self.default_cert
             if key_pin:
                 signer.KeyPin = key_pin
             sd = win32.Dispatch(SIGNED_DATA)
@@ -139,6 +344,27 @@ if sys.platform == 'win32':
                 sign = sign.encode()
             return sign
 
+        def sign_hash(self,
+                      chunks: Iterable[bytes],
+                      key_pin: str|None = None,
+                      cert: CDispatch|None = None) -> bytes:
+            cert = cert or self.default_cert
+            hd = win32.Dispatch(HASHED_DATA)
+            hd.Algorithm = self.hash_algorithm(cert)
+            hd.DataEncoding = CADESCOM_BASE64_TO_BINARY
+            for chunk in chunks:
+                hd.Hash(b64encode(chunk).decode('ascii'))
+
+            signer = win32.Dispatch(SIGNER)
+            signer.Certificate = cert
+            if key_pin:
+                signer.KeyPin = key_pin
+            sd = win32.Dispatch(SIGNED_DATA)
+            sign = sd.SignHash(hd, signer, CADES_BES, CAPICOM_ENCODE_BASE64)
+            if isinstance(sign, str):
+                sign = sign.encode()
+            return sign
+
         def prepare_data(self, data: str|bytes) -> bytes:
             import base64
             return base64.b64decode(data)
@@ -181,12 +407,8 @@ elif sys.platform == 'linux':
             return [self.store.Certificates.Item(i+1)
                         for i in range(self.store.Certificates.Count)]
 
-        @property
-        def actual_certs(self):
-            for cert in self.certs:
-                valid_to_date = datetime.strptime(cert.ValidToDate, '%d.%m.%Y %H:%M:%S')
-                if valid_to_date > datetime.now():
-                    yield cert
+        def cert_valid_to(self, cert) -> datetime:
+            return datetime.strptime(cert.ValidToDate, '%d.%m.%Y %H:%M:%S').astimezone()
 
         @property
         def default_cert(self) -> Certificate:
@@ -207,9 +429,18 @@ elif sys.platform == 'linux':
             else:
                 raise ValueError(f"{value} is not instance of pycades.Certificate or str")
 
-        def sign_data(self, data: bytes|str, key_pin: str|None=None, detached_sign: bool = True) -> bytes:
+        def sign_data(self,
+                      data: bytes|str,
+                      key_pin: str|None = None,
+                      detached_sign: bool = True,
+                      cert: Certificate|None = None) -> bytes:
+            if detached_sign and self.conf.hash_sign:
+                # bytes приходят в base64, строка подписывается как UCS2LE (ContentEncoding по умолчанию)
+                raw = b64decode(data) if isinstance(data, bytes) else data.encode('utf-16-le')
+                return self.sign_hash(chunked(raw), key_pin, cert)
+
             signer = pycades.Signer()
-            signer.Certificate = self.default_cert
+            signer.Certificate = cert or self.default_cert
             if key_pin:
                 signer.KeyPin = key_pin
             sd = pycades.SignedData()
@@ -225,6 +456,27 @@ elif sys.platform == 'linux':
                 sign = sign.encode()
             return sign
 
+        def sign_hash(self,
+                      chunks: Iterable[bytes],
+                      key_pin: str|None = None,
+                      cert: Certificate|None = None) -> bytes:
+            cert = cert or self.default_cert
+            hd = pycades.HashedData()
+            hd.Algorithm = self.hash_algorithm(cert)
+            hd.DataEncoding = pycades.CADESCOM_BASE64_TO_BINARY
+            for chunk in chunks:
+                hd.Hash(b64encode(chunk).decode('ascii'))
+
+            signer = pycades.Signer()
+            signer.Certificate = cert
+            if key_pin:
+                signer.KeyPin = key_pin
+            sd = pycades.SignedData()
+            sign = sd.SignHash(hd, signer, pycades.CADESCOM_CADES_BES, pycades.CAPICOM_ENCODE_BASE64)
+            if isinstance(sign, str):
+                sign = sign.encode()
+            return sign
+
         def prepare_data(self, data: str|bytes) -> str:
             return data
 
@@ -253,11 +505,8 @@ class LogicMock(LogicAbstract):
     def certs(self):
         return [self.mock_cert]
 
-    @property
-    def actual_certs(self):
-        for c in self.certs:
-            if c.ValidToDate > datetime.now(tz=pytz.UTC):
-                yield c
+    def cert_valid_to(self, cert) -> datetime:
+        return cert.ValidToDate
 
     @property
     def default_cert(self) -> CDispatch:
@@ -275,5 +524,15 @@ class LogicMock(LogicAbstract):
             raise ValueError(f"{value} is not instance of str or COMObject")
 
     def sign_data(self, data: bytes|str, key_pin: str,
-                  detached_sign: bool = True) -> bytes:
+                  detached_sign: bool = True, cert: CDispatch|None = None) -> bytes:
         return b64encode(random.randbytes(1000))
+
+    def sign_hash(self, chunks: Iterable[bytes], key_pin: str|None = None,
+                  cert: CDispatch|None = None) -> bytes:
+        hd = hashlib.sha256()
+        for chunk in chunks:
+            hd.update(chunk)
+        return b64encode(random.randbytes(1000))
+
+    def prepare_data(self, data: str|bytes) -> str|bytes:
+        return data
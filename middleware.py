@@ -1,3 +1,5 @@
+from ipaddress import ip_address, ip_network
+
 from sqlalchemy.util import md5_hex
 from starlette.middleware import Middleware
 from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint
@@ -7,15 +9,73 @@ from starlette.responses import Response
 from config import Config
 
 
+class Whitelist:
+    """Адреса и подсети (CIDR) из `whitelist`. Адрес проверяется по маске каждой длины префикса,
+    которая есть в списке, - число проверок не зависит от количества записей"""
+
+    def __init__(self, entries: list[str]):
+        self.empty = not entries
+        self.hosts = set()  # записи, которые не разбираются как IP (например, имена хостов)
+        by_prefix = {4: {}, 6: {}}
+        for entry in entries:
+            try:
+                net = ip_network(str(entry).strip(), strict=False)
+            except ValueError:
+                self.hosts.add(str(entry))
+                continue
+            by_prefix[net.version].setdefault(net.prefixlen, set()).add(int(net.network_address))
+
+        bits = {4: 32, 6: 128}
+        self.prefixes = {version: tuple((((1 << plen) - 1) << (bits[version] - plen), frozenset(nets))
+                                        for plen, nets in prefixes.items())
+                         for version, prefixes in by_prefix.items()}
+
+    def __contains__(self, host: str) -> bool:
+        if host in self.hosts:
+            return True
+        try:
+            addr = ip_address(host)
+        except ValueError:
+            return False
+        if addr.version == 6 and addr.ipv4_mapped:
+            addr = addr.ipv4_mapped
+        value = int(addr)
+        return any(value & mask in nets for mask, nets in self.prefixes[addr.version])
+
+
+class AccessSnapshot:
+    """Неизменяемый слепок настроек доступа. Собирается заново, только когда Config.refresh загрузил файл"""
+
+    def __init__(self, config: Config):
+        self.generation = config.generation
+        self.auth_disabled = config.auth_disabled
+        users = config.users
+        # принимаются md5("user:password") и, как раньше, сам пароль
+        self.tokens = frozenset(md5_hex(f"{u}:{p}") for u, p in users.items()) | frozenset(users.values())
+        self.whitelist = Whitelist(config.whitelist)
+
+
+_snapshot: AccessSnapshot|None = None
+
+
+def access_snapshot() -> AccessSnapshot:
+    global _snapshot
+
+    config = Config()
+    if _snapshot is None or _snapshot.generation != config.generation:
+        _snapshot = AccessSnapshot(config)
+    return _snapshot
+
+
 class IPAddrMiddleware(BaseHTTPMiddleware):
     async def dispatch(
         self, request: Request, call_next: RequestResponseEndpoint
     ) -> Response:
         addr = request.client.host
 
-        config = Config()
+        whitelist = access_snapshot().whitelist
 
-        if len(config.whitelist) > 0 and addr not in config.whitelist:
+        if not whitelist.empty and addr not in whitelist:
             return Response(f'{addr} NOT IN WHITELIST!', status_code=403)
         return await call_next(request)
 
@@ -35,8 +95,8 @@ class AuthMiddleware(BaseHTTPMiddleware):
         return md5_hex(s)
 
     async def dispatch(self, request: Request, call_next: RequestResponseEndpoint) -> Response:
-        config = Config()
-        if config.auth_disabled:
+        snapshot = access_snapshot()
+        if snapshot.auth_disabled:
             return await call_next(request)
 
         if request.url.path.startswith(self.UNDEFENDED_URLS):
@@ -44,17 +104,14 @@ class AuthMiddleware(BaseHTTPMiddleware):
 
         if self.DIADOC_CLIENT_ID in request.headers and \
                 (client_id := request.headers.get(self.DIADOC_CLIENT_ID)):
+            config = Config()
             if config.client_id != client_id:
                 config.client_id = client_id
 
         if pretoken := request.headers.get('authorization'):
             method, token = pretoken.split(' ')
             if method == self.AUTH_METHOD:
-                tokens = (md5_hex(f"{u}:{p}") for u,p in config.users.items())
-                if token in tokens:
-                    return await call_next(request)
-                tokens = config.users.values()
-                if token in tokens:
+                if token in snapshot.tokens:
                     return await call_next(request)
 
         return Response("NOT AUTHORIZED!", status_code=403)
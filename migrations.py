@@ -0,0 +1,100 @@
+"""Версионные изменения схемы БД. Применяются при старте сервиса после create_all: create_all создаёт
+недостающие таблицы, миграции доводят до текущего вида уже существующие.
+Каждая миграция должна быть повторяемой - старые базы не знают, какие из изменений в них уже есть"""
+from typing import Callable
+
+from sqlalchemy import Connection, inspect, text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from db import Document, is_postgres
+from logger import logger
+
+
+def add_columns(cnx: Connection, table, names: list[str]):
+    existing = {c['name'] for c in inspect(cnx).get_columns(table.name)}
+    for name in names:
+        if name not in existing:
+            column = table.c[name]
+            cnx.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {name} {column.type.compile(cnx.dialect)}"))
+
+
+def create_indexes(cnx: Connection, table, names: list[str]):
+    existing = {i['name'] for i in inspect(cnx).get_indexes(table.name)}
+    for index in table.indexes:
+        if index.name in names and index.name not in existing:
+            index.create(cnx)
+
+
+def m001_document_columns(cnx: Connection):
+    """Колонки подписи, повторов и аренды, появившиеся после первых версий"""
+    add_columns(cnx, Document.__table__, ['content_hash', 'cert_number', 'sign_time',
+                                          'next_attempt_at', 'last_error_at', 'claimed_by', 'lease_until'])
+
+
+def m002_dead_status(cnx: Connection):
+    if is_postgres:
+        # в PG статус - перечислимый тип, новое значение нужно добавить явно
+        cnx.execute(text("ALTER TYPE documentstatus ADD VALUE IF NOT EXISTS 'DEAD'"))
+
+
+def m003_document_indexes(cnx: Connection):
+    create_indexes(cnx, Document.__table__, ['ix_documents_content_hash', 'ix_documents_queue',
+                                             'ix_documents_message'])
+
+
+def m004_document_blobs(cnx: Connection):
+    """Подписи и содержимое из колонок documents - в document_blobs"""
+    if not {'sign', 'signed_data'} <= {c['name'] for c in inspect(cnx).get_columns('documents')}:
+        return
+    moved = cnx.execute(text("INSERT INTO document_blobs (uuid, sign, signed_data) "
+                             "SELECT uuid, sign, signed_data FROM documents "
+                             "WHERE (sign IS NOT NULL OR signed_data IS NOT NULL) "
+                             "AND uuid NOT IN (SELECT uuid FROM document_blobs)")).rowcount
+    cnx.execute(text("UPDATE documents SET sign = NULL, signed_data = NULL "
+                     "WHERE sign IS NOT NULL OR signed_data IS NOT NULL"))
+    if moved:
+        logger.info(f"Content of {moved} documents is moved to document_blobs")
+
+
+def m005_drop_pending_index(cnx: Connection):
+    """Частичный индекс по статусам не использовался: статусы в запросах очереди - параметры,
+    и планировщик не может сопоставить их с условием индекса. Очередь обслуживает ix_documents_queue"""
+    cnx.execute(text("DROP INDEX IF EXISTS ix_documents_pending"))
+
+
+MIGRATIONS: list[tuple[int, Callable[[Connection], None]]] = [
+    (1, m001_document_columns),
+    (2, m002_dead_status),
+    (3, m003_document_indexes),
+    (4, m004_document_blobs),
+    (5, m005_drop_pending_index),
+]
+
+# ALTER TYPE ... ADD VALUE в PostgreSQL до 12 нельзя выполнять внутри транзакции
+AUTOCOMMIT = {m002_dead_status}
+
+
+def current_version(cnx: Connection) -> int:
+    cnx.execute(text("CREATE TABLE IF NOT EXISTS schema_version "
+                     "(version INTEGER PRIMARY KEY, applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"))
+    return cnx.execute(text("SELECT MAX(version) FROM schema_version")).scalar() or 0
+
+
+async def migrate(eng: AsyncEngine):
+    async with eng.begin() as cnx:
+        version = await cnx.run_sync(current_version)
+
+    for number, fn in MIGRATIONS:
+        if number <= version:
+            continue
+        if fn in AUTOCOMMIT:
+            async with eng.connect() as cnx:
+                cnx = await cnx.execution_options(isolation_level='AUTOCOMMIT')
+                await cnx.run_sync(fn)
+                await cnx.execute(text("INSERT INTO schema_version (version) VALUES (:v)"), {'v': number})
+        else:
+            # каждая миграция - в своей транзакции вместе с отметкой о ней
+            async with eng.begin() as cnx:
+                await cnx.run_sync(fn)
+                await cnx.execute(text("INSERT INTO schema_version (version) VALUES (:v)"), {'v': number})
+        logger.info(f"Migration {fn.__name__} is applied")
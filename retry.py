@@ -0,0 +1,27 @@
+import asyncio
+import random
+from datetime import timedelta
+
+
+def backoff_delay(policy: dict, tries: int) -> timedelta:
+    """Задержка после tries неудачных попыток: экспонента от base-delay до max-delay,
+    случайно в пределах [delay/2, delay], чтобы повторы не приходили одновременно"""
+    delay = min(policy['max-delay'], policy['base-delay'] * 2 ** (tries - 1))
+    return timedelta(seconds=random.uniform(delay / 2, delay))
+
+
+class Wakeup:
+    """Пробуждение фонового обработчика. asyncio.Event создаётся при первом обращении,
+    уже в работающем цикле событий"""
+
+    def __init__(self):
+        self._event: asyncio.Event|None = None
+
+    @property
+    def event(self) -> asyncio.Event:
+        if self._event is None:
+            self._event = asyncio.Event()
+        return self._event
+
+    def set(self) -> None:
+        self.event.set()
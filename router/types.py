@@ -26,7 +26,7 @@ class Status(BaseModel):
     valid_to: str|date|None = None
 
 
-class DocumentRequest(BaseModel):
+class DocumentMeta(BaseModel):
     source_box: UUID
     dest_box: UUID|None = None
     dest_inn: str|None = None
@@ -40,6 +40,8 @@ class DocumentRequest(BaseModel):
     vat: Decimal|None = None
     grounds: str|None = None
 
+
+class DocumentRequest(DocumentMeta):
     data: bytes
 
 
@@ -47,6 +49,21 @@ class SignedResponse(BaseModel):
     status: ServiceStatus
     msg: str
     uuid: UUID|None = None
+    duplicates: list[UUID]|None = None
+
+
+class DbPoolStatus(BaseModel):
+    size: int
+    checked_out: int
+    idle: int
+    overflow: int
+    max_overflow: int
+    checkouts: int
+    waits: int
+    timeouts: int
+    connects: int
+    avg_checkout_ms: float
+    max_checkout_ms: float
 
 
 class DocStatusResponse(BaseModel):
@@ -1,19 +1,34 @@
+import asyncio
+import hashlib
 import traceback
+from base64 import b64decode
+from datetime import datetime, timedelta
 from os.path import exists
+from typing import Awaitable, Callable
 
-from fastapi import HTTPException
+from fastapi import Depends, HTTPException, Request
 from fastapi.routing import APIRouter
 from sqlalchemy import select
+from sqlalchemy.orm import selectinload
 
 import logger
+from callbacks import wake_dispatcher
 from config import Config
 from const import DocumentStatusRus
-from db import Document, Session
-from diadoc.connector import AuthdDiadocAPI, DiadocAPI
+from counteragents import find_ctg, list_ctgs, local_box_by_innkpp
+from docstatus import changed_statuses, docflow_statuses, events_are_fresh, save_statuses
+from db import DOCUMENT_COLUMNS, Document, DocumentBlob, Session, engine
+from dbwriter import write
+from diadoc.aconnector import authd_diadoc_api
 from diadoc.enums import CounteragentStatus
-from logic import Logic, LogicMock, NoAvailableCertificateException
+from diadoc.struct import DocflowStatusModel
+from logic import (Logic, LogicAbstract, LogicMock, NoAvailableCertificateException, SignQueueFullException,
+                   SignResult)
 from router.types import *
-from sender import send_document
+from sender import (INSTANCE_ID, PENDING_STATUSES, error_class, notify_documents, release_document, schedule_retry,
+                    send_document, wake_sender)
+from signd import RemoteLogic
+from upload import SpooledDocument, UploadTooLargeException
 
 __cades = None
 
@@ -23,7 +38,10 @@ def CadesLogic():
 
     cfg = Config()
     if not __cades:
-        if cfg.fake_logic:
+        if cfg.sign_daemon:
+            # токен открыт в демоне подписи, воркеров может быть несколько
+            __cades = RemoteLogic()
+        elif cfg.fake_logic:
             __cades = LogicMock()
         else:
             __cades = Logic()
@@ -39,7 +57,7 @@ async def list_keys() -> list[Cert]:
 
     return [
         Cert(number=c.SerialNumber, name=c.SubjectName)
-        for c in cades.actual_certs
+        for c in await cades.aactual_certs()
     ]
 
 
@@ -47,8 +65,8 @@ async def list_keys() -> list[Cert]:
 async def get_key_description(number: str) -> Cert|str:
     cades = CadesLogic()
 
-    if cert := next(cades.find_cert(number)):
-        return Cert(number=cert.SerialNumber, name=cert.SubjectName)
+    if certs := await cades.afind_cert(number):
+        return Cert(number=certs[0].SerialNumber, name=certs[0].SubjectName)
     else:
         raise HTTPException(404, "KEY NOT FOUND")
 
@@ -56,7 +74,10 @@ async def get_key_description(number: str) -> Cert|str:
 @router.post("/keys/{number}", tags=['keys'])
 async def set_default_key(number: str) -> str:
     cades = CadesLogic()
-    cades.default_cert = number
+    try:
+        await cades.aset_default_cert(number)
+    except ValueError:
+        raise HTTPException(404, "KEY NOT FOUND")
 
     return "OK"
 
@@ -66,9 +87,9 @@ async def status() -> Status:
     from apisrv import VERSION
 
     try:
-        cades = CadesLogic()
-        dt = cades.default_cert.ValidToDate
-        subj = cades.default_cert.SubjectName
+        cert = await CadesLogic().adefault_cert()
+        dt = cert.ValidToDate
+        subj = cert.SubjectName
 
         return Status(code=1,
                       name=ServiceStatus.OK,
@@ -80,10 +101,16 @@ async def status() -> Status:
                       name=ServiceStatus.NO_KEYS)
 
 
+@router.get("/db-pool", tags=['status'])
+async def db_pool() -> DbPoolStatus:
+    """Загрузка пула соединений с БД"""
+    return DbPoolStatus(**engine.pool.usage())
+
+
 @router.get("/diadoc", tags=['diadoc'])
 async def diadoc() -> Status:
-    dd = AuthdDiadocAPI()
-    if dd.authenticate():
+    dd = await authd_diadoc_api()
+    if await dd.authenticate():
         return Status(code=1,
                       name=DiadocServiceStatus.OK)
     else:
@@ -100,6 +127,8 @@ def get_msg(doc: Document) -> str:
             return "Документ отправлен в ДИАДОК"
         case DocumentStatus.RECEIVED:
             return "Документ получен и скоро перейдёт в обработку"
+        case DocumentStatus.DEAD:
+            return doc.error_msg or "Попытки отправки документа исчерпаны"
         case _:
             return doc.error_msg or "Документ в неизвестном статусе"
 
@@ -109,15 +138,17 @@ async def document_status(guid: UUID) -> DocStatusResponse:
     try:
         async with Session() as ss:
             if doc := (await ss.execute(select(Document).where(Document.uuid == guid))).scalar():
-                dd = AuthdDiadocAPI()
-                dsr = DocStatusResponse(status=doc.status, uuid=doc.uuid, dte=doc.send_time, msg=get_msg(doc))
-
-                if stt := dd.get_document_status(doc.source_box, doc.message_id, doc.entity_id):
-                    if doc.diadoc_status != stt.Severity or doc.diadoc_status_descr != stt.StatusText:
-                        doc.diadoc_status = stt.Severity
-                        doc.diadoc_status_descr = stt.StatusText
-                        ss.add(doc)
-                        ss.commit()
+                dsr = DocStatusResponse(status=doc.status, uuid=doc.uuid, dte=doc.send_time, msg=get_msg(doc),
+                                        edo_status=doc.diadoc_status, edo_status_descr=doc.diadoc_status_descr)
+                if await events_are_fresh(doc.source_box):
+                    # статус поддерживает актуальным опрос ленты событий
+                    return dsr
+
+                dd = await authd_diadoc_api()
+                if stt := await dd.get_document_status(doc.source_box, doc.message_id, doc.entity_id):
+                    if changed := changed_statuses([doc], {doc.uuid: stt}):
+                        await write(lambda ws: save_statuses(ws, changed))
+                        wake_dispatcher()
 
                     dsr.edo_status = stt.Severity
                     dsr.edo_status_descr = stt.StatusText
@@ -131,28 +162,35 @@ async def document_status(guid: UUID) -> DocStatusResponse:
         raise HTTPException(500, str(e))
 
 
-async def gen_doc_status_response(dd: DiadocAPI, doc: Document) -> DocStatusResponse:
-    doc_stt = await dd.aget_document_status(doc.source_box, doc.message_id, doc.entity_id)
-    return DocStatusResponse(status=doc.status,
-                             edo_status=doc_stt.Severity if doc_stt else None,
-                             edo_status_descr=doc_stt.StatusText if doc_stt else None,
-                             uuid=doc.uuid,
-                             dte=doc.send_time,
-                             msg=get_msg(doc))
-
-
 @router.post("/documents/status", tags=['status'])
 async def document_status(request: DocsStatusRequest) -> list[DocStatusResponse]:
     try:
         async with Session() as ss:
             if docs := (await ss.execute(select(Document).where(Document.uuid.in_(request.uuids)))).all():
                 docs = [x for (x,) in docs]
-                dd = AuthdDiadocAPI()
-
-                return [
-                    await gen_doc_status_response(dd, doc)
-                        for doc in docs
+                fresh = {box for box in {doc.source_box for doc in docs} if await events_are_fresh(box)}
+                statuses = {doc.uuid: DocflowStatusModel(Severity=doc.diadoc_status,
+                                                         StatusText=doc.diadoc_status_descr)
+                            for doc in docs if doc.source_box in fresh and doc.diadoc_status}
+                if stale := [doc for doc in docs if doc.source_box not in fresh]:
+                    statuses.update(await docflow_statuses(await authd_diadoc_api(), stale))
+
+                response = [
+                    DocStatusResponse(status=doc.status,
+                                      edo_status=stt.Severity if (stt := statuses.get(doc.uuid)) else None,
+                                      edo_status_descr=stt.StatusText if stt else None,
+                                      uuid=doc.uuid,
+                                      dte=doc.send_time,
+                                      msg=get_msg(doc))
+                    for doc in docs
                 ]
+
+                # опрос без изменений не должен занимать писателя
+                if changed := changed_statuses(docs, statuses):
+                    await write(lambda ws: save_statuses(ws, changed))
+                    wake_dispatcher()
+
+                return response
             return []
 
     except Exception as e:
@@ -169,70 +207,290 @@ async def status_ref() -> list[DocumentStatusRef]:
     ]
 
 
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(b64decode(data)).hexdigest()
+
+
+def new_document(item: DocumentMeta, sr: SignResult, signed_data: bytes, chash: str) -> Document:
+    return Document(**dict(filter(lambda x: x[0] != 'data', item)),
+                    sign=sr.sign,
+                    signed_data=signed_data,
+                    content_hash=chash,
+                    cert_number=sr.cert_number,
+                    sign_time=sr.sign_time,
+                    status=DocumentStatus.RECEIVED)
+
+
+def restart_document(doc: Document, item: DocumentMeta, sr: SignResult, signed_data: bytes, chash: str) -> Document:
+    doc.status = DocumentStatus.PROGRESS
+    doc.tries = 0
+    doc.next_attempt_at = None
+    for k, v in dict(item).items():
+        if k in ['uuid', 'data']: continue
+        setattr(doc, k, v)
+    doc.sign = sr.sign
+    doc.signed_data = signed_data
+    doc.content_hash = chash
+    doc.cert_number = sr.cert_number
+    doc.sign_time = sr.sign_time
+    return doc
+
+
+async def sign_or_reuse(cades: LogicAbstract|RemoteLogic, chash: str, source_box: UUID,
+                        sign: Callable[[], Awaitable[SignResult]]) -> SignResult:
+    """Если такое же содержимое уже подписывалось доступным сертификатом недавно - берём ту подпись"""
+    if window := Config().sign_reuse_window:
+        async with Session() as ss:
+            if row := (await ss.execute(
+                    select(DocumentBlob.sign, Document.cert_number, Document.sign_time)
+                    .join(DocumentBlob, DocumentBlob.uuid == Document.uuid)
+                    .where(Document.content_hash == chash,
+                           Document.cert_number.in_(await cades.asigning_cert_numbers(source_box)),
+                           DocumentBlob.sign.is_not(None),
+                           Document.sign_time >= datetime.now() - timedelta(seconds=window))
+                    .order_by(Document.sign_time.desc())
+                    .limit(1))).first():
+                logger.info(f"Signature of content {chash} by {row.cert_number} is reused")
+                return SignResult(*row)
+    return await sign()
+
+
+async def find_duplicates(ss, hashes: dict[UUID, str]) -> dict[UUID, list[UUID]]:
+    """Документы с тем же содержимым под другими uuid"""
+    found: dict[str, list[UUID]] = {}
+    for uuid, chash in (await ss.execute(
+            select(Document.uuid, Document.content_hash)
+            .where(Document.content_hash.in_(set(hashes.values())),
+                   Document.status.not_in([DocumentStatus.FAIL, DocumentStatus.DEAD])))).all():
+        found.setdefault(chash, []).append(uuid)
+    for uuid, chash in hashes.items():
+        found.setdefault(chash, [])
+        if uuid not in found[chash]:
+            found[chash].append(uuid)
+
+    duplicates = {}
+    for uuid, chash in hashes.items():
+        if others := [u for u in found[chash] if u != uuid]:
+            logger.warning(f"Document {uuid} has the same content as {others}")
+            duplicates[uuid] = others
+    return duplicates
+
+
+async def accept_document(item: DocumentMeta, sr: SignResult, signed_data: bytes, chash: str) -> SignedResponse:
+    async with Session() as ss:
+        duplicates = (await find_duplicates(ss, {item.uuid: chash})).get(item.uuid)
+        status = (await ss.execute(select(Document.status).where(Document.uuid == item.uuid))).scalar()
+
+    async def restart(ws) -> bool:
+        doc = (await ws.execute(
+            select(Document).options(selectinload(Document.blob))
+            .where(Document.uuid == item.uuid).with_for_update())).scalar()
+        if not DocumentStatus.restartable(doc.status):
+            return False
+        restart_document(doc, item, sr, signed_data, chash)
+        await notify_documents(ws)
+        return True
+
+    if status is not None:
+        if DocumentStatus.restartable(status) and await write(restart):
+            wake_sender()
+            logger.info(f"Document {item.name} №{item.number} {item.uuid} was sent again")
+            return SignedResponse(status=ServiceStatus.OK,
+                                  msg='Document is restarted for send',
+                                  uuid=item.uuid,
+                                  duplicates=duplicates)
+        logger.warning(f"Document {item.name} № {item.number} {item.uuid} was received earlier already")
+        return SignedResponse(status=ServiceStatus.ALREADY,
+                              msg='Document was received earlier already',
+                              uuid=item.uuid)
+
+    # документ сразу закреплён за этим процессом, чтобы обработчик не взял его, пока идёт отправка.
+    # Сетевой обмен с ДИАДОК - вне транзакции
+    doc = new_document(item, sr, signed_data, chash)
+    doc.claimed_by = INSTANCE_ID
+    doc.lease_until = datetime.now() + timedelta(seconds=Config().sender_lease)
+
+    async def insert(ws):
+        ws.add(doc)
+        await ws.flush()
+        await ws.refresh(doc, DOCUMENT_COLUMNS)
+        ws.expunge(doc)
+
+    await write(insert)
+    try:
+        await send_document(doc)
+    except Exception as e:
+        # документ уже принят: неудачная попытка записывается как обычно, ответ совпадает с тем, что в БД
+        logger.error(f"Document {doc.uuid} is not sent: {str(e)}")
+        schedule_retry(doc, error_class(e), str(e))
+
+    if not await release_document(doc):
+        logger.warning(f"Lease of document {doc.uuid} is lost, result is not saved")
+    if doc.status in PENDING_STATUSES:
+        await write(notify_documents)
+        wake_sender()
+        msg = 'Document signed and queued for send'
+        if doc.error_msg:
+            msg += f": {doc.error_msg}"
+    elif doc.status in (DocumentStatus.FAIL, DocumentStatus.DEAD):
+        msg = f"Document signed but not sent: {doc.error_msg}"
+    else:
+        msg = 'Document signed and sent to upstream'
+
+    logger.info(f"Document {item.name} № {item.number}: {msg}")
+
+    return SignedResponse(status=ServiceStatus.OK,
+                          msg=msg,
+                          uuid=item.uuid,
+                          duplicates=duplicates)
+
+
 @router.post("/senddoc", tags=['send'])
 async def senddoc(item: DocumentRequest) -> SignedResponse:
     config = Config()
     try:
         cades = CadesLogic()
-        data = cades.prepare_data(item.data)
-        sign = cades.sign_data(data, config.pincode)
+        chash = content_hash(item.data)
+        sr = await sign_or_reuse(cades, chash, item.source_box,
+                                 lambda: cades.asign_data(cades.prepare_data(item.data), config.pincode,
+                                                          source_box=item.source_box))
+        return await accept_document(item, sr, item.data, chash)
+
+    except SignQueueFullException as e:
+        logger.warning(f"Document {item.uuid} is rejected: {str(e)}")
+        return SignedResponse(status=ServiceStatus.BUSY,
+                              msg='Sign queue is full. Try again later',
+                              uuid=item.uuid)
+    except Exception as e:
+        logger.error(f"Document {item.uuid} has errors: {str(e)}\n{traceback.format_exc()}")
+        raise HTTPException(422, str(e))
 
-        async with Session() as ss:
 
-            docs = (await ss.execute(
-                select(Document).where(Document.uuid == item.uuid).with_for_update(skip_locked=True))).scalars()
-
-            for doc in docs:
-                if doc.status == DocumentStatus.FAIL:
-                    doc.status = DocumentStatus.PROGRESS
-                    for k, v in dict(item).items():
-                        if k in ['uuid', 'data']: continue
-                        setattr(doc, k, v)
-                    doc.sign = sign
-                    doc.signed_data = item.data
-
-                    ss.add(doc)
-                    await ss.commit()
-                    await ss.refresh(doc)
-                    logger.info(f"Document {doc.name} №{doc.number} {doc.uuid} was sent again")
-                    return SignedResponse(status=ServiceStatus.OK,
-                                          msg='Document is restarted for send',
-                                          uuid=doc.uuid)
-                else:
-                    logger.warning(f"Document {item.name} № {item.number} {doc.uuid} was received earlier already")
-                    return SignedResponse(status=ServiceStatus.ALREADY,
-                                          msg='Document was received earlier already',
-                                          uuid=doc.uuid)
-            else:
-                doc = Document(**dict(filter(lambda x: x[0] != 'data', item)),
-                               sign=sign,
-                               signed_data=item.data,
-                               status=DocumentStatus.RECEIVED)
-                ss.add(doc)
-                await ss.flush()
-                await ss.refresh(doc, with_for_update=True)
+@router.post("/senddoc/stream", tags=['send'])
+async def senddoc_stream(request: Request, item: DocumentMeta = Depends()) -> SignedResponse:
+    """Отправка документа без base64 в JSON. Реквизиты передаются в query, содержимое - телом запроса
+    (application/octet-stream) или полем `file` (multipart/form-data). Тело сбрасывается во временный файл.
+    Подписывается только хэш содержимого, поэтому нужен `hash-sign`"""
+    config = Config()
+    if not config.hash_sign:
+        raise HTTPException(400, "senddoc/stream requires settings.hash-sign: true")
+    try:
+        with SpooledDocument(config.upload_spool_size, config.upload_max_size) as sd:
+            await sd.receive(request)
+            logger.debug(f"Document {item.uuid} received: {sd.size} bytes, sha256={sd.hexdigest}")
+
+            cades = CadesLogic()
+            sr = await sign_or_reuse(cades, sd.hexdigest, item.source_box,
+                                     lambda: cades.asign_file(sd.file, config.pincode, source_box=item.source_box))
+            return await accept_document(item, sr, sd.b64content(), sd.hexdigest)
+
+    except UploadTooLargeException as e:
+        raise HTTPException(413, str(e))
+    except SignQueueFullException as e:
+        logger.warning(f"Document {item.uuid} is rejected: {str(e)}")
+        return SignedResponse(status=ServiceStatus.BUSY,
+                              msg='Sign queue is full. Try again later',
+                              uuid=item.uuid)
+    except Exception as e:
+        logger.error(f"Document {item.uuid} has errors: {str(e)}\n{traceback.format_exc()}")
+        raise HTTPException(422, str(e))
+
 
-                await send_document(doc)
+@router.post("/senddocs", tags=['send'])
+async def senddocs(items: list[DocumentRequest]) -> list[SignedResponse]:
+    """Пакетная отправка. Документы подписываются параллельно и сохраняются одной транзакцией,
+    в ДИАДОК их отправляет фоновый обработчик"""
+    config = Config()
+    if len(items) > config.batch_limit:
+        raise HTTPException(413, f"Too many documents in batch: {len(items)} > {config.batch_limit}")
 
-                ss.add(doc)
-                await ss.commit()
+    results: dict[UUID, SignedResponse] = {}
+    unique: dict[UUID, DocumentRequest] = {}
+    for item in items:
+        unique.setdefault(item.uuid, item)
 
-                logger.info(f"Document {item.name} № {item.number} signed and sent to upstream")
+    try:
+        hashes = {uuid: content_hash(item.data) for uuid, item in unique.items()}
+        async with Session() as ss:
+            known = dict((await ss.execute(
+                select(Document.uuid, Document.status).where(Document.uuid.in_(unique)))).all())
+            duplicates = await find_duplicates(ss, hashes)
+
+        cades = CadesLogic()
+        signing = asyncio.Semaphore(config.sign_workers)
+
+        async def sign_item(item: DocumentRequest) -> SignResult|None:
+            async with signing:
+                try:
+                    return await sign_or_reuse(cades, hashes[item.uuid], item.source_box,
+                                               lambda: cades.asign_data(cades.prepare_data(item.data),
+                                                                        config.pincode,
+                                                                        source_box=item.source_box))
+                except SignQueueFullException as e:
+                    results[item.uuid] = SignedResponse(status=ServiceStatus.BUSY,
+                                                        msg='Sign queue is full. Try again later',
+                                                        uuid=item.uuid)
+                except Exception as e:
+                    logger.error(f"Document {item.uuid} has errors: {str(e)}")
+                    results[item.uuid] = SignedResponse(status=ServiceStatus.ERROR,
+                                                        msg=str(e),
+                                                        uuid=item.uuid)
+
+        to_sign = [item for uuid, item in unique.items()
+                   if uuid not in known or DocumentStatus.restartable(known[uuid])]
+        signs = dict(zip((item.uuid for item in to_sign),
+                         await asyncio.gather(*(sign_item(item) for item in to_sign))))
+
+        async def save(ws):
+            docs = {doc.uuid: doc for doc in (await ws.execute(
+                select(Document).options(selectinload(Document.blob))
+                .where(Document.uuid.in_(signs)).with_for_update())).scalars()}
+
+            for uuid, sr in signs.items():
+                if sr is None:
+                    continue
+                item = unique[uuid]
+                if doc := docs.get(uuid):
+                    if not DocumentStatus.restartable(doc.status):
+                        results[uuid] = SignedResponse(status=ServiceStatus.ALREADY,
+                                                       msg='Document was received earlier already',
+                                                       uuid=uuid)
+                        continue
+                    ws.add(restart_document(doc, item, sr, item.data, hashes[uuid]))
+                    results[uuid] = SignedResponse(status=ServiceStatus.OK,
+                                                   msg='Document is restarted for send',
+                                                   uuid=uuid,
+                                                   duplicates=duplicates.get(uuid))
+                else:
+                    ws.add(new_document(item, sr, item.data, hashes[uuid]))
+                    results[uuid] = SignedResponse(status=ServiceStatus.OK,
+                                                   msg='Document signed and queued for send',
+                                                   uuid=uuid,
+                                                   duplicates=duplicates.get(uuid))
+            await notify_documents(ws)
+
+        await write(save)
+        wake_sender()
 
     except Exception as e:
-        logger.error(f"Document {item.uuid} has errors: {str(e)}\n{traceback.format_exc()}")
+        logger.error(f"Batch of {len(items)} documents has errors: {str(e)}\n{traceback.format_exc()}")
         raise HTTPException(422, str(e))
 
-    return SignedResponse(status=ServiceStatus.OK,
-                          msg='Document signed and sent to upstream',
-                          uuid=item.uuid)
+    for uuid in unique:
+        results.setdefault(uuid, SignedResponse(status=ServiceStatus.ALREADY,
+                                                msg='Document was received earlier already',
+                                                uuid=uuid))
+    logger.info(f"Batch of {len(items)} documents is processed")
+    return [results[item.uuid] if unique[item.uuid] is item else
+            SignedResponse(status=ServiceStatus.ALREADY, msg='Document is duplicated in batch', uuid=item.uuid)
+            for item in items]
 
 
 @router.get("/check-relationship", tags=['contragents'])
 async def check_relationship(srcboxid: str|UUID, dstboxid: str|UUID) -> RelationStatus:
     """Получить статус клиента, может ли он участвовать в ЭДО"""
-    dd = AuthdDiadocAPI()
-    ctg = await dd.aget_ctg(srcboxid, dstboxid)
+    dd = await authd_diadoc_api()
+    ctg = await find_ctg(dd, srcboxid, dstboxid)
 
     return RelationStatus(srcboxid=srcboxid,
                           dstboxid=dstboxid,
@@ -245,22 +503,23 @@ async def check_relationship_inn_kpp(srcboxid: str|UUID, inn: str, kpp: str|None
     """Получить статус клиента по ИНН + КПП"""
 
     try:
-        dd = AuthdDiadocAPI()
-        if len(orgs := await dd.aget_orgs_by_innkpp(inn, kpp)):
-            org = orgs[0]
-            box = org.Boxes[0]
-            if boxid := box.BoxIdGuid:
-                if isinstance(ctg := await dd.aget_ctg(srcboxid, boxid), str):
-                    return RelationStatus(
-                        srcboxid=srcboxid,
-                        dstboxid=boxid,
-                        status=CounteragentStatus.NotInCounteragentList,
-                        established=False
-                    )
-                return RelationStatus(srcboxid=srcboxid,
-                                      dstboxid=boxid,
-                                      status=ctg.CurrentStatus,
-                                      established=ctg.CurrentStatus == CounteragentStatus.IsMyCounteragent)
+        dd = await authd_diadoc_api()
+        if boxid := await local_box_by_innkpp(srcboxid, inn, kpp):
+            boxid = str(boxid)
+        elif len(orgs := await dd.get_orgs_by_innkpp(inn, kpp)):
+            boxid = orgs[0].Boxes[0].BoxIdGuid
+        if boxid:
+            if isinstance(ctg := await find_ctg(dd, srcboxid, boxid), str):
+                return RelationStatus(
+                    srcboxid=srcboxid,
+                    dstboxid=boxid,
+                    status=CounteragentStatus.NotInCounteragentList,
+                    established=False
+                )
+            return RelationStatus(srcboxid=srcboxid,
+                                  dstboxid=boxid,
+                                  status=ctg.CurrentStatus,
+                                  established=ctg.CurrentStatus == CounteragentStatus.IsMyCounteragent)
         else:
             logger.warning(f"COntragent not found. INN={inn}, KPP={kpp}")
             return MsgResponse(msg="Contragent by INN/KPP not found")
@@ -272,8 +531,8 @@ async def check_relationship_inn_kpp(srcboxid: str|UUID, inn: str, kpp: str|None
 @router.get("/connected-contragents", tags=['contragents'])
 async def connected_contragents(srcboxid: str|UUID) -> list[Contragent]:
     """Получить статусы клиентов"""
-    dd = AuthdDiadocAPI()
-    if isinstance(ctgs := await dd.aget_ctgs(srcboxid), list):
+    dd = await authd_diadoc_api()
+    if isinstance(ctgs := await list_ctgs(dd, srcboxid), list):
         return [
             Contragent(inn=c.Organization.Inn,
                        kpp=c.Organization.Kpp,
@@ -1,47 +1,80 @@
-import aiohttp
 import asyncio
-from asyncio import sleep
-from datetime import datetime
-from uuid import UUID
+import os
+import socket
+from datetime import datetime, timedelta
+from uuid import UUID, uuid4
 
-from requests import Response
-from sqlalchemy import select
+from sqlalchemy import and_, func, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
 
 import logger
+from callbacks import callback_payload, enqueue_callbacks, wake_dispatcher
 from config import Config
 from const import DocumentStatus
-from db import Document, Session
-from diadoc.connector import AuthdDiadocAPI
+from counteragents import find_ctg, local_box_by_innkpp
+from db import PENDING_STATUSES, Document, Session, is_postgres, listen, notify
+from dbwriter import write
+from diadoc.aconnector import ApiResponse, authd_diadoc_api
 from diadoc.enums import DiadocDocumentType
 from diadoc.exceptions import AuthError
 from diadoc.struct import (Counteragent, DocumentAttachment, DocumentV3, Message, MessageToPost, MetadataItem,
                            SignedContent)
+from retry import Wakeup, backoff_delay
 
 
-async def run_callbacks(doc: Document):
-    try:
-        conf = Config()
-
-        async with aiohttp.ClientSession() as ss:
-            for clbk in conf.callback_urls:
-                async with ss.post(clbk,
-                                   json={"uuid"            : str(doc.uuid),
-                                         "status"          : str(doc.status),
-                                         "edo_status"      : doc.diadoc_status,
-                                         "edo_status_descr": doc.diadoc_status_descr},
-                                   ssl=False) as rsl:
-                    logger.debug(f"callback {clbk} is called for doc={str(doc.uuid)}")
-    except Exception as e:
-        logger.error(f"error while executing callback: {str(e)}")
+NOTIFY_CHANNEL = 'cades_documents'
 
+_wakeup = Wakeup()
 
-async def send_document(doc: Document) -> bool:
-    conf = Config()
 
-    if doc.tries > 5:
-        doc.status = DocumentStatus.FAIL
+def wake_sender() -> None:
+    """Разбудить обработчик этого процесса. Вызывать после commit"""
+    _wakeup.set()
+
+
+async def notify_documents(ss: AsyncSession) -> None:
+    """Разбудить обработчики в других процессах (только PG). Вызывать до commit"""
+    await notify(ss, NOTIFY_CHANNEL)
+
+
+# Классы ошибок для настройки повторов (секция retry в cades.yaml)
+ERR_AUTH = 'auth'
+ERR_LOOKUP = 'lookup'
+ERR_NETWORK = 'network'
+ERR_THROTTLED = 'throttled'
+ERR_SERVER = 'server'
+
+
+def error_class(e: Exception) -> str:
+    """Класс повтора для исключения, которое send_document не разобрал сам"""
+    return ERR_AUTH if isinstance(e, AuthError) else ERR_NETWORK
+
+
+def schedule_retry(doc: Document, error_class: str, msg: str|bytes) -> bool:
+    """Запланировать следующую попытку с экспоненциальной задержкой. Если попытки исчерпаны - документ
+    переходит в DEAD и больше не выбирается обработчиком. Возвращает True, если статус стал окончательным"""
+    policy = Config().retry_policy(error_class)
+    now = datetime.now()
+
+    doc.tries += 1
+    doc.error_msg = (msg.decode(errors='replace') if isinstance(msg, bytes) else str(msg))[:512]
+    doc.last_error_at = now
+
+    if doc.tries >= policy['max-tries']:
+        doc.status = DocumentStatus.DEAD
+        doc.next_attempt_at = None
+        logger.error(f"Document {doc.uuid} is dead after {doc.tries} tries: {doc.error_msg}")
         return True
 
+    doc.next_attempt_at = now + backoff_delay(policy, doc.tries)
+    logger.warning(f"Document {doc.uuid} ({error_class}) will be retried at {doc.next_attempt_at}: {doc.error_msg}")
+    return False
+
+
+async def send_document(doc: Document) -> bool:
+    conf = Config()
+
     if conf.fake_logic:
         doc.status = DocumentStatus.FAKELY_SENT
         doc.error_msg = "The document was sent fakely"
@@ -51,24 +84,26 @@ async def send_document(doc: Document) -> bool:
     doc.status = DocumentStatus.PROGRESS
 
     try:
-        dda = AuthdDiadocAPI()
+        dda = await authd_diadoc_api()
     except Exception as e:
-        doc.error_msg = str(e)
-        doc.tries += 1
-        return False
+        return schedule_retry(doc, ERR_AUTH, str(e))
 
     sbox = doc.source_box
-    if not (dbox := doc.dest_box):
-        orgs = dda.get_orgs_by_innkpp(doc.dest_inn, doc.dest_kpp)
-        if not len(orgs):
-            doc.tries += 1
-            doc.error_msg = f"You can't send document to {doc.dest_inn}/{doc.dest_kpp}"
-            return False
+    try:
+        if not (dbox := doc.dest_box) and \
+                not (dbox := await local_box_by_innkpp(sbox, doc.dest_inn, doc.dest_kpp)):
+            orgs = await dda.get_orgs_by_innkpp(doc.dest_inn, doc.dest_kpp)
+            if not len(orgs):
+                return schedule_retry(doc, ERR_LOOKUP, f"You can't send document to {doc.dest_inn}/{doc.dest_kpp}")
+
+            org = orgs[0]
+            dbox = org.Boxes[0].BoxIdGuid
 
-        org = orgs[0]
-        dbox = org.Boxes[0].BoxIdGuid
+        ctg = await find_ctg(dda, sbox, dbox)
+    except Exception as e:
+        return schedule_retry(doc, ERR_NETWORK, str(e))
 
-    if isinstance(ctg := dda.get_ctg(sbox, dbox), Counteragent):
+    if isinstance(ctg, Counteragent):
         try:
             sc = SignedContent(Content=doc.signed_data,
                                Signature=doc.sign,
@@ -88,14 +123,15 @@ async def send_document(doc: Document) -> bool:
 
             postmsg = MessageToPost(
                 FromBoxId=str(sbox),
-                ToBoxId=dbox,
+                ToBoxId=str(dbox),
                 DocumentAttachments=[da]
             )
 
-            if isinstance(msg := await dda.apost_message(postmsg), Message):
+            if isinstance(msg := await dda.post_message(postmsg), Message):
                 logger.info(msg)
                 doc.status = DocumentStatus.SENT  # тут надо сделать проверку, какой ответ получили
                 doc.error_msg = None
+                doc.next_attempt_at = None
                 doc.send_time = datetime.now()
                 doc.message_id = UUID(msg.MessageId)
                 if ent := next((e for e in msg.Entities if e['EntityType'] == 'Attachment'), None):
@@ -105,51 +141,161 @@ async def send_document(doc: Document) -> bool:
                     doc.diadoc_status_descr = doc_struct.DocflowStatus.PrimaryStatus.StatusText
                     return True
 
-            elif isinstance(msg, Response):
-                if msg.status_code not in (200, 201):
+            elif isinstance(msg, ApiResponse):
+                if msg.status_code == 429:
+                    return schedule_retry(doc, ERR_THROTTLED, msg.content)
+                elif msg.status_code >= 500:
+                    return schedule_retry(doc, ERR_SERVER, msg.content)
+                elif msg.status_code not in (200, 201):
                     logger.error(msg.content)
                     doc.status = DocumentStatus.FAIL
                     doc.error_msg = msg.content
+                    doc.last_error_at = datetime.now()
                     return True
                 else:
                     logger.info(msg.content)
 
         except Exception as e:
-            doc.tries += 1
-            doc.error_msg = str(e)
-            logger.error(doc.error_msg)
+            return schedule_retry(doc, ERR_NETWORK, str(e))
 
     elif isinstance(ctg, str):
         doc.status = DocumentStatus.FAIL
         doc.error_msg = f"Ошибка: {ctg}"
-        doc.tries = 5
+        doc.last_error_at = datetime.now()
         return True
 
     return False
 
 
-async def handle_documents() -> None:
+def due_condition():
+    return and_(Document.status.in_(PENDING_STATUSES),
+                or_(Document.next_attempt_at.is_(None),
+                    Document.next_attempt_at <= datetime.now()))
+
+
+# Поля, которые меняет send_document. Только их записываем обратно после отправки
+SEND_RESULT_FIELDS = ('status', 'tries', 'error_msg', 'next_attempt_at', 'last_error_at', 'send_time',
+                      'message_id', 'entity_id', 'diadoc_status', 'diadoc_status_descr')
+
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+
+
+async def claim_documents(limit: int) -> list[UUID]:
+    """Короткая транзакция: пометить до limit готовых к отправке документов как взятые этим процессом"""
+    conf = Config()
+    now = datetime.now()
+
+    async def claim(ss: AsyncSession) -> list[UUID]:
+        uuids = (await ss.execute(select(Document.uuid)
+                                  .where(due_condition(),
+                                         or_(Document.lease_until.is_(None), Document.lease_until < now))
+                                  .limit(limit)
+                                  .with_for_update(skip_locked=True))).scalars().all()
+        if uuids:
+            await ss.execute(update(Document)
+                             .where(Document.uuid.in_(uuids))
+                             .values(claimed_by=INSTANCE_ID,
+                                     lease_until=now + timedelta(seconds=conf.sender_lease)))
+        return uuids
+
+    return await write(claim)
+
+
+async def release_document(doc_or_uuid: Document|UUID, notify: bool = False) -> bool:
+    """Снять пометку и, если передан документ, записать результат отправки.
+    notify - в той же транзакции поставить уведомления о смене статуса.
+    False - аренду уже перехватил другой процесс"""
+    values = {'claimed_by': None, 'lease_until': None}
+    if isinstance(doc_or_uuid, Document):
+        uuid = doc_or_uuid.uuid
+        values.update({f: getattr(doc_or_uuid, f) for f in SEND_RESULT_FIELDS})
+    else:
+        uuid = doc_or_uuid
+
+    async def release(ss: AsyncSession) -> bool:
+        res = await ss.execute(update(Document)
+                               .where(Document.uuid == uuid, Document.claimed_by == INSTANCE_ID)
+                               .values(**values))
+        if notify and res.rowcount > 0:
+            await enqueue_callbacks(ss, [callback_payload(doc_or_uuid)])
+        return res.rowcount > 0
+
+    released = await write(release)
+    if notify:
+        wake_dispatcher()
+    return released
+
+
+async def process_document(uuid: UUID) -> None:
+    """Отправка одного документа. Сетевой обмен с ДИАДОК идёт вне транзакции"""
+    async with Session() as ss:
+        doc = (await ss.execute(select(Document).options(selectinload(Document.blob))
+                                .where(Document.uuid == uuid, Document.claimed_by == INSTANCE_ID))).scalar()
+        if not doc:
+            return
+        ss.expunge(doc)
+
+    try:
+        t = await send_document(doc)
+    except Exception as e:
+        # без записи попытки документ сразу взяли бы снова - считаем её неудачной и откладываем
+        t = schedule_retry(doc, error_class(e), str(e))
+        await release_document(doc, notify=t)
+        raise
+
+    if not await release_document(doc, notify=t):
+        logger.warning(f"Lease of document {uuid} is lost, result is not saved")
+
+
+async def document_worker(queue: asyncio.Queue) -> None:
     while True:
+        uuid = await queue.get()
         try:
-            async with Session() as ss:
-                docs = await ss.execute(select(Document)
-                                        .where(Document.status.in_([DocumentStatus.RECEIVED,
-                                                                    DocumentStatus.PROGRESS]))
-                                        .with_for_update(skip_locked=True))
-                for doc in docs.scalars():
-                    t = await send_document(doc)
-                    ss.add(doc)
-                    if t:
-                        await run_callbacks(doc)
-
-                await ss.commit()
+            await process_document(uuid)
         except AuthError as e:
             logger.error(f'Cant login into diadoc: {str(e)}')
         except Exception as e:
-            logger.error(str(e))
+            logger.error(f"Document {uuid} is not processed: {str(e)}")
+        finally:
+            queue.task_done()
+
+
+async def handle_documents() -> None:
+    conf = Config()
+    queue = asyncio.Queue()
+    wakeup = _wakeup.event
+    workers = [asyncio.create_task(document_worker(queue))
+               for _ in range(conf.sender_concurrency)]
+    try:
+        while True:
+            wakeup.clear()
+            try:
+                while uuids := await claim_documents(conf.sender_batch_size):
+                    for uuid in uuids:
+                        queue.put_nowait(uuid)
+                    await queue.join()
+
+                async with Session() as ss:
+                    next_attempt = (await ss.execute(select(func.min(Document.next_attempt_at))
+                                                     .where(Document.status.in_(PENDING_STATUSES)))).scalar()
+            except Exception as e:
+                logger.error(str(e))
+                next_attempt = None
 
-        await sleep(60)
+            timeout = conf.sender_poll_interval
+            if next_attempt:
+                timeout = max(0.0, min(timeout, (next_attempt - datetime.now()).total_seconds()))
+            try:
+                # новые документы будят обработчик сразу, опрос по таймеру остаётся как запасной вариант
+                await asyncio.wait_for(wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        for w in workers:
+            w.cancel()
 
 
 async def init_repeat_task() -> None:
     asyncio.create_task(handle_documents())
+    if is_postgres:
+        asyncio.create_task(listen(NOTIFY_CHANNEL, wake_sender, Config().sender_poll_interval))
@@ -0,0 +1,459 @@
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import itertools
+import json
+import multiprocessing
+import os
+import secrets
+import socket
+import struct
+import sys
+from base64 import b64decode, b64encode
+from datetime import datetime
+from tempfile import SpooledTemporaryFile
+from time import monotonic, sleep
+from typing import BinaryIO, Iterable, Iterator
+from uuid import UUID
+
+from config import Config
+from logger import formatter, logger
+from logic import (HASH_CHUNK_SIZE, Logic, LogicMock, NoAvailableCertificateException, SignQueueFullException,
+                   SignResult)
+from tools import restrict_to_owner
+
+
+# кадр: длина (4 байта, big-endian) + JSON
+HEADER = struct.Struct('>I')
+# сколько ждать, пока запущенный демон начнёт принимать соединения
+READY_TIMEOUT = 30
+# сколько клиенту даётся на ответ на вызов при подключении
+AUTH_TIMEOUT = 5
+
+
+class SignDaemonError(Exception): ...
+
+
+# исключения, которые демон передаёт клиенту как есть
+REMOTE_ERRORS = {e.__name__: e for e in (NoAvailableCertificateException, SignQueueFullException, ValueError)}
+
+
+def tcp_address(address: str) -> tuple[str, int]|None:
+    """'127.0.0.1:8765' -> ('127.0.0.1', 8765), путь к unix-сокету -> None"""
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        return host, int(port)
+
+
+def ensure_key(path: str) -> bytes:
+    """Ключ демона. Создаётся при первом запуске, читать его может только учётная запись сервиса"""
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        pass
+    else:
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32))
+    restrict_to_owner(path)
+    return read_key(path)
+
+
+def read_key(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        if key := f.read().strip():
+            return key
+    raise SignDaemonError(f"Sign daemon key {path} is empty")
+
+
+def auth_digest(key: bytes, challenge: str) -> str:
+    return hmac.new(key, challenge.encode(), hashlib.sha256).hexdigest()
+
+
+def pack_frame(msg: dict) -> bytes:
+    data = json.dumps(msg, ensure_ascii=False).encode()
+    return HEADER.pack(len(data)) + data
+
+
+async def read_frame(reader: asyncio.StreamReader) -> dict:
+    size, = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return json.loads(await reader.readexactly(size))
+
+
+def read_frame_sync(fh: BinaryIO) -> dict:
+    if len(header := fh.read(HEADER.size)) < HEADER.size:
+        raise SignDaemonError("Connection to sign daemon is lost")
+    size, = HEADER.unpack(header)
+    return json.loads(fh.read(size))
+
+
+async def open_connection(address: str, key: bytes) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    """Соединение с демоном: демон присылает вызов, клиент отвечает HMAC от него на общем ключе"""
+    if tcp := tcp_address(address):
+        reader, writer = await asyncio.open_connection(*tcp)
+    else:
+        reader, writer = await asyncio.open_unix_connection(address)
+    try:
+        challenge = (await read_frame(reader))['challenge']
+        writer.write(pack_frame({'auth': auth_digest(key, challenge)}))
+        await writer.drain()
+        if (await read_frame(reader)).get('auth') is not True:
+            raise SignDaemonError("Sign daemon rejected the key")
+    except (asyncio.IncompleteReadError, KeyError) as e:
+        writer.close()
+        raise SignDaemonError(f"Sign daemon rejected the key: {e!r}")
+    except Exception:
+        writer.close()
+        raise
+    return reader, writer
+
+
+def cert_info(cert) -> dict:
+    return {'number': str(cert.SerialNumber), 'subject': str(cert.SubjectName), 'valid_to': str(cert.ValidToDate)}
+
+
+class SignDaemon:
+    """Единственный процесс, который открывает хранилище сертификатов (pycades.Store / CAdESCOM).
+    Воркеры API подписывают через него по unix-сокету (на Windows - TCP на localhost).
+    Каждое соединение начинается с проверки общего ключа (вызов - ответ), без неё запросы не принимаются.
+    Запросы на одном соединении конвейеризуются: ответ уходит, как только готов, клиент сопоставляет его по id.
+    Файл для sign_file приходит следом за запросом кадрами {"id", "data"} до {"id", "eof"} и сбрасывается
+    во временный файл, как загрузка в API"""
+
+    def __init__(self, address: str|None = None):
+        conf = Config()
+        self.address = address or conf.sign_daemon
+        self.key_file = conf.sign_daemon_key
+        self.logic = LogicMock() if conf.fake_logic else Logic()
+
+    async def serve(self):
+        # без ключа демон не слушает: иначе подписать мог бы любой, кто достучится до порта
+        self.key = ensure_key(self.key_file)
+        if tcp := tcp_address(self.address):
+            if not is_loopback(tcp[0]):
+                raise SignDaemonError(f"Sign daemon listens on localhost only, not on {tcp[0]}")
+            server = await asyncio.start_server(self.handle, *tcp)
+        else:
+            if os.path.exists(self.address):
+                os.remove(self.address)  # остался от прошлого запуска
+            server = await asyncio.start_unix_server(self.handle, self.address)
+            os.chmod(self.address, 0o600)
+        logger.info(f"Sign daemon is listening on {self.address}")
+        async with server:
+            await server.serve_forever()
+
+    async def authenticate(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+        challenge = secrets.token_hex(16)
+        try:
+            writer.write(pack_frame({'challenge': challenge}))
+            await writer.drain()
+            msg = await asyncio.wait_for(read_frame(reader), AUTH_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            msg = None
+        digest = str(msg.get('auth', '')) if isinstance(msg, dict) else ''
+        if hmac.compare_digest(digest.encode(), auth_digest(self.key, challenge).encode()):
+            writer.write(pack_frame({'auth': True}))
+            await writer.drain()
+            return True
+        logger.warning(f"Sign daemon client {writer.get_extra_info('peername') or ''} is not authenticated")
+        return False
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if not await self.authenticate(reader, writer):
+            writer.close()
+            return
+
+        lock = asyncio.Lock()
+        tasks = set()
+        uploads: dict[int, tuple[dict, SpooledTemporaryFile]] = {}
+
+        async def serve(req: dict, fh: SpooledTemporaryFile|None = None):
+            try:
+                params = req.get('params') or {}
+                if fh:
+                    params['fh'] = fh
+                resp = {'id': req['id'], 'result': await self.call(req['method'], params)}
+            except Exception as e:
+                resp = {'id': req['id'], 'error': {'type': type(e).__name__, 'msg': str(e)}}
+            finally:
+                if fh:
+                    fh.close()
+            async with lock:
+                writer.write(pack_frame(resp))
+                await writer.drain()
+
+        def start(req: dict, fh: SpooledTemporaryFile|None = None):
+            task = asyncio.create_task(serve(req, fh))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        try:
+            while True:
+                req = await read_frame(reader)
+                if upload := uploads.get(req['id']):
+                    if req.get('eof'):
+                        del uploads[req['id']]
+                        start(*upload)
+                    else:
+                        # запись может уйти на диск - не в цикле событий
+                        await asyncio.to_thread(upload[1].write, b64decode(req['data']))
+                elif req.get('method') == 'sign_file':
+                    uploads[req['id']] = req, SpooledTemporaryFile(max_size=Config().upload_spool_size)
+                else:
+                    start(req)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            for _, fh in uploads.values():
+                fh.close()
+            writer.close()
+
+    async def call(self, method: str, params: dict):
+        if not (fn := getattr(self, f"do_{method}", None)):
+            raise SignDaemonError(f"Unknown method {method}")
+        return await fn(**params)
+
+    @staticmethod
+    def sign_result(sr: SignResult) -> dict:
+        return {'sign': b64encode(sr.sign).decode('ascii'),
+                'cert_number': str(sr.cert_number),
+                'sign_time': sr.sign_time.isoformat()}
+
+    async def do_sign(self, data: str, text: bool = False, key_pin: str|None = None,
+                      detached_sign: bool = True, source_box: str|None = None) -> dict:
+        content = data if text else b64decode(data)
+        return self.sign_result(await self.logic.asign_data(self.logic.prepare_data(content), key_pin,
+                                                            detached_sign, source_box))
+
+    async def do_sign_file(self, fh: SpooledTemporaryFile, key_pin: str|None = None, detached_sign: bool = True,
+                           source_box: str|None = None) -> dict:
+        # с hash-sign файл хэшируется кусками, целиком в память не читается
+        return self.sign_result(await self.logic.asign_file(fh, key_pin, detached_sign, source_box))
+
+    async def do_certs(self, query: str|None = None) -> list[dict]:
+        return [cert_info(c) for c in await self.logic.afind_cert(query)]
+
+    async def do_default_cert(self) -> dict:
+        return cert_info(await self.logic.adefault_cert())
+
+    async def do_set_default_cert(self, number: str):
+        await self.logic.aset_default_cert(number)
+
+    async def do_signing_cert_numbers(self, source_box: str|None = None) -> list[str]:
+        return [str(n) for n in await self.logic.asigning_cert_numbers(source_box)]
+
+    async def do_refresh_certs(self):
+        await self.logic.in_store(self.logic.refresh_certs)
+
+
+class SignDaemonProcess(multiprocessing.Process):
+    """Демон подписи как дочерний процесс сервера API"""
+
+    def __init__(self):
+        super().__init__(name='cades-signd', daemon=True)
+
+    def run(self):
+        asyncio.run(SignDaemon().serve())
+
+    def start(self):
+        super().start()
+        conf = Config()
+        address = conf.sign_daemon
+        deadline = monotonic() + READY_TIMEOUT
+        while monotonic() < deadline and self.is_alive():
+            try:
+                # ключ создаёт демон при запуске
+                with connect(address, read_key(conf.sign_daemon_key)):
+                    return
+            except (OSError, SignDaemonError):
+                sleep(0.2)
+        logger.warning(f"Sign daemon does not answer on {address} yet")
+
+    def stop(self):
+        self.terminate()
+
+
+def is_loopback(host: str) -> bool:
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return host == 'localhost'
+
+
+def connect(address: str, key: bytes) -> socket.socket:
+    """Синхронное соединение с демоном, с той же проверкой ключа, что и open_connection"""
+    if tcp := tcp_address(address):
+        sock = socket.create_connection(tcp)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+    try:
+        with sock.makefile('rb') as fh:
+            challenge = read_frame_sync(fh)['challenge']
+            sock.sendall(pack_frame({'auth': auth_digest(key, challenge)}))
+            if read_frame_sync(fh).get('auth') is not True:
+                raise SignDaemonError("Sign daemon rejected the key")
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+class RemoteCert:
+    """Сертификат в описании демона. Атрибуты - как у объектов CAdESCOM"""
+
+    def __init__(self, number: str, subject: str, valid_to: str):
+        self.SerialNumber = number
+        self.SubjectName = subject
+        self.ValidToDate = valid_to
+
+    def __repr__(self):
+        return f"<RemoteCert number={self.SerialNumber}>"
+
+
+class RemoteLogic:
+    """Подпись через демон (signd). Повторяет ту часть LogicAbstract, которой пользуется API,
+    так что воркеров uvicorn может быть несколько - токен открыт только в демоне"""
+
+    def __init__(self, address: str|None = None):
+        conf = Config()
+        self.address = address or conf.sign_daemon
+        self.key_file = conf.sign_daemon_key
+        self._ids = itertools.count(1)
+        self._loop = None
+        self._lock: asyncio.Lock|None = None
+        self._writer: asyncio.StreamWriter|None = None
+        # ожидающие ответа запросы - у каждого соединения свои
+        self._pending: dict[int, asyncio.Future] = {}
+
+    async def _connection(self) -> tuple[asyncio.StreamWriter, dict[int, asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop, self._lock, self._writer = loop, asyncio.Lock(), None
+        async with self._lock:
+            if self._writer is None or self._writer.is_closing():
+                key = await asyncio.to_thread(read_key, self.key_file)
+                reader, self._writer = await open_connection(self.address, key)
+                self._pending = {}
+                loop.create_task(self._read(reader, self._writer, self._pending))
+        return self._writer, self._pending
+
+    async def _read(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                    pending: dict[int, asyncio.Future]):
+        try:
+            while True:
+                resp = await read_frame(reader)
+                if (fut := pending.get(resp['id'])) and not fut.done():
+                    if err := resp.get('error'):
+                        fut.set_exception(REMOTE_ERRORS.get(err['type'], SignDaemonError)(err['msg']))
+                    else:
+                        fut.set_result(resp.get('result'))
+        except Exception as e:
+            logger.warning(f"Connection to sign daemon is lost: {str(e)}")
+        finally:
+            writer.close()
+            # ответы на этом соединении уже не придут. Запросы, отправленные в новое соединение, не трогаем
+            for fut in pending.values():
+                if not fut.done():
+                    fut.set_exception(SignDaemonError("Connection to sign daemon is lost"))
+
+    async def call(self, method: str, chunks: Iterable[bytes]|None = None, **params):
+        """chunks - содержимое для sign_file, уходит кадрами после запроса"""
+        writer, pending = await self._connection()
+        rid = next(self._ids)
+        pending[rid] = fut = asyncio.get_running_loop().create_future()
+        try:
+            writer.write(pack_frame({'id': rid, 'method': method, 'params': params}))
+            await writer.drain()
+            if chunks is not None:
+                for chunk in chunks:
+                    writer.write(pack_frame({'id': rid, 'data': b64encode(chunk).decode('ascii')}))
+                    await writer.drain()
+                writer.write(pack_frame({'id': rid, 'eof': True}))
+                await writer.drain()
+            return await fut
+        finally:
+            pending.pop(rid, None)
+
+    def call_sync(self, method: str, **params):
+        """Для синхронных свойств (сертификаты): отдельное короткое соединение. Блокирует поток -
+        в async-коде нужны варианты с префиксом a"""
+        with connect(self.address, read_key(self.key_file)) as sock:
+            sock.sendall(pack_frame({'id': 0, 'method': method, 'params': params}))
+            with sock.makefile('rb') as fh:
+                resp = read_frame_sync(fh)
+        if err := resp.get('error'):
+            raise REMOTE_ERRORS.get(err['type'], SignDaemonError)(err['msg'])
+        return resp.get('result')
+
+    @staticmethod
+    def sign_result(res: dict) -> SignResult:
+        return SignResult(b64decode(res['sign']), res['cert_number'], datetime.fromisoformat(res['sign_time']))
+
+    async def asign_data(self, data: str|bytes, key_pin: str|None = None, detached_sign: bool = True,
+                         source_box: UUID|str|None = None) -> SignResult:
+        text = isinstance(data, str)
+        return self.sign_result(await self.call('sign', data=data if text else b64encode(data).decode('ascii'),
+                                                text=text, key_pin=key_pin, detached_sign=detached_sign,
+                                                source_box=str(source_box) if source_box else None))
+
+    async def asign_file(self, fh: BinaryIO, key_pin: str|None = None, detached_sign: bool = True,
+                         source_box: UUID|str|None = None) -> SignResult:
+        """Файл уходит демону кусками: ни здесь, ни в демоне он не читается в память целиком"""
+        fh.seek(0)
+        return self.sign_result(await self.call('sign_file', chunks=iter(lambda: fh.read(HASH_CHUNK_SIZE), b''),
+                                                key_pin=key_pin, detached_sign=detached_sign,
+                                                source_box=str(source_box) if source_box else None))
+
+    def prepare_data(self, data: str|bytes) -> str|bytes:
+        # преобразует демон - ему известна платформа криптопровайдера
+        return data
+
+    async def asigning_cert_numbers(self, source_box: UUID|str|None = None) -> list[str]:
+        return await self.call('signing_cert_numbers', source_box=str(source_box) if source_box else None)
+
+    def signing_cert_numbers(self, source_box: UUID|str|None = None) -> list[str]:
+        return self.call_sync('signing_cert_numbers', source_box=str(source_box) if source_box else None)
+
+    async def afind_cert(self, number_or_subject: str|None = None) -> list[RemoteCert]:
+        return [RemoteCert(**c) for c in await self.call('certs', query=number_or_subject)]
+
+    async def aactual_certs(self) -> list[RemoteCert]:
+        return await self.afind_cert()
+
+    async def adefault_cert(self) -> RemoteCert:
+        return RemoteCert(**await self.call('default_cert'))
+
+    async def aset_default_cert(self, value: str|RemoteCert):
+        await self.call('set_default_cert', number=value.SerialNumber if isinstance(value, RemoteCert) else value)
+
+    def find_cert(self, number_or_subject: str|None = None) -> Iterator[RemoteCert]:
+        for c in self.call_sync('certs', query=number_or_subject):
+            yield RemoteCert(c['number'], c['subject'], c['valid_to'])
+
+    @property
+    def actual_certs(self) -> Iterator[RemoteCert]:
+        return self.find_cert()
+
+    @property
+    def default_cert(self) -> RemoteCert:
+        c = self.call_sync('default_cert')
+        return RemoteCert(c['number'], c['subject'], c['valid_to'])
+
+    @default_cert.setter
+    def default_cert(self, value: str|RemoteCert):
+        self.call_sync('set_default_cert', number=value.SerialNumber if isinstance(value, RemoteCert) else value)
+
+    def refresh_certs(self):
+        self.call_sync('refresh_certs')
+
+
+if __name__ == '__main__':
+    import logging
+
+    stm_h = logging.StreamHandler(sys.stdout)
+    stm_h.setFormatter(formatter)
+    logger.addHandler(stm_h)
+    asyncio.run(SignDaemon().serve())
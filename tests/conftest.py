@@ -0,0 +1,62 @@
+"""Тесты работают с временной SQLite-базой. Config читает cades.yaml из текущего каталога,
+а db создаёт engine при импорте, поэтому каталог и конфиг готовятся до импорта модулей сервиса"""
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WORKDIR = tempfile.mkdtemp(prefix='cades-tests-')
+os.chdir(WORKDIR)
+with open('cades.yaml', 'w') as f:
+    yaml.dump({'users': {'admin': 'admin123'},
+               'whitelist': ['127.0.0.1'],
+               'settings': {'fake-logic': True, 'certnumber': '', 'pincode': ''},
+               'diadoc': {'client-id': None, 'url': None, 'login': None, 'password': None},
+               'callbacks': None,
+               'db-connection-string': f"sqlite+aiosqlite:///{os.path.join(WORKDIR, 'cades.db')}"}, f)
+
+from config import Config  # noqa: E402
+from db import Callback, Document, DocumentBlob, create_tables, engine  # noqa: E402
+
+
+def run(coro):
+    """asyncio.run с закрытием соединений: они привязаны к циклу событий, который завершится"""
+    async def main():
+        try:
+            return await coro
+        finally:
+            await engine.dispose()
+
+    return asyncio.run(main())
+
+
+@pytest.fixture(scope='session')
+def tables():
+    asyncio.run(create_tables())
+
+
+@pytest.fixture
+def db(tables):
+    yield
+    from sqlalchemy import delete
+
+    async def clean():
+        async with engine.begin() as cnx:
+            for model in (Callback, DocumentBlob, Document):
+                await cnx.execute(delete(model))
+
+    run(clean())
+
+
+@pytest.fixture
+def config(monkeypatch):
+    """Config() с откатом изменений после теста"""
+    conf = Config()
+    monkeypatch.setattr(conf, '_data', dict(conf._data))
+    return conf
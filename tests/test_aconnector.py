@@ -0,0 +1,49 @@
+import json
+import os
+from time import time
+
+import pytest
+
+from conftest import run
+from diadoc.aconnector import AuthContainer
+from singleton import Singleton
+
+
+@pytest.fixture
+def auth(config, tmp_path, monkeypatch):
+    config._data['diadoc'] = dict(config._data['diadoc'], **{'token-file': str(tmp_path / 'diadoc.token')})
+    monkeypatch.delitem(Singleton._instances, AuthContainer, raising=False)
+    auth = AuthContainer()
+    yield auth
+    Singleton._instances.pop(AuthContainer, None)
+
+
+def write_token(auth: AuthContainer, token: str, mtime: int):
+    with open(auth.conf.diadoc_token_file, 'w') as f:
+        json.dump({'key': auth.token_key, 'token': token, 'issued_at': time()}, f)
+    os.utime(auth.conf.diadoc_token_file, ns=(mtime, mtime))
+
+
+def test_token_file_is_read_only_when_changed(auth, monkeypatch):
+    reads = []
+    load_token = auth.load_token
+    monkeypatch.setattr(auth, 'load_token', lambda: reads.append(1) or load_token())
+
+    assert auth.api_token is None
+    assert not run(auth.has_fresh_token(None))
+
+    write_token(auth, 'first', 1_000_000_000)
+    assert run(auth.has_fresh_token(None))
+    assert run(auth.has_fresh_token(None))
+    assert auth.api_token == 'first' and len(reads) == 1
+
+    write_token(auth, 'second', 2_000_000_000)
+    assert run(auth.has_fresh_token('first'))
+    assert auth.api_token == 'second' and len(reads) == 2
+
+
+def test_saved_token_is_not_read_back(auth, monkeypatch):
+    auth.api_token = 'own'
+    auth.save_token()
+    monkeypatch.setattr(auth, 'load_token', lambda: pytest.fail('token file is read again'))
+    assert run(auth.has_fresh_token(None))
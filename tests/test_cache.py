@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+from diadoc.cache import LookupCache
+from singleton import Singleton
+
+
+@pytest.fixture
+def cache(config, monkeypatch):
+    monkeypatch.delitem(Singleton._instances, LookupCache, raising=False)
+    yield LookupCache()
+    Singleton._instances.pop(LookupCache, None)
+
+
+class Loader:
+    def __init__(self, value=None, found: bool|None = True, delay: float = 0.01):
+        self.value, self.found, self.delay = value, found, delay
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if isinstance(self.value, Exception):
+            raise self.value
+        return self.value, self.found
+
+
+def test_concurrent_gets_share_one_load(cache):
+    loader = Loader('org')
+
+    async def main():
+        return await asyncio.gather(*(cache.get('inn', loader) for _ in range(10)))
+
+    assert asyncio.run(main()) == ['org'] * 10
+    assert loader.calls == 1
+    assert asyncio.run(cache.get('inn', loader)) == 'org'
+    assert loader.calls == 1
+
+
+def test_cancelled_caller_does_not_cancel_load(cache):
+    loader = Loader('org', delay=0.05)
+
+    async def main():
+        first = asyncio.create_task(cache.get('inn', loader))
+        second = asyncio.create_task(cache.get('inn', loader))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second, first.cancelled()
+
+    assert asyncio.run(main()) == ('org', True)
+    assert loader.calls == 1
+
+
+def test_errors_are_shared_but_not_cached(cache):
+    loader = Loader(RuntimeError('diadoc is down'))
+
+    async def main():
+        return await asyncio.gather(*(cache.get('inn', loader) for _ in range(3)), return_exceptions=True)
+
+    assert all(isinstance(e, RuntimeError) for e in asyncio.run(main()))
+    assert loader.calls == 1
+
+    loader.value = 'org'
+    assert asyncio.run(cache.get('inn', loader)) == 'org'
+    assert loader.calls == 2
+
+
+def test_unknown_result_is_not_cached(cache):
+    loader = Loader(None, found=None)
+    asyncio.run(cache.get('inn', loader))
+    asyncio.run(cache.get('inn', loader))
+    assert loader.calls == 2
@@ -0,0 +1,100 @@
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from sqlalchemy import delete
+
+from callbacks import claim_batch, claim_callbacks
+from conftest import run
+from const import CallbackStatus
+from db import Callback, Session
+
+
+def new_callback(url: str = 'http://a', **values) -> Callback:
+    values = {'doc_uuid': uuid4(), 'url': url, 'payload': '{}', 'status': CallbackStatus.PENDING, 'tries': 0,
+              'created_at': datetime.now(), **values}
+    return Callback(**values)
+
+
+async def add(*rows: Callback):
+    async with Session() as ss:
+        ss.add_all(rows)
+        await ss.commit()
+
+
+async def delivered(*rows: Callback):
+    async with Session() as ss:
+        await ss.execute(delete(Callback).where(Callback.id.in_([r.id for r in rows])))
+        await ss.commit()
+
+
+def test_claim_callbacks_limit(db):
+    async def scenario():
+        await add(*[new_callback() for _ in range(5)])
+        return [[cb.id for cb in await claim_callbacks(limit, [])] for limit in (3, 3, 3)]
+
+    first, second, third = run(scenario())
+    assert len(first) == 3 and first == sorted(first)
+    # взятые в аренду не выдаются повторно, пока она не истекла
+    assert len(second) == 2 and not set(first) & set(second)
+    assert third == []
+
+
+def test_claim_callbacks_skips_batched_and_not_due(db):
+    now = datetime.now()
+    due = uuid4()
+
+    async def scenario():
+        await add(new_callback('http://batched'),
+                  new_callback(next_attempt_at=now + timedelta(minutes=5)),
+                  new_callback(status=CallbackStatus.DEAD),
+                  new_callback(doc_uuid=due, next_attempt_at=now - timedelta(seconds=1)))
+        return await claim_callbacks(10, ['http://batched'])
+
+    claimed, = run(scenario())
+    assert claimed.doc_uuid == due
+
+
+def test_claim_callbacks_one_in_flight_per_document(db):
+    doc = uuid4()
+
+    async def scenario():
+        await add(*[new_callback(doc_uuid=doc, payload=f'{{"n": {n}}}') for n in range(3)],
+                  new_callback(url='http://b', doc_uuid=doc))
+        first = await claim_callbacks(10, [])
+        # пока первое в доставке, следующие для того же документа и URL не выдаются
+        blocked = await claim_callbacks(10, [])
+        await delivered(*first)
+        return first, blocked, await claim_callbacks(10, [])
+
+    first, blocked, second = run(scenario())
+    assert sorted((cb.url, cb.payload) for cb in first) == [('http://a', '{"n": 0}'), ('http://b', '{}')]
+    assert blocked == []
+    assert [cb.payload for cb in second] == ['{"n": 1}']
+
+
+def test_claim_callbacks_waits_for_earlier_retry(db):
+    doc = uuid4()
+    now = datetime.now()
+
+    async def scenario():
+        await add(new_callback(doc_uuid=doc, tries=1, next_attempt_at=now + timedelta(minutes=5)),
+                  new_callback(doc_uuid=doc),
+                  new_callback(doc_uuid=doc, status=CallbackStatus.DEAD, payload='dead'))
+        return await claim_callbacks(10, [])
+
+    assert run(scenario()) == []
+
+
+def test_claim_batch_takes_due_changes_of_document_together(db):
+    doc = uuid4()
+    target = {'url': 'http://a', 'batch': True, 'max-count': 10, 'window': 0}
+
+    async def scenario():
+        await add(*[new_callback(doc_uuid=doc) for _ in range(3)])
+        rows, _ = await claim_batch(target)
+        await add(new_callback(doc_uuid=doc))
+        return rows, await claim_batch(target)
+
+    rows, (blocked, ready_at) = run(scenario())
+    assert len(rows) == 3
+    assert blocked == [] and ready_at is None
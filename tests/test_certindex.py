@@ -0,0 +1,98 @@
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+import certindex
+from certindex import CertIndex, subject_tokens
+
+
+class Cert:
+    def __init__(self, number, subject, days=30):
+        self.SerialNumber = number
+        self.SubjectName = subject
+        self.ValidToDate = datetime.now(tz=pytz.UTC) + timedelta(days=days)
+
+
+class Store:
+    """Хранилище, которое считает обращения к себе"""
+
+    def __init__(self, *certs):
+        self.list = list(certs)
+        self.reads = 0
+
+    @property
+    def certs(self):
+        self.reads += 1
+        return list(self.list)
+
+    def cert_valid_to(self, cert):
+        return cert.ValidToDate
+
+    def executor_initializer(self):
+        pass
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(certindex, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_subject_tokens():
+    assert subject_tokens('CN=Иванов, O=ООО "Ромашка, и К"') >= {'CN=Иванов', 'Иванов', 'ООО "Ромашка, и К"'}
+
+
+def test_lookups_are_served_from_cache(clock):
+    store = Store(Cert('1', 'CN=Иванов, O=Ромашка'), Cert('2', 'CN=Петров, O=Ромашка'), Cert('3', 'CN=Old', days=-1))
+    index = CertIndex(store, interval=0)
+
+    assert [e.number for e in index.find('1')] == ['1']
+    assert sorted(e.number for e in index.find('Ромашка')) == ['1', '2']
+    assert [e.number for e in index.find('Петр')] == ['2']  # подстрока, как в старом поиске
+    assert index.find('Old') == []  # просроченный
+    assert index.cached('3') is None
+    assert store.reads == 1
+
+
+def test_miss_refreshes_at_most_once_per_interval(clock):
+    store = Store(Cert('1', 'CN=A'))
+    index = CertIndex(store, interval=0)
+    assert index.find('2') == []
+    assert store.reads == 1
+
+    store.list.append(Cert('2', 'CN=B'))  # вставили токен
+    assert index.find('2') == []
+    assert store.reads == 1
+
+    clock[0] += certindex.MISS_REFRESH_INTERVAL + 1
+    assert [e.number for e in index.find('2')] == ['2']
+    assert store.reads == 2
+
+
+def test_cached_never_touches_the_store(clock):
+    store = Store(Cert('1', 'CN=A'))
+    index = CertIndex(store, interval=0)
+
+    assert index.cached('1') is None
+    assert store.reads == 0
+
+    assert index.refresh_if_stale()
+    assert index.cached('1').number == '1'
+    assert not index.refresh_if_stale()
+    assert store.reads == 1
+
+
+def test_cached_find_never_reads_the_store(clock):
+    store = Store(Cert('1', 'CN=A'), Cert('2', 'CN=Old', days=-1))
+    index = CertIndex(store, interval=0)
+    assert index.cached_find('1') is None  # ещё не загружен
+    assert store.reads == 0
+
+    index.refresh()
+    assert [e.number for e in index.cached_find('1')] == ['1']
+    assert [e.number for e in index.cached_find(None)] == ['1']
+    assert index.cached_find('Old') == []
+    assert index.cached_find('2000') is None  # промах - решает find() в потоке хранилища
+    assert store.reads == 1
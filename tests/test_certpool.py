@@ -0,0 +1,82 @@
+from uuid import uuid4
+
+import pytest
+
+from certpool import CertPool, NoAvailableCertificateException
+
+
+class Index:
+    def __init__(self, numbers):
+        self.numbers = set(numbers)
+
+    def cached(self, number):
+        return number if number in self.numbers else None
+
+
+class Logic:
+    def __init__(self, *numbers):
+        self.cert_index = Index(numbers)
+
+
+@pytest.fixture
+def signing(config):
+    def setup(certs, **options):
+        config._data['signing'] = {'certs': certs, **options}
+    return setup
+
+
+def test_round_robin_skips_missing_certs(signing):
+    signing([{'number': '1'}, {'number': '2'}, {'number': 'absent'}])
+    pool = CertPool(Logic('1', '2'))
+
+    used = []
+    for _ in range(4):
+        with pool.lease() as entry:
+            used.append(entry.number)
+    assert used == ['1', '2', '1', '2']
+
+
+def test_boxes_are_served_by_their_certs(signing):
+    box = str(uuid4())
+    signing([{'number': '1', 'boxes': [box.upper()]}, {'number': '2'}])
+    pool = CertPool(Logic('1', '2'))
+
+    assert pool.numbers(box) == ['1']
+    assert pool.numbers(uuid4()) == ['2']
+
+
+def test_failover_and_cooldown(signing, monkeypatch):
+    signing([{'number': '1'}, {'number': '2'}], **{'fail-limit': 2, 'cooldown': 60})
+    pool = CertPool(Logic('1', '2'))
+    now = [1000.0]
+    monkeypatch.setattr('certpool.monotonic', lambda: now[0])
+
+    entry = pool.acquire()
+    for _ in range(2):
+        pool.release(entry, ok=False)
+    assert entry.disabled
+    assert pool.numbers() == [n for n in ('1', '2') if n != entry.number]
+
+    now[0] += 61
+    assert sorted(pool.numbers()) == ['1', '2']
+
+
+def test_failed_lease_counts_as_failure(signing):
+    signing([{'number': '1'}], **{'fail-limit': 1})
+    pool = CertPool(Logic('1'))
+
+    with pytest.raises(RuntimeError):
+        with pool.lease():
+            raise RuntimeError('token removed')
+    with pytest.raises(NoAvailableCertificateException):
+        pool.acquire()
+
+
+def test_malformed_box_skips_only_its_entry(signing):
+    signing([{'number': '1', 'boxes': ['not-a-uuid']}, {'number': '2'}])
+    pool = CertPool(Logic('1', '2'))
+
+    # запись с ошибкой не становится общей и не ломает подпись остальными
+    assert pool.numbers(uuid4()) == ['2']
+    with pool.lease() as entry:
+        assert entry.number == '2'
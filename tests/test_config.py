@@ -0,0 +1,9 @@
+def test_workers_need_sign_daemon_and_postgres(config):
+    config._data['settings'] = dict(config._data['settings'], workers=4)
+    assert config.workers == 1
+
+    config._data['settings']['sign-daemon'] = True
+    assert config.workers == 1  # тесты работают на SQLite
+
+    config._data['db-connection-string'] = 'postgresql+asyncpg://cades@localhost/cades'
+    assert config.workers == 4
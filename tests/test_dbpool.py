@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from dbpool import MeteredPool, PoolStats
+
+
+@pytest.fixture
+def stats(monkeypatch):
+    stats = PoolStats()
+    monkeypatch.setattr(MeteredPool, 'stats', stats)
+    return stats
+
+
+def test_pool_stats_snapshot():
+    stats = PoolStats()
+    assert stats.snapshot()['avg_checkout_ms'] == 0.0
+
+    stats.observe(0.002, False, False)
+    stats.observe(0.004, True, True)
+    assert stats.snapshot() == {'checkouts': 2, 'waits': 1, 'timeouts': 1, 'connects': 0,
+                                'avg_checkout_ms': 3.0, 'max_checkout_ms': 4.0}
+
+
+def test_metered_pool_counts_waits_and_timeouts(stats, tmp_path):
+    async def scenario():
+        eng = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'pool.db'}", poolclass=MeteredPool,
+                                  pool_size=1, max_overflow=0, pool_timeout=0.1)
+        try:
+            async with eng.connect() as cnx:
+                await cnx.execute(text("SELECT 1"))
+                busy = eng.pool.usage()
+                with pytest.raises(TimeoutError):
+                    async with eng.connect():
+                        pass
+            async with eng.connect() as cnx:
+                await cnx.execute(text("SELECT 1"))
+            return busy, eng.pool.usage()
+        finally:
+            await eng.dispose()
+
+    busy, idle = asyncio.run(scenario())
+    assert (busy['size'], busy['checked_out'], busy['idle'], busy['max_overflow']) == (1, 1, 0, 0)
+    assert (idle['checked_out'], idle['idle']) == (0, 1)
+    assert (idle['checkouts'], idle['waits'], idle['timeouts'], idle['connects']) == (3, 1, 1, 1)
+    assert idle['max_checkout_ms'] >= 100
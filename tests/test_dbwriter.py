@@ -0,0 +1,84 @@
+import asyncio
+from datetime import datetime
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from conftest import run
+from const import CallbackStatus
+from db import Callback, Session
+from dbwriter import DbWriter, write
+
+
+@pytest.fixture
+def commits(config, monkeypatch) -> list[int]:
+    """Размеры зафиксированных пакетов"""
+    config._data['sqlite'] = {'group-commit-size': 3, 'group-commit-window': 20}
+    sizes = []
+    commit = DbWriter._commit
+
+    async def counting(self, batch):
+        sizes.append(len(batch))
+        await commit(self, batch)
+
+    monkeypatch.setattr(DbWriter, '_commit', counting)
+    return sizes
+
+
+def add_callback(url: str):
+    async def fn(ss: AsyncSession) -> str:
+        ss.add(Callback(doc_uuid=uuid4(), url=url, payload='{}', status=CallbackStatus.PENDING, tries=0,
+                        created_at=datetime.now()))
+        await ss.flush()
+        return url
+    return fn
+
+
+async def urls() -> list[str]:
+    async with Session() as ss:
+        return sorted((await ss.execute(select(Callback.url))).scalars())
+
+
+def test_group_commit(db, commits):
+    async def scenario():
+        results = await asyncio.gather(*(write(add_callback(f'http://{n}')) for n in range(5)))
+        return results, await urls()
+
+    results, saved = run(scenario())
+    assert results == [f'http://{n}' for n in range(5)]
+    assert saved == results
+    # group-commit-size = 3
+    assert commits == [3, 2]
+
+
+def test_failed_change_does_not_affect_others(db, commits):
+    async def fail(ss: AsyncSession):
+        await add_callback('http://failed')(ss)
+        raise ValueError('bad change')
+
+    async def scenario():
+        results = await asyncio.gather(write(add_callback('http://a')), write(fail), write(add_callback('http://b')),
+                                       return_exceptions=True)
+        return results, await urls()
+
+    (a, failed, b), saved = run(scenario())
+    assert (a, b) == ('http://a', 'http://b')
+    assert isinstance(failed, ValueError)
+    assert saved == ['http://a', 'http://b']
+    assert commits == [3]
+
+
+def test_failed_commit_fails_whole_batch(db, commits, monkeypatch):
+    async def broken(self):
+        raise RuntimeError('disk I/O error')
+
+    monkeypatch.setattr(AsyncSession, 'commit', broken)
+
+    async def scenario():
+        return await asyncio.gather(*(write(add_callback(f'http://{n}')) for n in range(2)), return_exceptions=True)
+
+    assert [str(e) for e in run(scenario())] == ['disk I/O error'] * 2
+    monkeypatch.undo()
+    assert run(urls()) == []
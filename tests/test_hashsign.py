@@ -0,0 +1,81 @@
+"""Подпись хэша (hash-sign). logic нужен pycades"""
+import io
+from base64 import b64decode, b64encode
+
+import pytest
+
+logic = pytest.importorskip('logic', exc_type=ImportError)
+
+from logic import HASH_CHUNK_SIZE, LogicMock, chunked  # noqa: E402
+
+
+@pytest.fixture
+def hash_sign(config):
+    config._data['settings'] = dict(config._data['settings'], **{'hash-sign': True})
+    return config
+
+
+def spy(monkeypatch, cades, method) -> list:
+    calls = []
+    monkeypatch.setattr(cades, method, lambda data, *args: calls.append(data) or b'sign')
+    return calls
+
+
+def test_chunked():
+    data = b'x' * (HASH_CHUNK_SIZE * 2 + 1)
+    assert [len(c) for c in chunked(data)] == [HASH_CHUNK_SIZE, HASH_CHUNK_SIZE, 1]
+    assert list(chunked(b'')) == []
+
+
+def test_sign_file_hashes_in_chunks(hash_sign, monkeypatch):
+    content = bytes(range(256)) * (HASH_CHUNK_SIZE // 100)
+    cades = LogicMock()
+    calls = spy(monkeypatch, cades, 'sign_hash')
+    assert cades.sign_file(io.BytesIO(content)) == b'sign'
+    chunks = list(calls[0])
+    assert all(len(c) <= HASH_CHUNK_SIZE for c in chunks) and len(chunks) > 1
+    assert b''.join(chunks) == content
+
+
+def test_sign_file_without_hash_sign(config, monkeypatch):
+    cades = LogicMock()
+    calls = spy(monkeypatch, cades, 'sign_data')
+    cades.sign_file(io.BytesIO(b'content'))
+    assert calls == [b64encode(b'content')]
+
+
+def test_attached_sign_file_ignores_hash_sign(hash_sign, monkeypatch):
+    cades = LogicMock()
+    calls = spy(monkeypatch, cades, 'sign_data')
+    cades.sign_file(io.BytesIO(b'content'), detached_sign=False)
+    assert calls == [b64encode(b'content')]
+
+
+@pytest.mark.skipif(not hasattr(logic, 'pycades'), reason='pycades implementation only')
+def test_pycades_sign_hash(monkeypatch):
+    hashed, signed = [], []
+
+    class HashedData:
+        def Hash(self, chunk):
+            hashed.append(b64decode(chunk))
+
+    class SignedData:
+        def SignHash(self, hd, signer, cades_type, encoding):
+            signed.append((hd.Algorithm, signer.Certificate, cades_type))
+            return 'sign'
+
+    class Signer:
+        pass
+
+    class Cert:
+        def PublicKey(self):
+            raise RuntimeError
+
+    for name, value in (('HashedData', HashedData), ('SignedData', SignedData), ('Signer', Signer)):
+        monkeypatch.setattr(logic.pycades, name, value)
+
+    cert = Cert()
+    cades = object.__new__(logic.Logic)
+    assert cades.sign_hash(chunked(b'abc' * HASH_CHUNK_SIZE), cert=cert) == b'sign'
+    assert b''.join(hashed) == b'abc' * HASH_CHUNK_SIZE
+    assert signed == [(logic.CADESCOM_HASH_ALGORITHM_CP_GOST_3411_2012_256, cert, logic.pycades.CADESCOM_CADES_BES)]
@@ -0,0 +1,66 @@
+"""Асинхронные обращения к сертификатам. logic нужен pycades"""
+import asyncio
+import threading
+
+import pytest
+
+pytest.importorskip('logic', exc_type=ImportError)
+
+from logic import LogicMock  # noqa: E402
+
+
+@pytest.fixture
+def cades(config):
+    config._data['settings'] = dict(config._data['settings'], **{'sign-workers': 1, 'cert-refresh-interval': 0})
+    cades = LogicMock()
+    yield cades
+    cades.executor.shutdown(wait=False)
+    cades.store_executor.shutdown(wait=False)
+
+
+@pytest.fixture
+def busy(cades):
+    """Единственный поток подписи занят"""
+    release = threading.Event()
+    cades.executor.submit(release.wait)
+    yield
+    release.set()
+
+
+def test_cert_lookups_do_not_wait_for_signing(cades, busy):
+    async def main():
+        return await asyncio.wait_for(asyncio.gather(cades.aactual_certs(), cades.afind_cert('12345'),
+                                                     cades.adefault_cert()), 1)
+
+    actual, found, default = asyncio.run(main())
+    assert [c.SerialNumber for c in actual] == [c.SerialNumber for c in found] == ['12345']
+    assert default.SerialNumber == '12345'
+
+
+def test_cached_hits_do_not_touch_the_store(cades, monkeypatch):
+    asyncio.run(cades.aactual_certs())
+    asyncio.run(cades.adefault_cert())
+
+    async def in_store(fn, *args):
+        pytest.fail('store is read for a cached certificate')
+
+    monkeypatch.setattr(cades, 'in_store', in_store)
+
+    async def main():
+        await cades.aset_default_cert('12345')
+        return (await cades.afind_cert('12345'), await cades.afind_cert('My Certificate'),
+                await cades.aactual_certs(), await cades.adefault_cert(), await cades.asigning_cert_numbers())
+
+    found, by_subject, actual, default, numbers = asyncio.run(main())
+    assert len(found) == len(by_subject) == len(actual) == 1
+    assert numbers == ['12345']
+
+
+def test_cache_miss_goes_to_the_store(cades, monkeypatch):
+    asyncio.run(cades.aactual_certs())
+    calls = []
+    in_store = cades.in_store
+    monkeypatch.setattr(cades, 'in_store', lambda fn, *args: calls.append(fn) or in_store(fn, *args))
+
+    assert asyncio.run(cades.afind_cert('unknown')) == []
+    assert len(calls) == 1
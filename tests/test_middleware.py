@@ -0,0 +1,29 @@
+from middleware import Whitelist
+
+
+def test_whitelist_addresses_and_networks():
+    wl = Whitelist(['127.0.0.1', '10.0.0.0/8', '192.168.1.17/24', '2001:db8::/32', 'gateway'])
+
+    assert '127.0.0.1' in wl
+    assert '127.0.0.2' not in wl
+    assert '10.200.3.4' in wl
+    assert '11.0.0.1' not in wl
+    # адрес узла в записи подсети приводится к самой подсети
+    assert '192.168.1.200' in wl
+    assert '192.168.2.1' not in wl
+    assert '2001:db8::1' in wl
+    assert '2001:db9::1' not in wl
+    assert 'gateway' in wl
+    assert 'unknown' not in wl
+
+
+def test_whitelist_ipv4_mapped():
+    wl = Whitelist(['10.0.0.0/8'])
+    assert '::ffff:10.1.2.3' in wl
+    assert '::ffff:11.1.2.3' not in wl
+
+
+def test_whitelist_empty():
+    wl = Whitelist([])
+    assert wl.empty
+    assert '127.0.0.1' not in wl
@@ -0,0 +1,60 @@
+import asyncio
+from uuid import uuid4
+
+from sqlalchemy import inspect, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from db import Base
+from migrations import MIGRATIONS, migrate
+
+# documents в том виде, в каком она была до миграций: подпись в самой таблице, без колонок очереди
+LEGACY_DOCUMENTS = """
+CREATE TABLE documents (
+    uuid CHAR(32) NOT NULL PRIMARY KEY, message_id CHAR(32), entity_id CHAR(32),
+    source_box CHAR(32) NOT NULL, dest_box CHAR(32), dest_inn VARCHAR(20), dest_kpp VARCHAR(20),
+    name VARCHAR(128), number VARCHAR(64), amount DECIMAL(17, 5), vat DECIMAL(17, 5), grounds VARCHAR(256),
+    date DATE, send_time DATETIME, sign BLOB, signed_data BLOB,
+    status VARCHAR(11) NOT NULL, tries INTEGER NOT NULL, error_msg VARCHAR(512),
+    login VARCHAR(128), password VARCHAR(128), diadoc_status VARCHAR(32), diadoc_status_descr VARCHAR(256))
+"""
+
+
+def test_migrate_legacy_db_is_idempotent(tmp_path):
+    uuid = uuid4().hex
+
+    def state(cnx):
+        return ({c['name'] for c in inspect(cnx).get_columns('documents')},
+                {i['name'] for i in inspect(cnx).get_indexes('documents')},
+                cnx.execute(text("SELECT version FROM schema_version ORDER BY version")).scalars().all(),
+                cnx.execute(text("SELECT sign, signed_data FROM document_blobs")).all(),
+                cnx.execute(text("SELECT sign FROM documents")).scalars().all())
+
+    async def scenario():
+        eng = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'legacy.db'}")
+        try:
+            async with eng.begin() as cnx:
+                await cnx.execute(text(LEGACY_DOCUMENTS))
+                await cnx.execute(text("INSERT INTO documents (uuid, source_box, status, tries, sign, signed_data) "
+                                       "VALUES (:uuid, :box, 'SENT', 1, x'01', x'02')"),
+                                  {'uuid': uuid, 'box': uuid4().hex})
+                await cnx.execute(text("CREATE INDEX ix_documents_pending ON documents (status)"))
+                await cnx.run_sync(Base.metadata.create_all)
+
+            states = []
+            for _ in range(2):
+                await migrate(eng)
+                async with eng.connect() as cnx:
+                    states.append(await cnx.run_sync(state))
+            return states
+        finally:
+            await eng.dispose()
+
+    first, second = asyncio.run(scenario())
+    assert first == second
+
+    columns, indexes, versions, blobs, signs = first
+    assert {'next_attempt_at', 'claimed_by', 'lease_until', 'content_hash'} <= columns
+    assert 'ix_documents_queue' in indexes and 'ix_documents_pending' not in indexes
+    assert versions == [number for number, _ in MIGRATIONS]
+    assert blobs == [(b'\x01', b'\x02')]
+    assert signs == [None]
@@ -0,0 +1,23 @@
+import asyncio
+from datetime import timedelta
+
+from retry import Wakeup, backoff_delay
+
+POLICY = {'base-delay': 10, 'max-delay': 60, 'max-tries': 5}
+
+
+def test_backoff_delay_grows_and_is_capped():
+    for tries, delay in ((1, 10), (2, 20), (3, 40), (4, 60), (10, 60)):
+        for _ in range(20):
+            assert timedelta(seconds=delay / 2) <= backoff_delay(POLICY, tries) <= timedelta(seconds=delay)
+
+
+def test_wakeup_event_is_created_lazily():
+    wakeup = Wakeup()
+    assert wakeup._event is None
+
+    async def main():
+        wakeup.set()
+        await asyncio.wait_for(wakeup.event.wait(), 1)
+
+    asyncio.run(main())
@@ -0,0 +1,117 @@
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+import pytest
+
+import sender
+from conftest import run
+from const import DocumentStatus
+from db import Document, Session
+
+
+def new_document(**values) -> Document:
+    values = {'uuid': uuid4(), 'source_box': uuid4(), 'name': 'doc', 'status': DocumentStatus.RECEIVED,
+              'tries': 0, **values}
+    return Document(**values)
+
+
+async def add(*docs: Document):
+    # expire_on_commit у SQLite: uuid нужно прочитать заранее
+    uuids = [doc.uuid for doc in docs]
+    async with Session() as ss:
+        ss.add_all(docs)
+        await ss.commit()
+    return uuids
+
+
+async def load(uuid) -> Document:
+    async with Session() as ss:
+        return await ss.get(Document, uuid)
+
+
+@pytest.fixture
+def retry(config):
+    config._data['retry'] = {'base-delay': 10, 'max-delay': 30, 'max-tries': 5,
+                             'classes': {sender.ERR_LOOKUP: {'max-tries': 2}}}
+
+
+def test_schedule_retry_backoff(retry):
+    doc = new_document()
+    before = datetime.now()
+
+    assert sender.schedule_retry(doc, sender.ERR_NETWORK, b'timeout') is False
+    assert doc.tries == 1
+    assert doc.status == DocumentStatus.RECEIVED
+    assert doc.error_msg == 'timeout'
+    assert before + timedelta(seconds=5) <= doc.next_attempt_at <= datetime.now() + timedelta(seconds=10)
+
+    doc.tries = 3
+    sender.schedule_retry(doc, sender.ERR_NETWORK, 'timeout')
+    # 10 * 2**3 = 80 упирается в max-delay
+    assert doc.next_attempt_at <= datetime.now() + timedelta(seconds=30)
+
+
+def test_schedule_retry_dead_by_class(retry):
+    doc = new_document()
+    assert sender.schedule_retry(doc, sender.ERR_LOOKUP, 'no org') is False
+    assert sender.schedule_retry(doc, sender.ERR_LOOKUP, 'no org') is True
+    assert doc.status == DocumentStatus.DEAD
+    assert doc.next_attempt_at is None
+
+
+def test_schedule_retry_class_limit_above_global(config):
+    config._data['retry'] = {'max-tries': 2, 'classes': {sender.ERR_THROTTLED: {'max-tries': 4}}}
+    doc = new_document(tries=2)
+    assert sender.schedule_retry(doc, sender.ERR_THROTTLED, '429') is False
+    assert sender.schedule_retry(doc, sender.ERR_THROTTLED, '429') is True
+    assert doc.tries == 4
+
+
+def test_claim_documents_respects_leases(db):
+    now = datetime.now()
+    free = new_document()
+    expired = new_document(claimed_by='other', lease_until=now - timedelta(seconds=1))
+    leased = new_document(claimed_by='other', lease_until=now + timedelta(minutes=5))
+    later = new_document(next_attempt_at=now + timedelta(minutes=5))
+    dead = new_document(status=DocumentStatus.DEAD)
+
+    async def scenario():
+        uuids = await add(free, expired, leased, later, dead)
+        first = await sender.claim_documents(10)
+        second = await sender.claim_documents(10)
+        return uuids, first, second, await load(uuids[1])
+
+    uuids, first, second, reclaimed = run(scenario())
+    assert set(first) == set(uuids[:2])
+    assert second == []
+    assert reclaimed.claimed_by == sender.INSTANCE_ID
+    assert reclaimed.lease_until > now
+
+
+def test_claim_documents_limit(db):
+    async def scenario():
+        await add(*[new_document() for _ in range(5)])
+        return [len(await sender.claim_documents(2)) for _ in range(4)]
+
+    assert run(scenario()) == [2, 2, 1, 0]
+
+
+def test_process_document_failure_is_a_try(db, retry, monkeypatch):
+    async def fail(doc):
+        raise RuntimeError('boom')
+
+    monkeypatch.setattr(sender, 'send_document', fail)
+    doc = new_document()
+
+    async def scenario():
+        uuid, = await add(doc)
+        assert await sender.claim_documents(10) == [uuid]
+        with pytest.raises(RuntimeError):
+            await sender.process_document(uuid)
+        return await load(uuid), await sender.claim_documents(10)
+
+    saved, claimed = run(scenario())
+    assert saved.tries == 1
+    assert saved.next_attempt_at > datetime.now()
+    assert saved.claimed_by is None
+    assert claimed == []
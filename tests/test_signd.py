@@ -0,0 +1,159 @@
+"""Протокол демона подписи. signd импортирует logic, которому нужен pycades"""
+import asyncio
+import io
+import os
+import stat
+
+import pytest
+
+pytest.importorskip('logic', exc_type=ImportError)
+
+import signd  # noqa: E402
+from signd import RemoteLogic, SignDaemon, SignDaemonError, ensure_key, pack_frame, read_frame  # noqa: E402
+
+
+def test_frames_roundtrip():
+    async def main():
+        reader = asyncio.StreamReader()
+        reader.feed_data(pack_frame({'id': 1, 'method': 'sign', 'params': {'data': 'тест'}}) + pack_frame({'id': 2}))
+        reader.feed_eof()
+        first, second = await read_frame(reader), await read_frame(reader)
+        with pytest.raises(asyncio.IncompleteReadError):
+            await read_frame(reader)
+        return first, second
+
+    assert asyncio.run(main()) == ({'id': 1, 'method': 'sign', 'params': {'data': 'тест'}}, {'id': 2})
+
+
+@pytest.fixture
+def key_file(config, tmp_path):
+    path = str(tmp_path / 'signd.key')
+    config._data['settings'] = dict(config._data['settings'], **{'sign-daemon-key': path})
+    return path
+
+
+@pytest.fixture
+def address(key_file, tmp_path):
+    return str(tmp_path / 'signd.sock')
+
+
+async def serving(address: str):
+    task = asyncio.create_task(SignDaemon(address).serve())
+    for _ in range(100):
+        try:
+            await asyncio.open_unix_connection(address)
+            return task
+        except OSError:
+            await asyncio.sleep(0.01)
+    raise RuntimeError('sign daemon is not started')
+
+
+def test_remote_calls(address):
+    async def main():
+        daemon = await serving(address)
+        try:
+            remote = RemoteLogic(address)
+            signed = await asyncio.gather(*(remote.asign_data(b'doc') for _ in range(5)),
+                                          remote.asign_file(io.BytesIO(b'x' * 500_000)))
+            certs = await remote.afind_cert('12345')
+            # синхронный вариант - своё соединение с той же проверкой ключа
+            assert await asyncio.to_thread(remote.call_sync, 'certs', query='12345') == \
+                [{'number': c.SerialNumber, 'subject': c.SubjectName, 'valid_to': c.ValidToDate} for c in certs]
+            with pytest.raises(ValueError):
+                await remote.aset_default_cert('unknown')
+            with pytest.raises(SignDaemonError):
+                await remote.call('unknown')
+            return signed, certs
+        finally:
+            daemon.cancel()
+
+    signed, certs = asyncio.run(main())
+    assert all(sr.sign and sr.cert_number == '12345' for sr in signed)
+    assert [c.SerialNumber for c in certs] == ['12345']
+
+
+def test_lost_connection_fails_only_its_own_requests(address, monkeypatch):
+    connections = []
+    received = asyncio.Event()
+    # обрыв первого соединения замечаем только после того, как запрос ушёл во второе
+    gate = asyncio.Event()
+    readers = []
+
+    async def gated_read_frame(reader):
+        if reader not in readers:
+            readers.append(reader)
+        try:
+            return await read_frame(reader)
+        except asyncio.IncompleteReadError:
+            if reader is readers[0]:
+                await gate.wait()
+            raise
+
+    monkeypatch.setattr(signd, 'read_frame', gated_read_frame)
+
+    daemon = SignDaemon(address)
+    daemon.key = ensure_key(daemon.key_file)
+
+    async def handle(reader, writer):
+        # первое соединение не отвечает, второе отвечает, когда первое уже оборвано
+        assert await daemon.authenticate(reader, writer)
+        first = not connections
+        connections.append(writer)
+        try:
+            while req := await read_frame(reader):
+                if not first:
+                    received.set()
+                    await asyncio.sleep(0.05)
+                    writer.write(pack_frame({'id': req['id'], 'result': 'ok'}))
+                    await writer.drain()
+        except asyncio.IncompleteReadError:
+            pass
+
+    async def main():
+        server = await asyncio.start_unix_server(handle, address)
+        async with server:
+            remote = RemoteLogic(address)
+            lost = asyncio.create_task(remote.call('certs'))
+            await asyncio.sleep(0.05)
+            remote._writer.close()
+            answered = asyncio.create_task(remote.call('certs'))
+            await received.wait()
+            gate.set()
+            with pytest.raises(SignDaemonError):
+                await lost
+            return await answered, len(connections)
+
+    assert asyncio.run(main()) == ('ok', 2)
+
+
+def test_key_file_is_private(key_file):
+    key = ensure_key(key_file)
+    assert len(key) == 64 and ensure_key(key_file) == key
+    assert stat.S_IMODE(os.stat(key_file).st_mode) == 0o600
+
+
+def test_requests_without_the_key_are_refused(address, key_file):
+    async def main():
+        daemon = await serving(address)
+        try:
+            reader, writer = await asyncio.open_unix_connection(address)
+            challenge = await read_frame(reader)
+            # запрос вместо ответа на вызов
+            writer.write(pack_frame({'id': 1, 'method': 'certs', 'params': {}}))
+            with pytest.raises(asyncio.IncompleteReadError):
+                await read_frame(reader)
+
+            with open(key_file, 'w') as f:
+                f.write('other key')
+            with pytest.raises(SignDaemonError):
+                await RemoteLogic(address).call('certs')
+            return challenge
+        finally:
+            daemon.cancel()
+
+    assert 'challenge' in asyncio.run(main())
+
+
+def test_tcp_only_on_loopback(key_file):
+    with pytest.raises(SignDaemonError):
+        asyncio.run(SignDaemon('0.0.0.0:8765').serve())
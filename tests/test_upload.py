@@ -0,0 +1,83 @@
+import hashlib
+
+import pytest
+from starlette.requests import Request
+
+from conftest import run
+from upload import CHUNK_SIZE, SpooledDocument, UploadTooLargeException
+
+
+def make_request(body: bytes, content_type: str = 'application/octet-stream', chunk: int = 1000,
+                 content_length: bool = False) -> tuple[Request, list]:
+    """Запрос, тело которого приходит кусками по chunk байт. Во втором значении - принятые куски"""
+    parts = [body[i:i + chunk] for i in range(0, len(body), chunk)] or [b'']
+    sent = []
+
+    async def receive():
+        part = parts[len(sent)]
+        sent.append(part)
+        return {'type': 'http.request', 'body': part, 'more_body': len(sent) < len(parts)}
+
+    headers = [(b'content-type', content_type.encode())]
+    if content_length:
+        headers.append((b'content-length', str(len(body)).encode()))
+    return Request({'type': 'http', 'method': 'POST', 'headers': headers}, receive), sent
+
+
+def multipart(content: bytes, boundary: str = 'xyz') -> tuple[bytes, str]:
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="doc.xml"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n').encode() + content + f'\r\n--{boundary}--\r\n'.encode()
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+def test_stream_spools_to_disk():
+    content = bytes(range(256)) * 100
+    request, _ = make_request(content)
+    with SpooledDocument(max_memory=1000) as sd:
+        run(sd.receive(request))
+        assert sd.file._rolled
+        assert sd.size == len(content)
+        assert sd.hexdigest == hashlib.sha256(content).hexdigest()
+        assert b''.join(sd.chunks()) == content
+
+
+def test_multipart_file_field():
+    content = b'<xml>' * 1000
+    body, content_type = multipart(content)
+    request, _ = make_request(body, content_type)
+    with SpooledDocument(max_memory=1 << 20, max_size=len(content)) as sd:
+        run(sd.receive(request))
+        assert b''.join(sd.chunks()) == content
+
+
+def test_b64content_chunks_concatenate():
+    from base64 import b64encode
+    content = b'x' * (CHUNK_SIZE * 2 + 5)
+    with SpooledDocument(max_memory=1000) as sd:
+        sd.write(content)
+        assert sd.b64content() == b64encode(content)
+
+
+def test_stream_rejected_while_reading():
+    request, sent = make_request(b'x' * 10_000, chunk=1000)
+    with SpooledDocument(max_memory=1000, max_size=2500) as sd:
+        with pytest.raises(UploadTooLargeException):
+            run(sd.receive(request))
+    assert len(sent) == 3
+
+
+def test_multipart_rejected_before_form_is_parsed():
+    body, content_type = multipart(b'x' * 200_000)
+    request, sent = make_request(body, content_type, chunk=10_000)
+    with SpooledDocument(max_memory=1000, max_size=1000) as sd:
+        with pytest.raises(UploadTooLargeException):
+            run(sd.receive(request))
+    assert len(sent) < len(body) // 10_000
+
+
+def test_content_length_rejected_up_front():
+    request, sent = make_request(b'x' * 10_000, content_length=True)
+    with SpooledDocument(max_memory=1000, max_size=100) as sd:
+        with pytest.raises(UploadTooLargeException):
+            run(sd.receive(request))
+    assert not sent
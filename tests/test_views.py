@@ -0,0 +1,62 @@
+"""Обработчики роутера. router.views импортирует logic, которому нужен pycades"""
+from base64 import b64encode
+from datetime import date
+from uuid import uuid4
+
+import pytest
+
+pytest.importorskip('pycades')
+
+from sqlalchemy import func, select  # noqa: E402
+
+from conftest import run  # noqa: E402
+from db import Document  # noqa: E402
+from router.types import DocumentRequest, ServiceStatus  # noqa: E402
+from router.views import db_pool, senddocs  # noqa: E402
+
+
+def item(data: bytes = b'<xml/>', uuid=None) -> DocumentRequest:
+    return DocumentRequest(source_box=uuid4(), uuid=uuid or uuid4(), name='doc', number='1',
+                           date=date.today(), amount=1, data=b64encode(data))
+
+
+async def stored() -> int:
+    from db import Session
+    async with Session() as ss:
+        return await ss.scalar(select(func.count()).select_from(Document))
+
+
+def test_senddocs_per_item_results(db):
+    a, b = item(b'a'), item(b'b')
+    results = run(senddocs([a, b]))
+    assert [(r.uuid, r.status) for r in results] == [(a.uuid, ServiceStatus.OK), (b.uuid, ServiceStatus.OK)]
+    assert run(stored()) == 2
+
+
+def test_senddocs_dedup_in_batch_and_with_stored(db):
+    a = item(b'a')
+    run(senddocs([a]))
+
+    copy, b = item(b'a', a.uuid), item(b'b')
+    results = run(senddocs([a, copy, b]))
+    assert [r.status for r in results] == [ServiceStatus.ALREADY, ServiceStatus.ALREADY, ServiceStatus.OK]
+    assert results[1].msg == 'Document is duplicated in batch'
+    assert run(stored()) == 2
+
+
+def test_senddocs_reports_same_content(db):
+    a, b = item(b'same'), item(b'same')
+    results = run(senddocs([a, b]))
+    assert all(r.status == ServiceStatus.OK for r in results)
+    assert results[0].duplicates == [b.uuid]
+    assert results[1].duplicates == [a.uuid]
+
+
+def test_db_pool_reports_usage(db):
+    async def scenario():
+        await stored()
+        return await db_pool()
+
+    usage = run(scenario())
+    assert usage.checked_out == 0 and usage.idle >= 1
+    assert usage.checkouts >= 1
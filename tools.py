@@ -1,3 +1,4 @@
+import os
 import sys
 from os.path import dirname
 from logger import logger
@@ -27,3 +28,24 @@ def get_installation_dir():
     except Exception as ex:
         logger.error(ex)
     return fallback()
+
+
+def restrict_to_owner(path: str):
+    """Доступ к файлу - только у учётной записи, под которой работает сервис"""
+    if sys.platform != 'win32':
+        os.chmod(path, 0o600)
+        return
+
+    import ntsecuritycon
+    import win32api
+    import win32security
+
+    token = win32security.OpenProcessToken(win32api.GetCurrentProcess(), win32security.TOKEN_QUERY)
+    sid, _ = win32security.GetTokenInformation(token, win32security.TokenUser)
+    dacl = win32security.ACL()
+    dacl.AddAccessAllowedAce(win32security.ACL_REVISION, ntsecuritycon.FILE_ALL_ACCESS, sid)
+    # без наследования прав от каталога
+    win32security.SetNamedSecurityInfo(path, win32security.SE_FILE_OBJECT,
+                                       win32security.DACL_SECURITY_INFORMATION |
+                                       win32security.PROTECTED_DACL_SECURITY_INFORMATION,
+                                       None, None, dacl, None)
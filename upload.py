@@ -0,0 +1,95 @@
+import hashlib
+from base64 import b64encode
+from tempfile import SpooledTemporaryFile
+from typing import BinaryIO, Iterator
+
+from starlette.datastructures import UploadFile
+from starlette.requests import Request
+
+
+# кратно 3, чтобы куски можно было кодировать в base64 по отдельности
+CHUNK_SIZE = 3 * 64 * 1024
+
+MULTIPART = 'multipart/form-data'
+FILE_FIELD = 'file'
+# запас на заголовки и границы частей multipart сверх размера самого документа
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+class UploadTooLargeException(Exception): ...
+
+
+class SpooledDocument:
+    """Содержимое документа, принятое потоком. Пока не превышен max_memory - лежит в памяти,
+    потом во временном файле. sha256 считается по мере приёма"""
+
+    def __init__(self, max_memory: int, max_size: int|None = None):
+        self.file: BinaryIO = SpooledTemporaryFile(max_size=max_memory)
+        self.max_size = max_size
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+
+    def __enter__(self) -> 'SpooledDocument':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.max_size and self.size > self.max_size:
+            raise self._too_large()
+        self._sha256.update(chunk)
+        self.file.write(chunk)
+
+    def _too_large(self) -> UploadTooLargeException:
+        return UploadTooLargeException(f"Document is larger than {self.max_size} bytes")
+
+    def _limited(self, request: Request, limit: int) -> Request:
+        """Запрос, тело которого обрывается с UploadTooLargeException, как только принято больше limit байт.
+        Starlette разбирает multipart целиком до того, как мы увидим файл, поэтому считаем байты на входе"""
+        received = 0
+
+        async def receive():
+            nonlocal received
+            message = await request.receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > limit:
+                    raise self._too_large()
+            return message
+
+        return Request(request.scope, receive)
+
+    async def receive(self, request: Request):
+        multipart = request.headers.get('content-type', '').startswith(MULTIPART)
+        if self.max_size:
+            limit = self.max_size + (MULTIPART_OVERHEAD if multipart else 0)
+            if int(request.headers.get('content-length') or 0) > limit:
+                raise self._too_large()
+            request = self._limited(request, limit)
+        if multipart:
+            async with request.form() as form:
+                if not isinstance(upload := form.get(FILE_FIELD), UploadFile):
+                    raise ValueError(f"multipart field '{FILE_FIELD}' with document content is required")
+                while chunk := await upload.read(CHUNK_SIZE):
+                    self.write(chunk)
+        else:
+            async for chunk in request.stream():
+                self.write(chunk)
+        self.file.seek(0)
+
+    @property
+    def hexdigest(self) -> str:
+        return self._sha256.hexdigest()
+
+    def chunks(self, size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        self.file.seek(0)
+        while chunk := self.file.read(size):
+            yield chunk
+
+    def b64content(self) -> bytes:
+        return b''.join(b64encode(chunk) for chunk in self.chunks())
@@ -5,6 +5,8 @@ import socket
 import sys
 from asyncio import CancelledError
 
+# до первого импорта pywin32: COM в потоках службы - MTA (см. logic.py)
+sys.coinit_flags = 0
 import servicemanager  # Simple setup and logging
 import win32event
 import win32service  # Events